@@ -0,0 +1,372 @@
+"""
+Mock Microsoft Graph and token endpoint server for benchmarks
+
+Serves generated users, groups (with members@delta) and Planner plans/tasks with paging, delta links, JSON batching,
+gzip compressed responses and optional latency and throttling (429) injection. Write requests (POST/PATCH/DELETE)
+are accepted and answered without keeping state.
+
+Point the service to it with GRAPH_ROOT=http://127.0.0.1:<port> and LOGIN_URL=http://127.0.0.1:<port>
+
+Extra endpoints:
+GET /_stats - request, connection, throttling and response size counters
+POST /_reset - reset counters
+
+Usage: python benchmark/mock_graph.py --port 8900 --users 100000 --groups 5000 --latency 0.05
+"""
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode, unquote
+
+NAMES = ['anna', 'bjorn', 'carl', 'dina', 'erik', 'frida', 'geir', 'hanne', 'ivar', 'jonas', 'kari', 'lars', 'mona',
+         'nils', 'ola', 'per', 'quinn', 'rune', 'siri', 'tor', 'ulf', 'vera', 'will', 'xena', 'yngve', 'zara']
+
+ID_PATTERN = '[^/]+'
+
+ROUTES = [
+    ('token', 'POST', re.compile(r'/[^/]+/oauth2/v2\.0/token')),
+    ('batch', 'POST', re.compile(r'/\$batch')),
+    ('delta', 'GET', re.compile(r'/(users|groups)/delta')),
+    ('collection', 'GET', re.compile(r'/(users|groups)/?')),
+    ('object', 'GET', re.compile(rf'/(users|groups)/({ID_PATTERN})')),
+    ('group_plans', 'GET', re.compile(rf'/groups/({ID_PATTERN})/planner/plans')),
+    ('plan_details', 'GET', re.compile(rf'/planner/plans/({ID_PATTERN})/details')),
+    ('plan_tasks', 'GET', re.compile(rf'/planner/plans/({ID_PATTERN})/tasks')),
+    ('task_details', 'GET', re.compile(rf'/planner/tasks/({ID_PATTERN})/details')),
+    ('create', 'POST', re.compile(r'/(users|groups)/?')),
+    ('update', 'PATCH', re.compile(rf'/(users|groups)/({ID_PATTERN})')),
+    ('delete', 'DELETE', re.compile(rf'/(users|groups)/({ID_PATTERN})(/.*)?')),
+    ('members', 'POST', re.compile(rf'/groups/({ID_PATTERN})/members/\$ref')),
+]
+
+
+class Directory:
+    """
+    Generated tenant content, objects are built on request from their index
+    """
+
+    def __init__(self, args):
+        self.args = args
+        # lowercase keys, Graph compares strings case insensitively
+        self.keys = {
+            'users': sorted((self.user_key(i).lower(), i) for i in range(args.users)),
+            'groups': sorted((self.group_key(i).lower(), i) for i in range(args.groups))
+        }
+
+    @staticmethod
+    def user_key(i: int) -> str:
+        return f'{NAMES[i % len(NAMES)]}.{i:07d}@bench.onmicrosoft.com'
+
+    @staticmethod
+    def group_key(i: int) -> str:
+        return f'{NAMES[(i * 7) % len(NAMES)].capitalize()} group {i:06d}'
+
+    def user(self, i: int) -> dict:
+        upn = self.user_key(i)
+        name = upn.split('@')[0]
+        return {
+            'id': f'00000000-0000-4000-8000-{i:012d}',
+            'businessPhones': ['+47 22 00 00 00'],
+            'displayName': name.replace('.', ' ').title(),
+            'givenName': name.split('.')[0].title(),
+            'jobTitle': 'Engineer',
+            'mail': f'{name}@bench.example.com',
+            'mobilePhone': None,
+            'officeLocation': 'Oslo',
+            'preferredLanguage': 'nb-NO',
+            'surname': name.split('.')[1],
+            'userPrincipalName': upn,
+            'mailNickname': name
+        }
+
+    def group(self, i: int) -> dict:
+        name = self.group_key(i)
+        return {
+            'id': f'10000000-0000-4000-8000-{i:012d}',
+            'displayName': name,
+            'description': f'Benchmark group {i}',
+            'mail': f'group{i}@bench.example.com',
+            'mailEnabled': True,
+            'mailNickname': f'group{i}',
+            'securityEnabled': False,
+            'groupTypes': ['Unified']
+        }
+
+    def members(self, i: int, changed: bool = False) -> list:
+        """
+        members@delta of group, incremental delta returns one added and one removed member
+        """
+        count = min(self.args.members, self.args.users)
+        users = [(i * count + k) % self.args.users for k in range(count)]
+        members = [{'@odata.type': '#microsoft.graph.user', 'id': self.user(u)['id']} for u in users]
+        if changed and members:
+            return [members[0], {**members[-1], '@removed': {'reason': 'deleted'}}]
+        return members
+
+    def object(self, kind: str, i: int) -> dict:
+        return self.user(i) if kind == 'users' else self.group(i)
+
+    def indexes(self, kind: str, query: dict) -> list:
+        """
+        Indexes of objects matching ge/le filters on userPrincipalName/displayName
+        """
+        keys = self.keys[kind]
+        lower, upper = 0, len(keys)
+        condition = query.get('$filter', '')
+        match = re.search(r"\w+ ge '((?:[^']|'')*)'", condition)
+        if match:
+            lower = _bisect(keys, match.group(1), left=True)
+        match = re.search(r"\w+ le '((?:[^']|'')*)'", condition)
+        if match:
+            upper = _bisect(keys, match.group(1), left=False)
+        return [index for _, index in keys[lower:upper]]
+
+
+def _bisect(keys: list, value: str, left: bool) -> int:
+    """
+    Position of value in sorted list of (lowercase key, index)
+    """
+    value = value.replace("''", "'").lower()
+    lo, hi = 0, len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        key = keys[mid][0]
+        if key < value or (not left and key == value):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class MockGraph:
+
+    def __init__(self, args):
+        self.args = args
+        self.directory = Directory(args)
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.stats[name] += value
+
+    def base(self) -> str:
+        return f'http://127.0.0.1:{self.args.port}/v1.0'
+
+    def page(self, path: str, items: list, query: dict, offset: int, last_link: dict = None) -> dict:
+        size = min(int(query.get('$top', self.args.page_size)), 999)
+        result = {'value': items[offset:offset + size]}
+        if offset + size < len(items):
+            result['@odata.nextLink'] = f'{self.base()}{path}?{urlencode({**query, "$skiptoken": offset + size})}'
+        elif last_link:
+            result.update(last_link)
+        return result
+
+    def select(self, obj: dict, query: dict) -> dict:
+        if not query.get('$select'):
+            return obj
+        fields = set(query['$select'].split(',')) | {'id'}
+        return {key: value for key, value in obj.items() if key in fields}
+
+    def handle(self, method: str, path: str, query: dict, body) -> tuple:
+        """
+        :return: status, headers, body
+        """
+        path = re.sub(r'^/(v1\.0|beta)', '', path)
+        for name, route_method, pattern in ROUTES:
+            match = pattern.fullmatch(path)
+            if match and route_method == method:
+                self.count(f'requests.{name}')
+                if name != 'token' and name != 'batch' and random.random() < self.args.throttle_rate:
+                    self.count('throttled')
+                    return 429, {'Retry-After': str(self.args.retry_after)}, {
+                        'error': {'code': 'TooManyRequests', 'message': 'injected throttling'}}
+                return getattr(self, f'route_{name}')(path, query, body, *match.groups())
+        self.count('requests.not_found')
+        return 404, {}, {'error': {'code': 'Request_ResourceNotFound', 'message': f'{method} {path}'}}
+
+    def route_token(self, path, query, body):
+        self.count('tokens')
+        return 200, {}, {'token_type': 'Bearer', 'expires_in': 3600, 'ext_expires_in': 3600,
+                         'access_token': uuid.uuid4().hex}
+
+    def route_batch(self, path, query, body):
+        responses = []
+        for request in body['requests']:
+            url = urlparse(request['url'])
+            status, headers, response_body = self.handle(request['method'].upper(), url.path,
+                                                         _query(url.query), request.get('body'))
+            responses.append({'id': request['id'], 'status': status, 'headers': headers, 'body': response_body})
+        return 200, {}, {'responses': responses}
+
+    def route_delta(self, path, query, body, kind):
+        token = query.pop('$deltatoken', None)
+        offset = int(query.pop('$skiptoken', 0))
+        # Graph keeps query options in delta token, mock keeps them in the link
+        options = {key: value for key, value in query.items() if key != '$top'}
+        delta_query = urlencode({**options, '$deltatoken': uuid.uuid4().hex})
+        delta_link = {'@odata.deltaLink': f'{self.base()}{path}?{delta_query}'}
+        if token == 'latest':
+            return 200, {}, {'value': [], **delta_link}
+        if token:
+            changed = [self.with_members(self.select(self.directory.object(kind, i), query), kind, i, query, True)
+                       for i in range(min(self.args.delta_changes, len(self.directory.keys[kind])))]
+            return 200, {}, self.page(path, changed, query, offset, delta_link)
+        indexes = [index for _, index in self.directory.keys[kind]]
+        page = self.page(path, indexes, query, offset, delta_link)
+        page['value'] = [self.with_members(self.select(self.directory.object(kind, i), query), kind, i, query)
+                         for i in page['value']]
+        return 200, {}, page
+
+    def with_members(self, obj: dict, kind: str, i: int, query: dict, changed: bool = False) -> dict:
+        if kind == 'groups' and 'members' in query.get('$select', '').split(','):
+            obj['members@delta'] = self.directory.members(i, changed)
+        return obj
+
+    def route_collection(self, path, query, body, kind):
+        offset = int(query.pop('$skiptoken', 0))
+        return 200, {}, self._paged_objects(path, kind, self.directory.indexes(kind, query), query, offset)
+
+    def _paged_objects(self, path, kind, indexes, query, offset, last_link=None):
+        page = self.page(path, indexes, query, offset, last_link)
+        page['value'] = [self.select(self.directory.object(kind, i), query) for i in page['value']]
+        return page
+
+    def route_object(self, path, query, body, kind, object_id):
+        return 200, {}, {'id': object_id}
+
+    def route_group_plans(self, path, query, body, group_id):
+        plans = [{'id': f'plan{group_id[-6:]}x{k:03d}', 'title': f'Plan {k}', 'owner': group_id,
+                  '@odata.etag': 'W/"plan"'} for k in range(self.args.plans)]
+        return 200, {}, {'value': plans}
+
+    def route_plan_details(self, path, query, body, plan_id):
+        return 200, {'ETag': 'W/"details"'}, {'id': plan_id, 'sharedWith': {}, 'categoryDescriptions': {},
+                                              '@odata.etag': 'W/"details"'}
+
+    def route_plan_tasks(self, path, query, body, plan_id):
+        offset = int(query.pop('$skiptoken', 0))
+        tasks = [{'id': f'task{plan_id[4:]}x{t:04d}', 'planId': plan_id, 'title': f'Task {t}',
+                  'percentComplete': 0, '@odata.etag': 'W/"task"'} for t in range(self.args.tasks)]
+        return 200, {}, self.page(path, tasks, query, offset)
+
+    def route_task_details(self, path, query, body, task_id):
+        return 200, {'ETag': 'W/"details"'}, {'id': task_id, 'description': 'Benchmark task', 'checklist': {},
+                                              'references': {}, '@odata.etag': 'W/"details"'}
+
+    def route_create(self, path, query, body, kind):
+        return 201, {}, {**(body or {}), 'id': str(uuid.uuid4())}
+
+    def route_update(self, path, query, body, kind, object_id):
+        if isinstance(body, dict) and 'members@odata.bind' in body:
+            self.count('members.bound', len(body['members@odata.bind']))
+        return 204, {}, None
+
+    def route_delete(self, path, query, body, kind, object_id, rest):
+        if rest and rest.startswith('/members/'):
+            self.count('members.removed')
+        return 204, {}, None
+
+    def route_members(self, path, query, body, group_id):
+        self.count('members.bound')
+        return 204, {}, None
+
+
+def _query(query_string: str) -> dict:
+    return {key: values[0] for key, values in parse_qs(query_string).items()}
+
+
+def make_handler(graph: MockGraph):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            graph.count('connections')
+
+        def log_message(self, *args):
+            pass
+
+        def _respond(self, status: int, headers: dict, body) -> None:
+            data = json.dumps(body).encode('utf-8') if body is not None else b''
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if data:
+                self.send_header('Content-Type', 'application/json')
+                graph.count('bytes_decoded', len(data))
+                if graph.args.gzip_level and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    data = gzip.compress(data, graph.args.gzip_level)
+                    self.send_header('Content-Encoding', 'gzip')
+                graph.count('bytes', len(data))
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _dispatch(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+            url = urlparse(self.path)
+
+            if url.path == '/_stats':
+                with graph.lock:
+                    stats = dict(graph.stats)
+                return self._respond(200, {}, stats)
+            if url.path == '/_reset':
+                with graph.lock:
+                    graph.stats.clear()
+                return self._respond(204, {}, None)
+
+            if graph.args.latency:
+                time.sleep(graph.args.latency)
+
+            if self.headers.get('Content-Type', '').startswith('application/json') and raw:
+                body = json.loads(raw)
+            else:
+                body = raw.decode('utf-8') if raw else None
+            graph.count('requests')
+            self._respond(*graph.handle(self.command, unquote(url.path), _query(url.query), body))
+
+        do_GET = do_POST = do_PATCH = do_DELETE = _dispatch
+
+    return Handler
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Mock Microsoft Graph server')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--users', type=int, default=10000, help='number of users')
+    parser.add_argument('--groups', type=int, default=500, help='number of groups')
+    parser.add_argument('--plans', type=int, default=2, help='plans per group')
+    parser.add_argument('--tasks', type=int, default=10, help='tasks per plan')
+    parser.add_argument('--members', type=int, default=10, help='members per group')
+    parser.add_argument('--page-size', type=int, default=100, help='page size used if $top is not given')
+    parser.add_argument('--delta-changes', type=int, default=10, help='objects returned by incremental delta')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=0.1, help='Retry-After of throttled responses')
+    parser.add_argument('--gzip-level', type=int, default=6,
+                        help='level of gzip used when client accepts it, 0 disables compression')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(MockGraph(args)))
+    server.daemon_threads = True
+    print(f'mock Graph listening on http://127.0.0.1:{args.port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
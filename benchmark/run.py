@@ -0,0 +1,307 @@
+"""
+Benchmark scenarios for the service running against local mock Graph server
+
+Starts benchmark/mock_graph.py and service/service.py as subprocesses, runs chosen scenarios and reports
+throughput, p50/p99 latency, peak RSS and CPU time of the service process, response bytes on the wire and decoded
+and number of requests and bytes received from mock Graph.
+
+Scenarios:
+users - GET /datasets/user/entities (full delta sync of all users)
+tasks - GET /planner/tasks/entities (groups -> plans -> tasks with details)
+members - GET /datasets/membership/entities (full sync of group memberships)
+sink-users - POST /datasets/user with new users in batches
+sink-groups - POST /datasets/group with new groups in batches
+sink-members - POST /datasets/membership with memberships of all groups in batches
+
+Usage: python benchmark/run.py users tasks --users 100000 --groups 5000 --latency 0.05
+Read scenarios are repeated --repeat times (default 5) and requests of every scenario are sent by --concurrency
+client threads, p50/p99 are percentiles of latencies of these requests (number of samples is reported with them)
+Service settings may be changed with --env, e.g. --env PREFETCH_DEPTH=0 --env SEGMENTED_FULL_SYNC=true
+Compression is compared with --accept-encoding identity|gzip|zstd and --env GZIP_LEVEL=1
+"""
+import argparse
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+try:
+    import zstandard
+except ImportError:  # needed only for --accept-encoding zstd
+    zstandard = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.join(HERE, '..', 'service')
+
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+
+def _children(pid: int) -> list:
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as children:
+            return [int(child) for child in children.read().split()]
+    except OSError:
+        return []
+
+
+def peak_rss_mb(pid: int):
+    """
+    Sum of peak resident set sizes of process and its child processes (e.g. gunicorn workers) from /proc,
+    Linux only
+    :return: megabytes or None if not available
+    """
+    total = None
+    for process in [pid] + _children(pid):
+        try:
+            with open(f'/proc/{process}/status') as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        total = (total or 0) + int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return total
+
+
+def cpu_seconds(pid: int) -> float:
+    """
+    User and system CPU time of running process and its child processes from /proc, Linux only
+    :return: seconds or 0 if not available
+    """
+    total = 0
+    for process in [pid] + _children(pid):
+        try:
+            with open(f'/proc/{process}/stat') as stat:
+                # fields after process name, utime and stime are 14th and 15th field of the whole line
+                fields = stat.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def wait_for(url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'process for {url} exited with code {process.returncode}')
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f'{url} is not available after {timeout} seconds')
+
+
+def decode(body: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    return body
+
+
+def fetch(url: str, accept_encoding: str) -> tuple:
+    """
+    Read streamed JSON array
+    :return: number of entities, number of bytes on the wire, number of decoded bytes
+    """
+    response = requests.get(url, stream=True, headers={'Accept-Encoding': accept_encoding})
+    response.raise_for_status()
+    wire = b''.join(response.raw.stream(64 * 1024, decode_content=False))
+    body = decode(wire, response.headers.get('Content-Encoding'))
+    return len(json.loads(body)), len(wire), len(body)
+
+
+def post(url: str, entities: list) -> tuple:
+    response = requests.post(url, data=json.dumps(entities), headers={'Content-Type': 'application/json'})
+    response.raise_for_status()
+    return len(entities), len(response.content), len(response.content)
+
+
+def new_users(count: int, offset: int) -> list:
+    return [{'_id': f'bench-user-{i}', 'accountEnabled': True, 'displayName': f'Bench User {i}',
+             'mailNickname': f'benchuser{i}', 'userPrincipalName': f'bench.user{i}@bench.onmicrosoft.com',
+             'passwordProfile': {'forceChangePasswordNextSignIn': True, 'password': 'Bench-Pa55word'}}
+            for i in range(offset, offset + count)]
+
+
+def new_groups(count: int, offset: int) -> list:
+    return [{'_id': f'bench-group-{i}', 'displayName': f'Bench group {i}', 'mailEnabled': False,
+             'mailNickname': f'benchgroup{i}', 'securityEnabled': True}
+            for i in range(offset, offset + count)]
+
+
+def new_memberships(count: int, offset: int, args) -> list:
+    return [{'_id': f'group{i // args.members}_user{i}', 'groupId': f'group{i // args.members}',
+             'memberId': f'user{i % args.users}'} for i in range(offset, offset + count)]
+
+
+def scenario_calls(name: str, args, service_url: str) -> list:
+    """
+    :return: list of functions, every call is one timed request returning (entities, wire bytes, decoded bytes)
+    """
+    if name == 'users':
+        return [lambda: fetch(f'{service_url}/datasets/user/entities', args.accept_encoding)] * args.repeat
+    if name == 'tasks':
+        return [lambda: fetch(f'{service_url}/planner/tasks/entities', args.accept_encoding)] * args.repeat
+    if name == 'members':
+        return [lambda: fetch(f'{service_url}/datasets/membership/entities', args.accept_encoding)] * args.repeat
+    if name == 'sink-members':
+        total = args.groups * args.members
+        return [lambda offset=offset: post(f'{service_url}/datasets/membership',
+                                           new_memberships(min(args.batch, total - offset), offset, args))
+                for offset in range(0, total, args.batch)]
+    if name in ('sink-users', 'sink-groups'):
+        make, path, total = (new_users, 'user', args.users) if name == 'sink-users' else \
+            (new_groups, 'group', args.groups)
+        return [lambda offset=offset: post(f'{service_url}/datasets/{path}', make(min(args.batch, total - offset),
+                                                                                   offset))
+                for offset in range(0, total, args.batch)]
+    raise ValueError(f'unknown scenario {name}')
+
+
+def timed(call) -> tuple:
+    """
+    :return: latency of call in seconds and its result
+    """
+    started = time.perf_counter()
+    result = call()
+    return time.perf_counter() - started, result
+
+
+def run_calls(calls: list, concurrency: int) -> list:
+    """
+    Run calls with given number of client threads, so latency is measured under concurrent load
+    :return: list of (latency, result) in the order of calls
+    """
+    if concurrency <= 1:
+        return [timed(call) for call in calls]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(timed, calls))
+
+
+def run_scenario(name: str, args, service_url: str, mock_url: str, service: subprocess.Popen) -> dict:
+    requests.post(f'{mock_url}/_reset')
+    cpu_started = cpu_seconds(service.pid)
+    started = time.perf_counter()
+    results = run_calls(scenario_calls(name, args, service_url), args.concurrency)
+    elapsed = time.perf_counter() - started
+    latencies = [latency for latency, _ in results]
+    entities = sum(count for _, (count, _, _) in results)
+    wire = sum(wire_size for _, (_, wire_size, _) in results)
+    written = sum(size for _, (_, _, size) in results)
+    cpu = cpu_seconds(service.pid) - cpu_started
+    stats = requests.get(f'{mock_url}/_stats').json()
+    return {
+        'scenario': name,
+        'entities': entities,
+        'seconds': round(elapsed, 3),
+        'entities_per_second': round(entities / elapsed, 1) if elapsed else None,
+        'response_bytes': written,
+        'response_wire_bytes': wire,
+        'service_cpu_seconds': round(cpu, 3),
+        'cpu_ms_per_entity': round(cpu * 1000 / entities, 4) if entities else None,
+        'latency_samples': len(latencies),
+        'p50_seconds': round(percentile(latencies, 0.5), 4),
+        'p99_seconds': round(percentile(latencies, 0.99), 4),
+        'peak_rss_mb': peak_rss_mb(service.pid),
+        'graph_requests': stats.get('requests', 0),
+        'graph_connections': stats.get('connections', 0),
+        'graph_throttled': stats.get('throttled', 0),
+        'graph_bytes': stats.get('bytes', 0),
+        'graph_bytes_decoded': stats.get('bytes_decoded', 0),
+        'graph_requests_by_route': {key[len('requests.'):]: value for key, value in sorted(stats.items())
+                                    if key.startswith('requests.')}
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run service benchmarks against mock Graph server')
+    parser.add_argument('scenarios', nargs='*',
+                        default=['users', 'tasks', 'members', 'sink-users', 'sink-groups', 'sink-members'])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=500)
+    parser.add_argument('--plans', type=int, default=2, help='plans per group')
+    parser.add_argument('--tasks', type=int, default=10, help='tasks per plan')
+    parser.add_argument('--members', type=int, default=10, help='members per group')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every Graph request')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of Graph requests answered with 429')
+    parser.add_argument('--graph-gzip-level', type=int, default=6, help='gzip level of mock Graph, 0 disables it')
+    parser.add_argument('--accept-encoding', default='gzip', help='Accept-Encoding sent to service')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs of read scenarios')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of requests sent at the same time')
+    parser.add_argument('--batch', type=int, default=1000, help='entities per POST request of sink scenarios')
+    parser.add_argument('--mock-port', type=int, default=8900)
+    parser.add_argument('--service-port', type=int, default=8901)
+    parser.add_argument('--env', action='append', default=[], help='service environment variable KEY=VALUE')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    mock_url = f'http://127.0.0.1:{args.mock_port}'
+    service_url = f'http://127.0.0.1:{args.service_port}'
+
+    mock = subprocess.Popen([sys.executable, os.path.join(HERE, 'mock_graph.py'), '--port', str(args.mock_port),
+                             '--users', str(args.users), '--groups', str(args.groups), '--plans', str(args.plans),
+                             '--tasks', str(args.tasks), '--members', str(args.members),
+                             '--page-size', str(args.page_size),
+                             '--latency', str(args.latency), '--throttle-rate', str(args.throttle_rate),
+                             '--gzip-level', str(args.graph_gzip_level)],
+                            stdout=subprocess.DEVNULL)
+    state_dir = tempfile.mkdtemp(prefix='azure-ad-bench-')
+    env = {**os.environ, 'GRAPH_ROOT': mock_url, 'LOGIN_URL': mock_url, 'PORT': str(args.service_port),
+           'client_id': 'bench', 'client_secret': 'bench', 'tenant_id': 'bench', 'LOG_LEVEL': 'WARNING',
+           'STATE_DB_PATH': os.path.join(state_dir, 'state.sqlite')}
+    env.update(item.split('=', 1) for item in args.env)
+    service = None
+    results = []
+    try:
+        wait_for(f'{mock_url}/_stats', mock)
+        service = subprocess.Popen([sys.executable, 'service.py'], cwd=SERVICE_DIR, env=env)
+        wait_for(f'{service_url}/metrics', service)
+        for name in args.scenarios:
+            results.append(run_scenario(name, args, service_url, mock_url, service))
+    finally:
+        for process in (service, mock):
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    if not any(result['peak_rss_mb'] for result in results):
+        # /proc is not available, only peak of all terminated children is known
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        for result in results:
+            result['peak_rss_mb'] = round(peak, 1)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in results:
+        print(f'{result["scenario"]:<12} {result["entities"]:>8} entities in {result["seconds"]:>8.2f}s '
+              f'{result["entities_per_second"]:>10,.0f}/s  p50 {result["p50_seconds"]:.3f}s '
+              f'p99 {result["p99_seconds"]:.3f}s (n={result["latency_samples"]})  peak RSS {result["peak_rss_mb"] or 0:.0f} MB  '
+              f'CPU {result["cpu_ms_per_entity"] or 0:.3f} ms/entity  '
+              f'response {result["response_wire_bytes"]:,} B on wire ({result["response_bytes"]:,} B decoded)  '
+              f'graph requests {result["graph_requests"]} (connections {result["graph_connections"]}, '
+              f'throttled {result["graph_throttled"]}, {result["graph_bytes"]:,} B on wire, '
+              f'{result["graph_bytes_decoded"]:,} B decoded)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark for JSON serialization of streamed entities
+
+Compares legacy per item encoding (one json.dumps string plus separator per item) with chunked encoder
+from json_stream_helper with and without orjson. Every yielded chunk is written to /dev/null with
+separate os.write call, so writes per entity show how many syscalls WSGI server would make.
+
+Usage: python benchmark/stream_json.py [number of entities] [chunk size in bytes]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'service'))
+
+import json_stream_helper  # noqa: E402
+
+DELTA_TOKEN = 'x' * 400
+
+
+def make_users(count: int):
+    for i in range(count):
+        yield {
+            '@odata.type': '#microsoft.graph.user',
+            'id': f'00000000-0000-0000-0000-{i:012d}',
+            'displayName': f'User Number {i}',
+            'givenName': 'User',
+            'surname': f'Number {i}',
+            'userPrincipalName': f'user{i}@example.onmicrosoft.com',
+            'mail': f'user{i}@example.com',
+            'jobTitle': 'Engineer',
+            'businessPhones': ['+47 00 00 00 00'],
+            'accountEnabled': True,
+            'officeLocation': 'Oslo',
+            '_updated': DELTA_TOKEN,
+            '_id': f'00000000-0000-0000-0000-{i:012d}'
+        }
+
+
+def legacy_stream(items):
+    first = True
+    yield '['
+    for item in items:
+        if not first:
+            yield ','
+        else:
+            first = False
+        yield json.dumps(item)
+    yield ']'
+
+
+def run(name: str, stream, count: int) -> None:
+    fd = os.open(os.devnull, os.O_WRONLY)
+    writes = 0
+    written = 0
+    start = time.perf_counter()
+    try:
+        for chunk in stream:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            os.write(fd, chunk)
+            writes += 1
+            written += len(chunk)
+    finally:
+        os.close(fd)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<22} {count / elapsed:>12,.0f} entities/s {writes / count:>10.4f} writes/entity '
+          f'{written / count:>8.0f} bytes/entity')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else json_stream_helper.WRITE_CHUNK_SIZE
+
+    run('legacy', legacy_stream(make_users(count)), count)
+
+    orjson = json_stream_helper.orjson
+    json_stream_helper.orjson = None
+    run('chunked (stdlib json)', json_stream_helper.iter_json_chunks(make_users(count), chunk_size), count)
+    json_stream_helper.orjson = orjson
+
+    if orjson is not None:
+        run('chunked (orjson)', json_stream_helper.iter_json_chunks(make_users(count), chunk_size), count)
+    else:
+        print('orjson is not installed, skipped')
+
+
+if __name__ == '__main__':
+    main()
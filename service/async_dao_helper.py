@@ -0,0 +1,338 @@
+import asyncio
+import atexit
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+import checkpoint_store
+import dao_helper
+import rate_limiter
+from auth_helper import Credential
+from dao_helper import GRAPH_URL, METADATA, ALLOWED_METHODS, BATCH_SIZE, _get_resource, _get_template
+from metrics_helper import GRAPH_LATENCY, GRAPH_RESPONSE_BYTES, PAGES, resource_template
+from query_helper import build_url
+from session_helper import TIMEOUT, ACCEPT_ENCODING
+from str_utils import str_to_bool
+from trace_helper import span
+
+try:
+    import aiohttp
+except ImportError:  # async client is optional
+    aiohttp = None
+
+"""
+Async client settings
+ASYNC_GRAPH_CLIENT - use asyncio based client for Planner and generic dataset endpoints
+ASYNC_MAX_CONNECTIONS - max number of simultaneously open connections
+ASYNC_CONCURRENCY - max number of in-flight requests started by one fan-out operation
+Coroutines run in a copy of the caller context, so credential and trace of the request are available to them
+"""
+ASYNC_GRAPH_CLIENT = str_to_bool(os.environ.get('ASYNC_GRAPH_CLIENT', 'false'))
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('ASYNC_MAX_CONNECTIONS', '1000'))
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', '256'))
+
+if ASYNC_GRAPH_CLIENT and aiohttp is None:
+    raise ImportError('ASYNC_GRAPH_CLIENT requires aiohttp package to be installed')
+
+__loop = None
+__loop_lock = threading.Lock()
+__session = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Get event loop running in background thread, loop is started on first call and shared by all requests
+    """
+    global __loop
+    if __loop is None:
+        with __loop_lock:
+            if __loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='graph-async-loop', daemon=True).start()
+                __loop = loop
+                atexit.register(close)
+    return __loop
+
+
+def close() -> None:
+    """
+    Close shared session and its connections
+    """
+    global __session
+    if __session is not None and __loop is not None:
+        session, __session = __session, None
+        asyncio.run_coroutine_threadsafe(session.close(), __loop).result()
+
+
+def _get_session():
+    """
+    Get shared aiohttp session, must be called from the loop thread
+    """
+    global __session
+    if __session is None:
+        connector = aiohttp.TCPConnector(limit=ASYNC_MAX_CONNECTIONS, keepalive_timeout=60)
+        __session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=TIMEOUT))
+    return __session
+
+
+def _http_error(url: str, status: int, text: str) -> requests.exceptions.HTTPError:
+    """
+    Build the same exception type as sync client raises, so callers may handle errors the same way
+    """
+    response = requests.Response()
+    response.status_code = status
+    response.url = url
+    response._content = text.encode('utf-8')
+    return requests.exceptions.HTTPError(f'{status} Error for url: {url}', response=response)
+
+
+async def run_blocking(func, *args):
+    """
+    Run blocking function in worker thread in a copy of current context, so loop is not stopped while waiting for it
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, contextvars.copy_context().run, func, *args)
+
+
+async def _get_token(credential: Credential) -> dict:
+    token = credential.valid_token()
+    if token is None:
+        token = await run_blocking(credential.get_token)
+    return token
+
+
+async def make_request(url: str, method: str, credential: Credential, data=None) -> dict:
+    """
+    Async version of dao_helper.make_request
+    :param url: where to send request
+    :param method: which method to use. An exception will be thrown if method is not allowed
+    :param credential: credential to use
+    :param data: request payload for POST/PUT/PATCH requests
+    :return: decoded JSON object
+    """
+    if method.lower() not in ALLOWED_METHODS:
+        raise Exception(f'Method {method} is not allowed')
+
+    token = await _get_token(credential)
+    headers = {
+        'Authorization': f'{token["token_type"]} {token["access_token"]}',
+        "Accept": f'application/json;odata.metadata={METADATA};odata.streaming=true',
+        'Accept-Encoding': ACCEPT_ENCODING
+    }
+
+    limiter = rate_limiter.get_limiter(credential.tenant_id, _get_resource(url))
+    template = _get_template(url)
+    attempt = 0
+    while True:
+        wait = limiter.try_acquire()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = limiter.try_acquire()
+
+        rate_limiter.count('requests')
+        started = time.perf_counter()
+        with span('graph request', method=method.upper(), resource=template, attempt=attempt + 1) as request_span:
+            async with _get_session().request(method.upper(), url, headers=headers, json=data) as response:
+                status = response.status
+                text = await response.text()
+                retry_after = response.headers.get('Retry-After')
+                encoding = response.headers.get('Content-Encoding', 'identity')
+                wire_bytes = response.content_length or len(text)
+            request_span['status'] = status
+            request_span['bytes'] = len(text)
+            request_span['wire_bytes'] = wire_bytes
+            request_span['encoding'] = encoding
+        GRAPH_LATENCY.observe(time.perf_counter() - started, template, method.upper(), status)
+        GRAPH_RESPONSE_BYTES.inc(template, encoding, value=wire_bytes)
+
+        if status not in rate_limiter.THROTTLE_STATUSES:
+            limiter.on_success()
+            break
+
+        attempt += 1
+        rate_limiter.count('throttled')
+        limiter.on_throttle(rate_limiter.backoff_delay(retry_after, attempt) if retry_after else None)
+        if attempt > rate_limiter.MAX_RETRIES:
+            rate_limiter.count('dropped')
+            break
+
+        rate_limiter.count('retried')
+        await asyncio.sleep(rate_limiter.backoff_delay(retry_after, attempt))
+
+    if status >= 400:
+        logging.error(f'{status} error for {method} {url}')
+        logging.error(text)
+        raise _http_error(url, status, text)
+
+    return json.loads(text) if len(text) > 0 else {}
+
+
+async def get_all_objects(resource_path: str, credential: Credential, delta=None, query=None):
+    """
+    Async version of dao_helper.get_all_objects (without limit and cursors)
+    :param resource_path path to needed resource in MS Graph API
+    :param credential: credential to use
+    :param delta: delta token from last request
+    :param query: OData query options sent with the first request if there is no delta token
+    :return: async generator with all fetched objects
+    """
+    since = delta
+    url = GRAPH_URL + resource_path
+    # runs with different query options must not use delta links of each other
+    checkpoint_path = build_url(resource_path, query)
+    use_checkpoints = 'delta' in resource_path.strip('/').split('/')
+
+    if delta:
+        url = build_url(url, {'$deltatoken': delta})
+        checkpoint = checkpoint_store.load(credential.tenant_id, checkpoint_path) if use_checkpoints else None
+        if checkpoint and checkpoint['delta_token'] == delta and checkpoint['delta_link']:
+            # stored link keeps all query options of the original request
+            url = checkpoint['delta_link']
+    else:
+        url = build_url(url, query)
+
+    page_template = resource_template(resource_path)
+    # last object is held back until it's known which token it must get
+    held = None
+    while url is not None:
+        with span('page', resource=page_template) as page_span:
+            result = await make_request(url, 'get', credential)
+            page_span['entities'] = len(result.get('value') or [])
+        PAGES.inc(page_template)
+
+        if type(result.get('value')) != list:
+            raise ValueError(f'value object expected in response to url: {url} got {result}')
+
+        if result.get('@odata.deltaLink'):
+            delta = parse_qs(urlparse(result.get('@odata.deltaLink')).query)['$deltatoken'][0]
+            if use_checkpoints:
+                checkpoint_store.save_delta(credential.tenant_id, checkpoint_path, delta, result['@odata.deltaLink'])
+
+        for item in result['value']:
+            item['_updated'] = since
+            item['_id'] = item['id']
+            if held is not None:
+                yield held
+            held = item
+
+        url = result.get('@odata.nextLink', None)
+
+    if held is not None:
+        held['_updated'] = delta
+        yield held
+
+
+async def get_object(resource_path: str, credential: Credential) -> dict:
+    """
+    Async version of dao_helper.get_object
+    """
+    return await make_request(GRAPH_URL + resource_path, 'get', credential)
+
+
+async def get_objects(resource_paths: list) -> list:
+    """
+    Fetch list of objects through JSON batching and response cache of dao_helper.get_objects,
+    blocking batch requests are sent from worker thread with credential and trace of current context
+    :param resource_paths: list of paths to needed objects, at most BATCH_SIZE paths are sent in one envelope
+    :return: list of fetched objects in the same order as resource_paths
+    """
+    return await run_blocking(dao_helper.get_objects, resource_paths)
+
+
+async def chunked(items, size: int = BATCH_SIZE):
+    """
+    Split async iterable into lists of at most size items
+    """
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def ordered_map(func, items, window: int = ASYNC_CONCURRENCY):
+    """
+    Run coroutine function for every item with at most window coroutines in flight
+    and yield results in input order
+    :param func: coroutine function called with one item
+    :param items: async iterable with input items
+    :param window: max number of in-flight coroutines
+    :return: async generator with results
+    """
+    in_flight = deque()
+    try:
+        async for item in items:
+            in_flight.append(asyncio.ensure_future(func(item)))
+            if len(in_flight) >= window:
+                yield await in_flight.popleft()
+
+        while in_flight:
+            yield await in_flight.popleft()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+async def flatten(lists):
+    """
+    Flatten async iterable with lists into async iterable with their items
+    """
+    async for items in lists:
+        for item in items:
+            yield item
+
+
+def from_sync(iterable):
+    """
+    Consume blocking iterable in worker thread and expose it as async iterable
+    Items are read in a copy of the caller context (e.g. with credential set by init_dao)
+    :param iterable: blocking iterable
+    :return: async generator with the same items
+    """
+    context = contextvars.copy_context()
+    iterator = iter(iterable)
+    done = object()
+
+    async def __generator():
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await loop.run_in_executor(None, context.run, next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    return __generator()
+
+
+def run_sync(coroutine):
+    """
+    Run coroutine in background loop and wait for result
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop()).result()
+
+
+def iterate_sync(async_iterable):
+    """
+    Sync adapter for async generators, so they may be used in Flask responses and other blocking code
+    :param async_iterable: async generator
+    :return: generator with the same items
+    """
+    iterator = async_iterable.__aiter__()
+    try:
+        while True:
+            try:
+                yield run_sync(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        if hasattr(iterator, 'aclose'):
+            run_sync(iterator.aclose())
@@ -1,13 +1,26 @@
-import requests
 import json
 import datetime
+import logging
+import os
+import threading
+import time
 import urllib.parse
 
+import token_store
+from metrics_helper import TOKEN_LATENCY
+from session_helper import get_session, TIMEOUT
+from trace_helper import span
+
+"""
+Microsoft identity platform root URL, may be pointed to a mock server (see benchmark/mock_graph.py)
+"""
+LOGIN_URL = os.environ.get('LOGIN_URL', 'https://login.microsoftonline.com').rstrip('/')
+
 """
 Base URL where to send token request
 Placeholder contains Azure tenant id
 """
-TOKEN_URL = "https://login.microsoftonline.com/{}/oauth2/v2.0/token"
+TOKEN_URL = LOGIN_URL + "/{}/oauth2/v2.0/token"
 
 """
 We use client_credentials flow with client_id and secret_id
@@ -18,21 +31,173 @@ in Azure Active Directory ( https://aad.portal.azure.com -> Dashboard -> App Reg
 TOKEN_REQUEST_PAYLOAD = data = {'grant_type': 'client_credentials',
                                 'scope': 'https://graph.microsoft.com/.default'}
 
+"""
+Tokens are refreshed when less than TOKEN_REFRESH_MARGIN seconds left before expiration.
+Background thread checks all tokens used during last TOKEN_IDLE_TIMEOUT seconds every TOKEN_REFRESH_INTERVAL seconds
+and refreshes them in advance, so requests don't have to wait for token endpoint
+"""
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', '300'))
+TOKEN_REFRESH_INTERVAL = int(os.environ.get('TOKEN_REFRESH_INTERVAL', '60'))
+TOKEN_IDLE_TIMEOUT = int(os.environ.get('TOKEN_IDLE_TIMEOUT', '3600'))
+
+
+class Credential:
+    """
+    Handle to cached token for one (tenant, client, grant, user) combination.
+    Token is fetched on first use and refreshed when it's about to expire.
+    Concurrent refreshes of the same credential are coalesced into one token request
+    """
+
+    def __init__(self, tenant_id: str, fetch_func, key: tuple = None):
+        self.tenant_id = tenant_id
+        self.fetch_func = fetch_func
+        self.key = key
+        self.token = None
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+
+    def _is_valid(self, margin: float, token: dict = None) -> bool:
+        token = token or self.token
+        return token is not None and token['timestamp'] + float(token['expires_in']) - margin > time.time()
+
+    def get_token(self) -> dict:
+        """
+        :return: valid Oauth2 token object
+        """
+        self.last_used = time.time()
+        if not self._is_valid(TOKEN_REFRESH_MARGIN):
+            self.refresh(TOKEN_REFRESH_MARGIN)
+        return self.token
+
+    def valid_token(self):
+        """
+        :return: cached token if it's not about to expire or None, never sends token request
+        """
+        if self._is_valid(TOKEN_REFRESH_MARGIN):
+            self.last_used = time.time()
+            return self.token
+        return None
+
+    def refresh(self, margin: float = None) -> None:
+        """
+        Fetch new token. If margin given then token is only fetched if it expires within margin seconds,
+        so threads waiting for lock while other thread was refreshing don't request another token
+        """
+        with self.lock:
+            if margin is not None and self._is_valid(margin):
+                return
+            # token may be already refreshed by another worker process
+            shared = token_store.load(self.key) if margin is not None and self.key else None
+            if shared is not None and self.token and 'refresh_token' in self.token:
+                # refresh tokens are not shared, own one is kept with token fetched by another process
+                shared['refresh_token'] = self.token['refresh_token']
+            if shared is not None and self._is_valid(margin, shared):
+                self.token = shared
+                return
+            started = time.perf_counter()
+            with span('token', tenant=self.tenant_id):
+                self.token = self.fetch_func(shared or self.token)
+            TOKEN_LATENCY.observe(time.perf_counter() - started)
+            if self.key:
+                token_store.save(self.key, self.token)
+
+    def set_token(self, token_obj: dict) -> None:
+        with self.lock:
+            self.token = token_obj
+            if self.key:
+                token_store.save(self.key, token_obj)
+
+
 """
 Token cache
 """
 __token_cache = {}
+__token_cache_lock = threading.Lock()
+__refresher = None
 
 
-def add_token_to_cache(client_id: str, tenant_id: str, token_obj: dict) -> None:
+def _get_credential(key: tuple, tenant_id: str, fetch_func) -> Credential:
+    credential = __token_cache.get(key)
+    if credential is None:
+        with __token_cache_lock:
+            credential = __token_cache.setdefault(key, Credential(tenant_id, fetch_func, key))
+            _start_refresher()
+    # secrets may be changed between requests
+    credential.fetch_func = fetch_func
+    return credential
+
+
+def _start_refresher() -> None:
+    """
+    Start background token refresher thread if not started yet
+    """
+    global __refresher
+    if __refresher is not None and __refresher.is_alive():
+        return
+
+    def __refresh_loop():
+        while True:
+            time.sleep(TOKEN_REFRESH_INTERVAL)
+            now = time.time()
+            for credential in list(__token_cache.values()):
+                if credential.token is None or now - credential.last_used > TOKEN_IDLE_TIMEOUT:
+                    continue
+                try:
+                    credential.refresh(TOKEN_REFRESH_MARGIN + TOKEN_REFRESH_INTERVAL)
+                except Exception:
+                    logging.exception(f'background token refresh failed for tenant {credential.tenant_id}')
+
+    __refresher = threading.Thread(target=__refresh_loop, name='token-refresher', daemon=True)
+    __refresher.start()
+
+
+def get_credential(client_id, client_secret, tenant_id) -> Credential:
+    """
+    Function to get cached credential for client_credentials grant type
+    (or authorization code grant if token was acquired in /auth endpoint)
+    :param client_id: id you get after register new app in Azure AD
+    :param client_secret: secret you get after register new app in Azure AD
+    :param tenant_id: tenant id may be found in Azure Admin Center -> Overview -> Properties
+    :return: credential object
+    """
+
+    def __fetch(token):
+        if token and 'refresh_token' in token:
+            return _refresh_token(client_id, client_secret, tenant_id, token['refresh_token'])
+        return _get_token(client_id, client_secret, tenant_id)
+
+    return _get_credential((tenant_id, client_id, 'app', None), tenant_id, __fetch)
+
+
+def get_user_credential(tenant_id, client_id, client_secret, username, password) -> Credential:
+    """
+    Function to get cached credential for resource owner password grant type
+    :param client_id: id you get after register new app in Azure AD
+    :param client_secret: secret you get after register new app in Azure AD
+    :param tenant_id: tenant id may be found in Azure Admin Center -> Overview -> Properties
+    :param username: username for an registered user
+    :param password: users password
+    :return: credential object
+    """
+
+    def __fetch(token):
+        if token and 'refresh_token' in token:
+            return _refresh_token(client_id, client_secret, tenant_id, token['refresh_token'])
+        return _get_token_for_user(tenant_id, client_id, client_secret, username, password)
+
+    return _get_credential((tenant_id, client_id, 'password', username), tenant_id, __fetch)
+
+
+def add_token_to_cache(client_id: str, tenant_id: str, token_obj: dict, client_secret: str = None) -> None:
     """
     Function to add an access token for given client and tenant into token cache
     :param client_id:i d you get after register new app in Azure AD
     :param tenant_id: enant id may be found in Azure Admin Center -> Overview -> Properties
     :param token_obj: Oauth2 token object
+    :param client_secret: secret you get after register new app in Azure AD, needed to refresh token
     :return: None
     """
-    __token_cache[client_id + tenant_id] = token_obj
+    get_credential(client_id, client_secret, tenant_id).set_token(token_obj)
 
 
 def _get_token(client_id, client_secret, tenant_id):
@@ -45,8 +210,8 @@ def _get_token(client_id, client_secret, tenant_id):
     :return: oauth token object with timestamp added
     """
     token_url = TOKEN_URL.format(tenant_id)
-    response = requests.post(token_url, data=data, verify=True, allow_redirects=False,
-                             auth=(client_id, client_secret))
+    response = get_session().post(token_url, data=data, verify=True, allow_redirects=False,
+                                  auth=(client_id, client_secret), timeout=TIMEOUT)
     response.raise_for_status()
     token_obj = json.loads(response.text)
     if not token_obj.get('access_token'):
@@ -74,7 +239,7 @@ def _refresh_token(client_id, client_secret, tenant_id, r_token):
         'grant_type': 'refresh_token',
         'refresh_token': r_token
     }
-    response = requests.post(token_url, data=_data, verify=True, allow_redirects=False)
+    response = get_session().post(token_url, data=_data, verify=True, allow_redirects=False, timeout=TIMEOUT)
     response.raise_for_status()
     token_obj = json.loads(response.text)
     if not token_obj.get('access_token'):
@@ -95,20 +260,24 @@ def get_token(client_id, client_secret, tenant_id):
     :param tenant_id: tenant id may be found in Azure Admin Center -> Overview -> Properties
     :return: oauth token object with timestamp added
     """
-    token = __token_cache.get(client_id + tenant_id)
-    ts = datetime.datetime.now().timestamp()
+    return get_credential(client_id, client_secret, tenant_id).get_token()
 
-    if not token or token['timestamp'] + token['expires_in'] + 5 < ts:
-        if token and 'refresh_token' in token:
-            r_token = token['refresh_token']
-            __token_cache[client_id + tenant_id] = _refresh_token(client_id, client_secret, tenant_id, r_token)
-        else:
-            __token_cache[client_id + tenant_id] = _get_token(client_id, client_secret, tenant_id)
 
-    return __token_cache.get(client_id + tenant_id)
+def get_token_on_behalf_on_user(tenant_id, client_id, client_secret, username, password):
+    """
+    Function to obtain an access_token on behalf on user without signing user in personally (browserless)
+    This function search valid token in cache first and request it only when not found or if expired
+    :param client_id: id you get after register new app in Azure AD
+    :param client_secret: secret you get after register new app in Azure AD
+    :param tenant_id: tenant id may be found in Azure Admin Center -> Overview -> Properties
+    :param username: username for an registered user
+    :param password: users password
+    :return: Oauth token object with timestamp of issue
+    """
+    return get_user_credential(tenant_id, client_id, client_secret, username, password).get_token()
 
 
-def get_token_on_behalf_on_user(tenant_id, client_id, client_secret, username, password):
+def _get_token_for_user(tenant_id, client_id, client_secret, username, password):
     """
     Function to obtain an access_token on behalf on user without signing user in personally (browserless)
     It uses "resource owner password" auth schema
@@ -131,7 +300,7 @@ def get_token_on_behalf_on_user(tenant_id, client_id, client_secret, username, p
         'username': username,
         'password': password
     }
-    response = requests.post(token_url, data=_data, verify=True, allow_redirects=False)
+    response = get_session().post(token_url, data=_data, verify=True, allow_redirects=False, timeout=TIMEOUT)
     response.raise_for_status()
     token_obj = json.loads(response.text)
     if not token_obj.get('access_token'):
@@ -161,7 +330,7 @@ def get_token_with_auth_code(tenant_id, client_id, client_secret, code, redirect
         'redirect_uri': redirect_url,
         'grant_type': 'authorization_code'
     }
-    response = requests.post(token_url, data=_data, verify=True, allow_redirects=False)
+    response = get_session().post(token_url, data=_data, verify=True, allow_redirects=False, timeout=TIMEOUT)
 
     response.raise_for_status()
     token_obj = json.loads(response.text)
@@ -183,7 +352,7 @@ def get_authorize_url(tenant, client, state, r_url):
     :return: built URL
     """
     scope = urllib.parse.quote('https://graph.microsoft.com/.default')
-    base_url = 'https://login.microsoftonline.com'
+    base_url = LOGIN_URL
     path = 'oauth2/v2.0/authorize'
     r_url = f'redirect_uri={urllib.parse.quote(r_url)}'
     r_type = 'response_type=code'
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import local_store
+from str_utils import str_to_bool
+
+"""
+Response cache settings
+CACHE_TTLS - JSON object with regular expressions matched against request URL and TTL in seconds for them,
+only matching URLs are cached. Delta queries are never cached
+CACHE_MAX_ENTRIES - max number of responses kept in memory
+CACHE_MAX_BYTES - max total size of responses kept in memory
+CACHE_DISK_ENABLED - keep cached responses in local state database too, so they survive restarts
+Responses are cached per credential (tenant, client, grant type, user), so objects fetched with permissions
+of one user or application are never served to another one
+"""
+DEFAULT_TTLS = {
+    r'/planner/plans/[^/?]+/details$': 3600,
+    r'/planner/tasks/[^/?]+/details$': 3600,
+    r'/groups/[^/?]+/planner/plans$': 900
+}
+CACHE_TTLS = {re.compile(pattern): float(ttl) for pattern, ttl in
+              json.loads(os.environ.get('CACHE_TTLS', json.dumps(DEFAULT_TTLS))).items()}
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '50000'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+CACHE_DISK_ENABLED = str_to_bool(os.environ.get('CACHE_DISK_ENABLED', 'false'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS response_cache (
+    url TEXT PRIMARY KEY,
+    body TEXT NOT NULL,
+    etag TEXT,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class CacheEntry:
+    __slots__ = ('body', 'etag', 'expires_at')
+
+    def __init__(self, body: str, etag, expires_at: float):
+        self.body = body
+        self.etag = etag
+        self.expires_at = expires_at
+
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    def value(self) -> dict:
+        """
+        :return: new decoded object on every call so callers may modify it
+        """
+        return json.loads(self.body)
+
+
+class LruCache:
+    """
+    Thread safe in-memory LRU cache bounded by number of entries and total size of stored bodies
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self.entries[key] = entry
+            self.size += len(entry.body)
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                count('evictions')
+
+
+__memory = LruCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+
+__stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'evictions': 0}
+__stats_lock = threading.Lock()
+
+
+def count(counter: str) -> None:
+    with __stats_lock:
+        __stats[counter] += 1
+
+
+def get_stats() -> dict:
+    """
+    :return: copy of hits/misses/revalidated/evictions counters
+    """
+    with __stats_lock:
+        return dict(__stats)
+
+
+def ttl_for(url: str):
+    """
+    Find TTL for given URL
+    :param url: request URL
+    :return: TTL in seconds or None if responses for this URL must not be cached
+    """
+    if '$deltatoken' in url or '/delta' in url:
+        return None
+    for pattern, ttl in CACHE_TTLS.items():
+        if pattern.search(url):
+            return ttl
+    return None
+
+
+def _key(url: str, scope: tuple) -> str:
+    """
+    Cache key of URL fetched with given credential, credential key contains client id and username
+    so it's not stored as is
+    """
+    return hashlib.sha256(json.dumps(scope).encode('utf-8')).hexdigest()[:32] + ' ' + url
+
+
+def get(url: str, scope: tuple):
+    """
+    Find cached response for given URL, caller should check if it's still fresh and revalidate it otherwise
+    :param url: request URL
+    :param scope: key of credential used to fetch the response
+    :return: CacheEntry or None
+    """
+    key = _key(url, scope)
+    entry = __memory.get(key)
+    if entry is None and CACHE_DISK_ENABLED:
+        local_store.ensure_schema('response_cache', SCHEMA)
+        rows = local_store.execute('SELECT body, etag, expires_at FROM response_cache WHERE url = ?', (key,))
+        if rows:
+            entry = CacheEntry(*rows[0])
+            __memory.put(key, entry)
+
+    if entry is not None and not entry.is_fresh() and not entry.etag:
+        return None
+    return entry
+
+
+def put(url: str, scope: tuple, value: dict, etag, ttl: float) -> None:
+    """
+    Store response for given URL
+    :param url: request URL
+    :param scope: key of credential used to fetch the response
+    :param value: decoded response body
+    :param etag: ETag of response if present
+    :param ttl: time to live in seconds
+    """
+    _store(_key(url, scope), CacheEntry(json.dumps(value), etag, time.time() + ttl))
+
+
+def _store(key: str, entry: CacheEntry) -> None:
+    __memory.put(key, entry)
+    if CACHE_DISK_ENABLED:
+        local_store.ensure_schema('response_cache', SCHEMA)
+        local_store.execute('INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)',
+                            (key, entry.body, entry.etag, entry.expires_at))
+
+
+def refresh(url: str, scope: tuple, entry: CacheEntry, ttl: float) -> None:
+    """
+    Extend life of cached response after it was revalidated by server (304 Not Modified)
+    """
+    count('revalidated')
+    _store(_key(url, scope), CacheEntry(entry.body, entry.etag, time.time() + ttl))
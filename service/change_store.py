@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+
+import local_store
+from str_utils import str_to_bool
+
+"""
+Set to false to disable change detection and always send full payload to MS Graph
+"""
+CHANGE_DETECTION_ENABLED = str_to_bool(os.environ.get('CHANGE_DETECTION_ENABLED', 'true'))
+
+"""
+Set to true to send full payload for every entity (stored state is still updated)
+Same may be done for single request with query parameter force_resync=true
+"""
+FORCE_RESYNC = str_to_bool(os.environ.get('FORCE_RESYNC', 'false'))
+
+# write-only secrets are never stored or compared, they can't be read back from MS Graph anyway
+SECRET_ATTRIBUTES = ('passwordProfile',)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS content_hash (
+    kind TEXT NOT NULL,
+    object_id TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (kind, object_id)
+);
+-- payloads stored by earlier versions may contain secrets, such objects are written in full once again
+DELETE FROM content_hash WHERE payload LIKE '%"passwordProfile"%';
+"""
+
+
+def _without_secrets(payload: dict) -> dict:
+    return {k: v for k, v in payload.items() if k not in SECRET_ATTRIBUTES}
+
+
+def _normalize(payload: dict) -> str:
+    return json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def _hash(normalized: str) -> str:
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def diff(kind: str, object_id: str, payload: dict, force: bool = False):
+    """
+    Compare payload with last payload written for the same object
+    :param kind: users or groups
+    :param object_id: object id or other unique key used in request URL
+    :param payload: payload to write, must be already cleared from Sesam attributes, secrets are not compared
+    :param force: if true then full payload is returned regardless of stored state
+    :return: None if nothing changed, dict with changed fields only if object was written before,
+    full payload otherwise
+    """
+    if not CHANGE_DETECTION_ENABLED or force or FORCE_RESYNC or not object_id:
+        return payload
+
+    local_store.ensure_schema('content_hash', SCHEMA)
+    rows = local_store.execute('SELECT hash, payload FROM content_hash WHERE kind = ? AND object_id = ?',
+                               (kind, str(object_id).lower()))
+    if not rows:
+        return payload
+
+    payload = _without_secrets(payload)
+    stored_hash, stored_payload = rows[0]
+    if stored_hash == _hash(_normalize(payload)):
+        return None
+
+    previous = json.loads(stored_payload)
+    changed = {k: v for k, v in payload.items() if k not in previous or previous[k] != v}
+    return changed or None
+
+
+def remember(kind: str, object_id: str, payload: dict) -> None:
+    """
+    Store payload written to object, fields written earlier and not present in payload are kept,
+    secret attributes (e.g. passwordProfile) are dropped before the payload is stored and hashed
+    :param kind: users or groups
+    :param object_id: object id or other unique key used in request URL
+    :param payload: full or partial payload successfully written to MS Graph
+    """
+    if not CHANGE_DETECTION_ENABLED or not object_id:
+        return
+
+    local_store.ensure_schema('content_hash', SCHEMA)
+    key = str(object_id).lower()
+    rows = local_store.execute('SELECT payload FROM content_hash WHERE kind = ? AND object_id = ?', (kind, key))
+    merged = _without_secrets({**json.loads(rows[0][0]), **payload} if rows else payload)
+    normalized = _normalize(merged)
+    local_store.execute('INSERT OR REPLACE INTO content_hash VALUES (?, ?, ?, ?)',
+                        (kind, key, _hash(normalized), normalized))
+
+
+def forget(kind: str, object_id: str) -> None:
+    """
+    Remove stored payload so next write of the object is sent in full
+    """
+    if not CHANGE_DETECTION_ENABLED or not object_id:
+        return
+
+    local_store.ensure_schema('content_hash', SCHEMA)
+    local_store.execute('DELETE FROM content_hash WHERE kind = ? AND object_id = ?', (kind, str(object_id).lower()))
@@ -0,0 +1,55 @@
+import os
+import time
+
+import local_store
+from str_utils import str_to_bool
+
+"""
+Set to false to disable checkpoints, delta tokens are then sent without query options of the run which issued them
+(Graph keeps them in the token anyway)
+"""
+CHECKPOINTS_ENABLED = str_to_bool(os.environ.get('CHECKPOINTS_ENABLED', 'true'))
+
+# checkpoints table of older versions kept page links of interrupted runs, these runs are resumed with cursors now
+SCHEMA = """
+DROP TABLE IF EXISTS checkpoints;
+CREATE TABLE IF NOT EXISTS delta_checkpoints (
+    tenant_id TEXT NOT NULL,
+    resource_path TEXT NOT NULL,
+    delta_token TEXT NOT NULL,
+    delta_link TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (tenant_id, resource_path)
+);
+"""
+
+
+def load(tenant_id: str, resource_path: str):
+    """
+    Load checkpoint for given resource
+    :param tenant_id: Azure tenant id
+    :param resource_path: path to resource in MS Graph API
+    :return: dict with delta_token and delta_link or None if there is no checkpoint
+    """
+    if not CHECKPOINTS_ENABLED:
+        return None
+
+    local_store.ensure_schema('checkpoints', SCHEMA)
+    rows = local_store.execute('SELECT delta_token, delta_link FROM delta_checkpoints '
+                               'WHERE tenant_id = ? AND resource_path = ?', (tenant_id or '', resource_path))
+    if not rows:
+        return None
+
+    return dict(zip(('delta_token', 'delta_link'), rows[0]))
+
+
+def save_delta(tenant_id: str, resource_path: str, delta_token: str, delta_link: str) -> None:
+    """
+    Save delta link received at the end of a run, so the run started with its token keeps all query options
+    """
+    if not CHECKPOINTS_ENABLED:
+        return
+
+    local_store.ensure_schema('checkpoints', SCHEMA)
+    local_store.execute('INSERT OR REPLACE INTO delta_checkpoints VALUES (?, ?, ?, ?, ?)',
+                        (tenant_id or '', resource_path, delta_token, delta_link, time.time()))
@@ -0,0 +1,108 @@
+import os
+import time
+import zlib
+from functools import wraps
+
+from flask import request, Response
+
+import trace_helper
+from metrics_helper import RESPONSE_UNCOMPRESSED_BYTES
+from str_utils import str_to_bool
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, only gzip is offered without it
+    zstandard = None
+
+"""
+Response compression settings
+RESPONSE_COMPRESSION - compress streamed entity responses if client sends Accept-Encoding with gzip or zstd
+RESPONSE_ENCODINGS - comma separated encodings offered in order of preference, zstd is skipped if zstandard
+package is not installed
+GZIP_LEVEL - gzip compression level 1 (fastest) - 9 (smallest)
+ZSTD_LEVEL - zstd compression level 1 (fastest) - 22 (smallest)
+"""
+RESPONSE_COMPRESSION = str_to_bool(os.environ.get('RESPONSE_COMPRESSION', 'true'))
+RESPONSE_ENCODINGS = [e.strip() for e in os.environ.get('RESPONSE_ENCODINGS', 'zstd,gzip').lower().split(',')
+                      if e.strip() == 'gzip' or (e.strip() == 'zstd' and zstandard is not None)]
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '5'))
+ZSTD_LEVEL = int(os.environ.get('ZSTD_LEVEL', '3'))
+
+
+def choose_encoding(accept_encodings) -> str:
+    """
+    Pick the first offered encoding accepted by client
+    :param accept_encodings: parsed Accept-Encoding header (werkzeug Accept object)
+    :return: encoding name or None if response should be sent as is
+    """
+    for encoding in RESPONSE_ENCODINGS:
+        if accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+def _compressor(encoding: str):
+    """
+    :return: functions compressing one chunk (flushed so client may decode it at once) and finishing the stream
+    """
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return (lambda chunk: compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                compressor.flush)
+
+    # wbits 31 = deflate with gzip header and trailer
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def iter_compressed(body, encoding: str, endpoint: str):
+    """
+    Compress streamed body chunk by chunk, every chunk is flushed so entities reach client without waiting
+    for compressor buffer to fill
+    :param body: iterable with bytes (or str) chunks
+    :param encoding: gzip or zstd
+    :param endpoint: endpoint name used in metrics
+    :return: generator with compressed chunks
+    """
+    compress, finish = _compressor(encoding)
+    try:
+        for chunk in body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            started = time.perf_counter()
+            data = compress(chunk)
+            if trace_helper.active():
+                trace_helper.add_span('compress', started, time.perf_counter() - started, encoding=encoding,
+                                      bytes=len(chunk), compressed_bytes=len(data))
+            RESPONSE_UNCOMPRESSED_BYTES.inc(endpoint, encoding, value=len(chunk))
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def compress_response(request_func):
+    """
+    Decorator compressing streamed responses with encoding negotiated from request Accept-Encoding header
+    :param request_func: request to be processed
+    :return: Response object
+    """
+
+    @wraps(request_func)
+    def compression_decorator(*args, **kwargs):
+        response = request_func(*args, **kwargs)
+        if not RESPONSE_COMPRESSION or not isinstance(response, Response) or not response.is_streamed:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None or response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return response
+
+        response.response = iter_compressed(response.response, encoding, request_func.__name__)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    return compression_decorator
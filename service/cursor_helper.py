@@ -0,0 +1,62 @@
+import base64
+import time
+
+# prefix distinguishing page cursors from delta tokens received in since parameter
+CURSOR_PREFIX = 'cursor.'
+
+
+class ResponseLimit:
+    """
+    Opt-in limit of one response, response is ended at the first page boundary after max_entities entities
+    were streamed or max_seconds elapsed
+    """
+
+    def __init__(self, max_entities: int = None, max_seconds: float = None):
+        self.max_entities = max_entities
+        self.max_seconds = max_seconds
+        self.started = time.monotonic()
+
+    @staticmethod
+    def from_args(args):
+        """
+        :param args: request arguments with optional limit (number of entities) and limit_seconds
+        :return: ResponseLimit or None if response is not limited
+        """
+        max_entities = int(args['limit']) if args.get('limit') else None
+        max_seconds = float(args['limit_seconds']) if args.get('limit_seconds') else None
+        if max_entities is None and max_seconds is None:
+            return None
+        return ResponseLimit(max_entities, max_seconds)
+
+    def reached(self, entities: int) -> bool:
+        return (self.max_entities is not None and entities >= self.max_entities) or \
+               (self.max_seconds is not None and time.monotonic() - self.started >= self.max_seconds)
+
+
+def encode_cursor(next_link: str) -> str:
+    """
+    Encode link to the next page as opaque value used as _updated of streamed entities
+    """
+    return CURSOR_PREFIX + base64.urlsafe_b64encode(next_link.encode('utf-8')).decode('ascii')
+
+
+def is_cursor(since: str) -> bool:
+    return bool(since) and since.startswith(CURSOR_PREFIX)
+
+
+def decode_cursor(since: str, graph_url: str):
+    """
+    Decode cursor received in since parameter
+    :param since: value of since parameter
+    :param graph_url: MS Graph root, cursor must point to it so access token is never sent elsewhere
+    :return: link to the next page or None if since is not a cursor (e.g. delta token)
+    """
+    if not is_cursor(since):
+        return None
+    try:
+        next_link = base64.urlsafe_b64decode(since[len(CURSOR_PREFIX):].encode('ascii')).decode('utf-8')
+    except ValueError:
+        raise ValueError(f'invalid cursor {since}')
+    if not next_link.startswith(graph_url + '/'):
+        raise ValueError(f'cursor {since} does not point to MS Graph')
+    return next_link
@@ -1,46 +1,135 @@
+import contextvars
 import logging
 import requests
 import json
 import os
-from auth_helper import get_token, get_token_on_behalf_on_user
+import time
+from auth_helper import get_credential, get_user_credential, Credential
+from session_helper import get_session, TIMEOUT
+from json_stream_helper import iter_json_chunks
+from query_helper import build_url
+from cursor_helper import ResponseLimit, encode_cursor, decode_cursor
+from pool_helper import merge_concurrently
+from metrics_helper import GRAPH_LATENCY, GRAPH_RESPONSE_BYTES, PAGES, resource_template
+from trace_helper import span
+import cache_helper
+import checkpoint_store
+import rate_limiter
 from urllib.parse import urlparse, parse_qs
 
+# MS Graph root URL, may be pointed to a mock server (see benchmark/mock_graph.py)
+GRAPH_ROOT = os.environ.get('GRAPH_ROOT', 'https://graph.microsoft.com').rstrip('/')
+
 # Available values: v1.0, beta
-GRAPH_URL = f'https://graph.microsoft.com/{os.environ.get("API_VERSION", "v1.0")}'
+GRAPH_URL = f'{GRAPH_ROOT}/{os.environ.get("API_VERSION", "v1.0")}'
+
+ALLOWED_METHODS = ['get', 'post', 'put', 'patch', 'delete']
+
+# MS Graph accepts max 20 requests in one JSON batch
+BATCH_SIZE = min(int(os.environ.get('GRAPH_BATCH_SIZE', '20')), 20)
+
+BATCH_MAX_RETRIES = int(os.environ.get('GRAPH_BATCH_MAX_RETRIES', '5'))
+
+# number of pages fetched ahead while current page is streamed, 0 disables read-ahead
+PREFETCH_DEPTH = int(os.environ.get('PREFETCH_DEPTH', '2'))
 
-ALLOWED_METHODS = ['get', 'post', 'put', 'patch']
+# statuses of batch items which may be retried after waiting
+RETRYABLE_STATUSES = (429, 503, 504)
 
 METADATA = os.environ.get('ODATA_METADATA', 'minimal')
 
-__token = None
+# credential of the current request, context variable is used so concurrent requests don't interfere
+# (worker threads started with pool_helper get copy of caller context)
+__credential = contextvars.ContextVar('credential', default=None)
 
 
-def init_dao(client_id: str, client_secret: str, tenant_id: str) -> None:
-    global __token
-    __token = get_token(client_id, client_secret, tenant_id)
+def init_dao(client_id: str, client_secret: str, tenant_id: str) -> Credential:
+    credential = get_credential(client_id, client_secret, tenant_id)
+    credential.get_token()
+    __credential.set(credential)
+    return credential
 
 
-def init_dao_on_behalf_on(client_id: str, client_secret: str, tenant_id: str, username: str, password: str) -> None:
-    global __token
-    __token = get_token_on_behalf_on_user(tenant_id, client_id, client_secret, username, password)
+def init_dao_on_behalf_on(client_id: str, client_secret: str, tenant_id: str, username: str,
+                          password: str) -> Credential:
+    credential = get_user_credential(tenant_id, client_id, client_secret, username, password)
+    credential.get_token()
+    __credential.set(credential)
+    return credential
 
 
-def make_request(url: str, method: str, data=None) -> dict:
+def get_current_credential():
+    """
+    :return: credential set by init_dao for current context or None
+    """
+    return __credential.get()
+
+
+def _get_tenant_id():
+    credential = __credential.get()
+    return credential.tenant_id if credential else None
+
+
+def _get_cache_scope() -> tuple:
+    """
+    Key of credential set for current context, responses are cached per credential
+    """
+    credential = __credential.get()
+    if not credential:
+        raise ValueError("access token not found, you need to authenticate before")
+    return credential.key
+
+
+def _get_resource(url: str) -> str:
+    """
+    Get top level resource name (users, groups, planner...) from Graph URL, used as rate limiter key
+    """
+    path = url[len(GRAPH_URL):] if url.startswith(GRAPH_URL) else urlparse(url).path
+    return path.lstrip('/').split('/', 1)[0].split('?', 1)[0]
+
+
+def _get_template(url: str) -> str:
+    """
+    Get Graph URL path with object ids replaced by placeholder, used as metrics label
+    """
+    path = url[len(GRAPH_URL):] if url.startswith(GRAPH_URL) else urlparse(url).path
+    return resource_template(path.split('?', 1)[0])
+
+
+def make_request(url: str, method: str, data=None, credential: Credential = None) -> dict:
     """
     Function to send request to given URL with given method using given token
     :param url: where to send request
     :param method: which method to use. An exception will be thrown if method is not allowed
     :param data: request payload for POST/PUT/PATCH requests
+    :param credential: credential to use, credential set by init_dao for current context is used if not given
     :return: decoded JSON object
     """
+    api_call_response = _send_request(url, method, data, credential=credential)
+    return json.loads(api_call_response.text) if len(api_call_response.text) > 0 else {}
+
+
+def _send_request(url: str, method: str, data=None, extra_headers: dict = None,
+                  credential: Credential = None) -> requests.Response:
+    """
+    Send request to MS Graph with throttling handling
+    :param url: where to send request
+    :param method: which method to use. An exception will be thrown if method is not allowed
+    :param data: request payload for POST/PUT/PATCH requests
+    :param extra_headers: additional request headers
+    :param credential: credential to use, credential set by init_dao for current context is used if not given
+    :return: response object, exception is raised for 4xx/5xx responses
+    """
     if method.lower() not in ALLOWED_METHODS:
         raise Exception(f'Method {method} is not allowed')
 
-    if not __token:
+    credential = credential or __credential.get()
+    if not credential:
         raise ValueError("access token not found, you need to authenticate before")
 
-    t_type = __token['token_type']
-    t_value = __token['access_token']
+    token = credential.get_token()
+    t_type = token['token_type']
+    t_value = token['access_token']
 
     headers = {
         'Authorization': f'{t_type} {t_value}',
@@ -50,8 +139,46 @@ def make_request(url: str, method: str, data=None) -> dict:
     if method != 'GET':
         headers['Content-Type'] = 'application/json'
 
-    call_method = getattr(requests, method.lower())
-    api_call_response = call_method(url, headers=headers, verify=True, json=data)
+    if extra_headers:
+        headers.update(extra_headers)
+
+    limiter = rate_limiter.get_limiter(credential.tenant_id, _get_resource(url))
+    template = _get_template(url)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        rate_limiter.count('requests')
+        started = time.perf_counter()
+        with span('graph request', method=method.upper(), resource=template, attempt=attempt + 1) as request_span:
+            api_call_response = get_session().request(method.upper(), url, headers=headers, verify=True, json=data,
+                                                      timeout=TIMEOUT)
+            request_span['status'] = api_call_response.status_code
+            request_span['bytes'] = len(api_call_response.content)
+            # bytes read from connection before decoding of Content-Encoding
+            wire_bytes = api_call_response.raw.tell()
+            encoding = api_call_response.headers.get('Content-Encoding', 'identity')
+            request_span['wire_bytes'] = wire_bytes
+            request_span['encoding'] = encoding
+        GRAPH_LATENCY.observe(time.perf_counter() - started, template, method.upper(), api_call_response.status_code)
+        GRAPH_RESPONSE_BYTES.inc(template, encoding, value=wire_bytes)
+        if api_call_response.status_code not in rate_limiter.THROTTLE_STATUSES:
+            limiter.on_success()
+            break
+
+        attempt += 1
+        rate_limiter.count('throttled')
+        retry_after = api_call_response.headers.get('Retry-After')
+        limiter.on_throttle(rate_limiter.backoff_delay(retry_after, attempt) if retry_after else None)
+        if attempt > rate_limiter.MAX_RETRIES:
+            rate_limiter.count('dropped')
+            break
+
+        wait = rate_limiter.backoff_delay(retry_after, attempt)
+        logging.warning(f'{method} {url} throttled with status {api_call_response.status_code}, '
+                        f'retrying in {wait:.1f} seconds')
+        rate_limiter.count('retried')
+        with span('retry wait', seconds=wait):
+            time.sleep(wait)
 
     try:
         api_call_response.raise_for_status()
@@ -60,71 +187,315 @@ def make_request(url: str, method: str, data=None) -> dict:
         logging.error(error.response.text)
         raise error
 
-    return json.loads(api_call_response.text) if len(api_call_response.text) > 0 else {}
+    return api_call_response
+
+
+def _get_cached(url: str) -> dict:
+    """
+    GET given URL through response cache. Fresh cached responses are returned without request,
+    stale ones are revalidated with If-None-Match if they have ETag
+    :param url: where to send request
+    :return: decoded JSON object
+    """
+    ttl = cache_helper.ttl_for(url)
+    if ttl is None:
+        return make_request(url, 'get')
+
+    scope = _get_cache_scope()
+    entry = cache_helper.get(url, scope)
+    if entry is not None and entry.is_fresh():
+        cache_helper.count('hits')
+        return entry.value()
+
+    response = _send_request(url, 'get', extra_headers={'If-None-Match': entry.etag} if entry else None)
+    if response.status_code == 304 and entry is not None:
+        cache_helper.refresh(url, scope, entry, ttl)
+        return entry.value()
+
+    cache_helper.count('misses')
+    result = json.loads(response.text) if len(response.text) > 0 else {}
+    cache_helper.put(url, scope, result, response.headers.get('ETag') or result.get('@odata.etag'), ttl)
+    return result
 
 
-def get_all_objects(resource_path: str, delta=None):
+def get_all_objects(resource_path: str, delta=None, query=None, limit: ResponseLimit = None):
     """
     Fetch and stream back objects from MS Graph API
+    Only the last streamed object gets the new delta token as _updated. Objects of delta resources get cursor pointing
+    to their own page, so interrupted run is continued by client from the page of the last received object
+    (at least once delivery), objects of other resources keep since value of the request.
+    Delta links are saved in checkpoint store, so run started with delta token keeps all query options
     :param resource_path path to needed resource in MS Graph API
-    :param delta: delta token from last request.
+    :param delta: delta token from last request or cursor returned by limited response.
     More about delta https://docs.microsoft.com/en-us/graph/delta-query-users
+    :param query: OData query options ($select, $filter, $expand, $top) sent with the first request.
+    Delta token already keeps options of the request it was issued for, so they are not repeated with it
+    :param limit: optional limit of streamed entities/time, output is ended at page boundary when limit is reached.
+    Objects of limited output get cursor pointing to their own page as _updated, the last one gets cursor of the next
+    page (or delta token at the end of run), so interrupted or limited responses continue from client-visible cursor
     :return: generated output with all fetched objects
     """
-    url = GRAPH_URL + resource_path
-
-    if delta:
-        url += f'?$deltatoken={delta}'
-
-    while url is not None:
-        result = make_request(url, 'get')
-
-        logging.debug(f"Got response: {json.dumps(result, indent=4, sort_keys=True)}")
+    since = delta
+    start_url = GRAPH_URL + resource_path
+    # runs with different query options must not use delta links of each other
+    checkpoint_path = build_url(resource_path, query)
+    is_delta = 'delta' in resource_path.strip('/').split('/')
+    checkpoint = checkpoint_store.load(_get_tenant_id(), checkpoint_path) if is_delta else None
+    cursor_link = decode_cursor(delta, GRAPH_URL)
+
+    if cursor_link:
+        # page link keeps all query options of the run which returned the cursor,
+        # objects of the last page of collections without delta support get no since value (same as full run)
+        start_url = cursor_link
+        delta = None
+    elif delta:
+        start_url = build_url(start_url, {'$deltatoken': delta})
+        if checkpoint and checkpoint['delta_token'] == delta and checkpoint['delta_link']:
+            # stored link keeps all query options of the original request
+            start_url = checkpoint['delta_link']
+    else:
+        start_url = build_url(start_url, query)
+
+    page_template = resource_template(resource_path)
+
+    def __pages():
+        url = start_url
+        while url is not None:
+            page_url = url
+            with span('page', resource=page_template) as page_span:
+                result = _get_cached(page_url)
+                page_span['entities'] = len(result.get('value') or [])
+
+            logging.debug(f"Got response: {json.dumps(result, indent=4, sort_keys=True)}")
+
+            if type(result.get('value')) != list:
+                raise ValueError(f'value object expected in response to url: {page_url} got {result}')
+
+            PAGES.inc(page_template)
+            url = result.get('@odata.nextLink', None)
+            yield page_url, result
+
+    # next pages are fetched in background while current one is streamed
+    pages = merge_concurrently([__pages], 1, PREFETCH_DEPTH) if PREFETCH_DEPTH > 0 else __pages()
+
+    # last object is held back until it's known which token it must get
+    held = None
+    streamed = 0
+    try:
+        for page_url, result in pages:
+            if result.get('@odata.deltaLink'):
+                delta = parse_qs(urlparse(result.get('@odata.deltaLink')).query)['$deltatoken'][0]
 
-        if result.get('@odata.deltaLink'):
-            parsed_url = urlparse(result.get('@odata.deltaLink'))
-            query = parse_qs(parsed_url.query)
-            delta = query['$deltatoken'][0]
+            next_link = result.get('@odata.nextLink', None)
+            resume_token = encode_cursor(page_url) if limit or is_delta else since
 
-        if type(result.get('value')) == list:
             for item in result['value']:
-                item['_updated'] = delta
+                item['_updated'] = resume_token
                 item['_id'] = item['id']
-                yield item
-        else:
-            raise ValueError(f'value object expected in response to url: {url} got {result}')
-
-        url = result.get('@odata.nextLink', None)
+                if held is not None:
+                    yield held
+                held = item
+
+            if is_delta and result.get('@odata.deltaLink'):
+                checkpoint_store.save_delta(_get_tenant_id(), checkpoint_path, delta, result['@odata.deltaLink'])
+
+            streamed += len(result['value'])
+            if limit is not None and next_link is not None and limit.reached(streamed):
+                logging.info(f'response limit reached after {streamed} objects of {resource_path}, '
+                             f'next run continues from cursor')
+                if held is not None:
+                    held['_updated'] = encode_cursor(next_link)
+                    yield held
+                return
+
+        if held is not None:
+            held['_updated'] = delta
+            yield held
+    finally:
+        # pages fetched ahead of a disconnected client are dropped, they are never checkpointed
+        pages.close()
 
 
 def get_object(resource_path):
     url = GRAPH_URL + resource_path
-    result = make_request(url, 'get')
+    result = _get_cached(url)
 
     logging.debug(f"Got response: {json.dumps(result, indent=4, sort_keys=True)}")
 
     return result
 
 
-def stream_as_json(generator_function):
+def make_batch_request(batch_items: list) -> list:
     """
-    Stream list of objects as JSON array
-    :param generator_function:
-    :return:
+    Function to send list of requests to MS Graph by using JSON batching (https://docs.microsoft.com/en-us/graph/json-batching)
+    Items are packed into envelopes of max BATCH_SIZE requests, envelopes are sent one by one in input order.
+    Items failed with 429/503/504 are retried individually after waiting for Retry-After, every throttled envelope
+    slows down the $batch rate limiter once, in proportion to its throttled items.
+    :param batch_items: list of request dicts with keys
+        method - HTTP method,
+        url - resource path relative to GRAPH_URL,
+        body - optional request payload,
+        headers - optional additional request headers,
+        depends_on - optional list of indexes of items in batch_items which must succeed before this one
+    :return: list of response dicts with keys status, headers, body in the same order as batch_items
+    """
+    responses = [None] * len(batch_items)
+
+    for start in range(0, len(batch_items), BATCH_SIZE):
+        pending = list(range(start, min(start + BATCH_SIZE, len(batch_items))))
+        attempt = 0
+
+        while pending:
+            envelope = []
+            for index in pending:
+                item = batch_items[index]
+                if item.get('method', 'GET').lower() not in ALLOWED_METHODS:
+                    raise Exception(f'Method {item["method"]} is not allowed')
+
+                failed_deps = [d for d in item.get('depends_on', []) if d not in pending
+                               and responses[d] is not None and responses[d]['status'] >= 400]
+                if failed_deps:
+                    # dependency was sent in previous envelope or attempt and failed
+                    responses[index] = {'status': 424, 'headers': {}, 'body': {
+                        'error': {'code': 'FailedDependency', 'message': f'request {failed_deps[0]} failed'}}}
+                    continue
+
+                envelope.append(_build_batch_request(index, item, pending))
+
+            if not envelope:
+                break
+
+            batch_url = f'{GRAPH_URL}/$batch'
+            result = make_request(batch_url, 'POST', {'requests': envelope})
+            for response in result.get('responses', []):
+                responses[int(response['id'])] = {'status': int(response['status']),
+                                                  'headers': response.get('headers', {}),
+                                                  'body': response.get('body') or {}}
+
+            retry = [i for i in pending if responses[i] and responses[i]['status'] in RETRYABLE_STATUSES]
+            wait = 0
+            if retry:
+                # one throttling event per envelope, applied to the limiter the envelope itself acquires
+                # and weighted by share of throttled items, so one envelope doesn't cut the rate several times.
+                # Retry-After of items is waited by retried items only, other envelopes are not paused
+                rate_limiter.count('throttled', len(retry))
+                rate_limiter.get_limiter(_get_tenant_id(), _get_resource(batch_url)).on_throttle(
+                    share=len(retry) / len(envelope))
+                wait = max(_retry_after(responses[i]['headers'], attempt + 1) for i in retry)
+            # requests failed only because their dependency was throttled must be retried together with it
+            for i in pending:
+                if responses[i] and responses[i]['status'] == 424 and \
+                        any(d in retry for d in batch_items[i].get('depends_on', [])):
+                    retry.append(i)
+            pending = sorted(retry)
+            if pending:
+                attempt += 1
+                if attempt > BATCH_MAX_RETRIES:
+                    logging.error(f'giving up on {len(pending)} batch requests after {BATCH_MAX_RETRIES} retries')
+                    rate_limiter.count('dropped', len(pending))
+                    break
+                rate_limiter.count('retried', len(pending))
+                logging.warning(f'{len(pending)} batch requests throttled, retrying in {wait} seconds')
+                time.sleep(wait)
+
+    return responses
+
+
+def _build_batch_request(index: int, item: dict, envelope_indexes: list) -> dict:
+    """
+    Build single request for JSON batch envelope
+    Dependencies on requests outside of current envelope are dropped as they were already executed
+    :param index: position of item in input list, used as request id
+    :param item: request dict
+    :param envelope_indexes: indexes of all items in current envelope
+    :return: request object for batch payload
     """
-    first = True
+    request = {
+        'id': str(index),
+        'method': item.get('method', 'GET').upper(),
+        'url': item['url'],
+        'headers': {'Accept': f'application/json;odata.metadata={METADATA}'}
+    }
+    if item.get('body') is not None:
+        request['body'] = item['body']
+        request['headers']['Content-Type'] = 'application/json'
+
+    request['headers'].update(item.get('headers', {}))
+
+    depends_on = [str(d) for d in item.get('depends_on', []) if d in envelope_indexes]
+    if depends_on:
+        request['dependsOn'] = depends_on
+
+    return request
 
-    yield '['
 
-    for item in generator_function:
-        if not first:
-            yield ','
+def _retry_after(headers: dict, attempt: int) -> float:
+    """
+    Get number of seconds to wait before retry from Retry-After header or jittered exponential backoff if not present
+    """
+    return rate_limiter.backoff_delay({k.lower(): v for k, v in headers.items()}.get('retry-after'), attempt)
+
+
+def get_objects(resource_paths: list) -> list:
+    """
+    Fetch list of objects from MS Graph API by using JSON batching
+    Fresh objects are served from response cache, stale ones are revalidated with If-None-Match
+    :param resource_paths: list of paths to needed objects
+    :return: list of fetched objects in the same order as resource_paths
+    """
+    results = [None] * len(resource_paths)
+    to_fetch = []
+    scope = _get_cache_scope()
+
+    for index, path in enumerate(resource_paths):
+        url = GRAPH_URL + path
+        ttl = cache_helper.ttl_for(url)
+        entry = cache_helper.get(url, scope) if ttl is not None else None
+        if entry is not None and entry.is_fresh():
+            cache_helper.count('hits')
+            results[index] = entry.value()
         else:
-            first = False
+            to_fetch.append((index, path, url, ttl, entry))
+
+    requests_to_send = [{'method': 'GET', 'url': path, 'headers': {'If-None-Match': entry.etag} if entry else {}}
+                        for _, path, _, _, entry in to_fetch]
+    with span('details', requested=len(resource_paths), cached=len(resource_paths) - len(to_fetch)):
+        for (index, path, url, ttl, entry), response in zip(to_fetch, make_batch_request(requests_to_send)):
+            if response is not None and response['status'] == 304 and entry is not None:
+                cache_helper.refresh(url, scope, entry, ttl)
+                results[index] = entry.value()
+            elif response is None or response['status'] >= 400:
+                raise BatchItemError(path, response)
+            else:
+                results[index] = response['body']
+                if ttl is not None:
+                    cache_helper.count('misses')
+                    etag = {k.lower(): v for k, v in response['headers'].items()}.get('etag')
+                    cache_helper.put(url, scope, response['body'], etag or response['body'].get('@odata.etag'),
+                                     ttl)
+
+    return results
+
+
+class BatchItemError(Exception):
+    """
+    Exception for failed request inside of JSON batch
+    """
+
+    def __init__(self, url: str, response: dict):
+        self.url = url
+        self.status = response['status'] if response else None
+        self.body = response['body'] if response else {}
+        super().__init__(f'batch request to {url} failed with status {self.status}: {json.dumps(self.body)}')
 
-        yield json.dumps(item)
 
-    yield ']'
+def stream_as_json(generator_function):
+    """
+    Stream list of objects as JSON array
+    :param generator_function:
+    :return: generator with chunks of encoded array, see json_stream_helper.WRITE_CHUNK_SIZE
+    """
+    return iter_json_chunks(generator_function)
 
 
 def is_object_already_exists_exception(ex: requests.exceptions.HTTPError) -> bool:
@@ -133,8 +504,16 @@ def is_object_already_exists_exception(ex: requests.exceptions.HTTPError) -> boo
     :param ex: HTTPError object
     :return: True if exception is about already existing object or false otherwise
     """
-    exc_details = json.loads(ex.response.text)
-    if exc_details.get('error').get('details') and exc_details['error']['details'][0]['code'] == 'ObjectConflict':
+    return is_object_already_exists_error(json.loads(ex.response.text))
+
+
+def is_object_already_exists_error(exc_details: dict) -> bool:
+    """
+    Check error payload returned by MS Graph to find if this is a 'Already exists' error or not
+    :param exc_details: decoded error response body
+    :return: True if error is about already existing object or false otherwise
+    """
+    if exc_details.get('error', {}).get('details') and exc_details['error']['details'][0]['code'] == 'ObjectConflict':
         return True
     return False
 
@@ -3,6 +3,7 @@ from flask import Flask, request, Response, abort
 
 import os
 import requests
+from urllib.parse import urlencode, urlparse, parse_qs
 
 import json
 
@@ -10,11 +11,29 @@ import logging
 
 import adal
 import uuid
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 
 logger = None
 
+# shared session so connections to Graph are kept alive between requests and pages
+session = requests.Session()
+
+# Graph accepts max 20 requests in one JSON batch
+BATCH_SIZE = 20
+BATCH_MAX_RETRIES = 5
+# number of batches sent at the same time by receiver
+WRITER_WORKERS = int(os.environ.get("WRITER_WORKERS", "4"))
+
+# tokens per client, refreshed this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 300
+token_cache = {}
+token_cache_lock = threading.Lock()
+
 def datetime_format(dt):
     return '%04d' % dt.year + dt.strftime("-%m-%dT%H:%M:%SZ")
 
@@ -30,43 +49,70 @@ class DataAccess:
         if not datatype in self._entities:
             abort(404)
 
-        return self.get_entitiesdata(datatype, since, endpoint, token)
-
-    def get_entitiesdata(self, datatype, since, endpoint, token):
-
-        entities = []
-
-
         if since is not None:
-            endpoint = endpoint + "?$skiptoken=" + since
-
-        http_headers = {'Authorization': 'Bearer ' + token["accessToken"],
-                        'User-Agent': 'adal-python-sample',
-                        'Accept': 'application/json',
-                        'Content-Type': 'application/json',
-                        'client-request-id': str(uuid.uuid4())}
-        result = requests.get(endpoint, headers=http_headers, stream=False).json()
-
-        skiptoken = None
-
-        if "@odata.nextLink" in result:
-            skiptoken = result["@odata.nextLink"].split("?$skiptoken=")[-1]
-
-        if "value" in result:
-            for e in result["value"]:
-
-               # c = {k: v for k, v in c.items() if v}
+            # plain since value (without "$") is $skiptoken returned by older versions
+            if not since.startswith("$"):
+                since = "$skiptoken=" + since
+            name, _, value = since.partition("=")
+            if name not in ("$skiptoken", "$deltatoken"):
+                abort(400)
+            endpoint = endpoint + "?" + urlencode({name: value})
+
+        return self.get_entitiesdata(datatype, endpoint, token)
+
+    def get_entitiesdata(self, datatype, endpoint, token):
+        """
+        Generator following all @odata.nextLink pages of the delta query, entities are yielded page by page.
+        Entities get continuation of the page they came from as _updated ("$skiptoken=..." or "$deltatoken=..."),
+        last entity is held back and gets continuation of the next page, or "$deltatoken=..." from
+        @odata.deltaLink at the end, so since of the next run continues after it or returns only changes
+        """
+        last = None
+        url = endpoint
+        while url is not None:
+            http_headers = {'Authorization': 'Bearer ' + token["accessToken"],
+                            'User-Agent': 'adal-python-sample',
+                            'Accept': 'application/json',
+                            'client-request-id': str(uuid.uuid4())}
+            response = session.get(url, headers=http_headers)
+            if response.status_code >= 400:
+                logger.error("Result: %s - %s: %s" % (response.status_code, response.reason, response.text))
+                response.raise_for_status()
+            result = response.json()
+
+            updated = continuation(url)
+            for e in result.get("value", []):
                 e.update({"_id": e["id"]})
-                if skiptoken:
-                    e.update({"_updated": "%s" % skiptoken})
+                if updated:
+                    e.update({"_updated": updated})
 
                 if "@removed" in e:
                     e.update({"_deleted": True})
 
-                entities.append(e)
+                if last is not None:
+                    yield last
+                last = e
+
+            url = result.get("@odata.nextLink")
+            next_updated = continuation(url or result.get("@odata.deltaLink"))
+            if last is not None and next_updated:
+                last.update({"_updated": next_updated})
 
+        if last is not None:
+            yield last
 
-        return entities
+
+def continuation(link):
+    """
+    Continuation of Graph link as since value ("$skiptoken=..." or "$deltatoken=..."), None if link has none
+    """
+    if link is None:
+        return None
+    query = parse_qs(urlparse(link).query)
+    for name in ("$skiptoken", "$deltatoken"):
+        if name in query:
+            return name + "=" + query[name][0]
+    return None
 
 data_access_layer = DataAccess()
 
@@ -79,6 +125,39 @@ def get_var(var):
     logger.info("Setting %s = %s" % (var, envvar))
     return envvar
 
+def get_token(authority_url, tenant, resource, client_id, client_secret):
+    """
+    Get token for client from cache or acquire new one with ADAL. Cache key contains hash of the secret,
+    so request with wrong password never gets token acquired by someone else
+    """
+    key = (authority_url, tenant, resource, client_id, hashlib.sha256(client_secret.encode("utf-8")).hexdigest())
+    with token_cache_lock:
+        cached = token_cache.get(key)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+
+    auth_context = adal.AuthenticationContext(authority_url + "/" + tenant)
+    token_response = auth_context.acquire_token_with_client_credentials(resource, client_id, client_secret)
+    expires_at = time.time() + int(token_response.get("expiresIn", 0)) - TOKEN_EXPIRY_MARGIN
+    with token_cache_lock:
+        token_cache[key] = (expires_at, token_response)
+    return token_response
+
+
+def stream_json(entities):
+    """
+    Stream JSON array one entity at a time
+    """
+    yield "["
+    first = True
+    for e in entities:
+        if not first:
+            yield ","
+        yield json.dumps(e)
+        first = False
+    yield "]"
+
+
 def authenticate():
     """Sends a 401 response that enables basic auth"""
     return Response(
@@ -109,21 +188,17 @@ def get_entities(datatype):
 
     auth = request.authorization
     logger.info("User = %s" % (auth.username))
-    auth_context = adal.AuthenticationContext(authority_url + "/" + tenant)
-    token_response = auth_context.acquire_token_with_client_credentials(resource,
-                                                                        auth.username, auth.password)
+    token_response = get_token(authority_url, tenant, resource, auth.username, auth.password)
 
+    entities = data_access_layer.get_entities(since, datatype, endpoint, token_response)
 
-    entities = sorted(data_access_layer.get_entities(since, datatype, endpoint, token_response), key=lambda k: k["_updated"])
-
-    return Response(json.dumps(entities), mimetype='application/json')
+    return Response(stream_json(entities), mimetype='application/json')
 
 
 
 @app.route('/<datatype>', methods=['POST'])
 @requires_auth
 def receiver(datatype):
-    # get entities from request and write each of them to a file
     entities = request.get_json()
     app.logger.info("Updating %s entities of type %s" % (len(entities), datatype))
     app.logger.debug(json.dumps(entities))
@@ -137,57 +212,116 @@ def receiver(datatype):
 
     auth = request.authorization
     logger.info("User = %s" % (auth.username))
-    auth_context = adal.AuthenticationContext(authority_url + "/" + tenant)
-    token_response = auth_context.acquire_token_with_client_credentials(resource,
-                                                                        auth.username, auth.password)
-
-    transform(datatype, entities, endpoint, token_response)# create the response
+    token_response = get_token(authority_url, tenant, resource, auth.username, auth.password)
+
+    outcomes = transform(datatype, entities, endpoint, token_response)
+
+    failed = len([o for o in outcomes if o["status"] == "failed"])
+    return Response(json.dumps({"processed": len(outcomes), "failed": failed, "entities": outcomes}),
+                    status=500 if failed else 200, mimetype='application/json')
+
+def send_batch(batch_url, requests_batch, token):
+    """
+    Send up to BATCH_SIZE requests in one Graph JSON batch, throttled requests and throttled batches
+    are retried after Retry-After, other failures of the batch itself are raised
+    :return: dict with status and body of every request by request id
+    """
+    http_headers = {'Authorization': 'Bearer ' + token["accessToken"],
+                    'User-Agent': 'sesam',
+                    'Accept': 'application/json',
+                    'Content-Type': 'application/json',
+                    'client-request-id': str(uuid.uuid4())}
+    results = {}
+    pending = requests_batch
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        result = session.post(batch_url, json={"requests": pending}, headers=http_headers)
+        if result.status_code in (429, 503) and attempt < BATCH_MAX_RETRIES:
+            wait = float(result.headers.get("Retry-After", 2 ** attempt))
+            app.logger.warning("Batch throttled (%s), retrying in %s seconds" % (result.status_code, wait))
+            time.sleep(wait)
+            continue
+        if result.status_code >= 400:
+            app.logger.error("Batch result: %s - %s: %s" % (result.status_code, result.reason, result.text))
+            result.raise_for_status()
+
+        throttled = []
+        wait = 0
+        for r in result.json()["responses"]:
+            if r["status"] in (429, 503) and attempt < BATCH_MAX_RETRIES:
+                throttled.append(r["id"])
+                wait = max(wait, float((r.get("headers") or {}).get("Retry-After", 2 ** attempt)))
+            else:
+                results[r["id"]] = r
+        if not throttled:
+            break
+        app.logger.warning("%s requests throttled, retrying in %s seconds" % (len(throttled), wait))
+        time.sleep(wait)
+        pending = [r for r in pending if r["id"] in throttled]
+    return results
 
-    return Response("Thanks!", mimetype='text/plain')
 
 def transform(datatype, entities, endpoint, token):
-    global ids
-    # create output directory
-    c = None
+    """
+    Write entities with Graph JSON batches of BATCH_SIZE requests, WRITER_WORKERS batches are sent at the same time.
+    Entities with id are updated (PATCH), entities with _deleted = true are deleted, entities without id are skipped
+    Entities of a batch which could not be sent are reported as failed with the error, other batches are still sent
+    :return: list of per-entity results with _id, status and error for failed entities
+    """
     listing = []
     if not isinstance(entities, (list)):
         listing.append(entities)
     else:
         listing = entities
+
+    outcomes = []
+    batch_requests = []
     for e in listing:
-        del e["_id"]
-        if not ("_deleted" in e and e["_deleted"]):
-            if "id" in e:
-                app.logger.debug("Update entity %s of type %s" % (e["id"], datatype))
-                d = []
-                for p in e.keys():
-                    if p.startswith("_"):
-                        d.append(p)
-                for p in d:
-                    del(e[p])
-
-                http_headers = {'Authorization': 'Bearer ' + token["accessToken"],
-                                'User-Agent': 'sesam',
-                                'Accept': 'application/json',
-                                'Content-Type': 'application/json',
-                                'client-request-id': str(uuid.uuid4())}
-
-                app.logger.debug("Payload: %s" % (json.dumps(e)))
-                id = e["id"]
-                del(e["id"])
-                result = requests.patch(endpoint + "/" + id, json=e, headers=http_headers)
-
-                if result.status_code >= 400:
-                    app.logger.error("Result: %s - %s: %s" % (result.status_code, result.reason, result.json()))
-                    result.raise_for_status()
+        entity_id = e.pop("_id", None)
+        id = e.get("id") or e.get("Id")
+        if not id:
+            outcomes.append({"_id": entity_id, "status": "skipped", "error": "id is missing"})
+            continue
+
+        if "_deleted" in e and e["_deleted"]:
+            app.logger.info("Deleting entity %s of type %s" % (id, datatype))
+            batch_request = {"method": "DELETE", "url": "/" + datatype + "/" + id}
+        else:
+            app.logger.debug("Update entity %s of type %s" % (id, datatype))
+            body = {k: v for k, v in e.items() if not k.startswith("_") and k not in ("id", "Id")}
+            app.logger.debug("Payload: %s" % (json.dumps(body)))
+            batch_request = {"method": "PATCH", "url": "/" + datatype + "/" + id, "body": body,
+                             "headers": {"Content-Type": "application/json"}}
+        batch_request["id"] = str(len(batch_requests))
+        batch_requests.append((entity_id, batch_request))
+
+    batch_url = endpoint.rsplit("/", 1)[0] + "/$batch"
+    chunks = [batch_requests[i:i + BATCH_SIZE] for i in range(0, len(batch_requests), BATCH_SIZE)]
+
+    def write(chunk):
+        try:
+            return chunk, send_batch(batch_url, [r for _, r in chunk], token), None
+        except Exception as e:
+            app.logger.exception("Batch of %s requests failed" % len(chunk))
+            return chunk, None, str(e)
+
+    with ThreadPoolExecutor(max_workers=WRITER_WORKERS) as executor:
+        for chunk, results, error in executor.map(write, chunks):
+            if error is not None:
+                outcomes.extend({"_id": entity_id, "status": "failed", "error": error} for entity_id, _ in chunk)
+                continue
+            for entity_id, batch_request in chunk:
+                r = results.get(batch_request["id"], {"status": 500, "body": "no response in batch"})
+                if r["status"] < 400 or (batch_request["method"] == "DELETE" and r["status"] == 404):
+                    app.logger.debug("Result: %s %s - %s" % (batch_request["method"], batch_request["url"],
+                                                             r["status"]))
+                    outcomes.append({"_id": entity_id,
+                                     "status": "deleted" if batch_request["method"] == "DELETE" else "updated"})
                 else:
-                    app.logger.debug("Result: %s - %s" % (result.status_code, result.reason))
-
-        if "_deleted" in e and e["_deleted"] :
-            if "Id" in e:
-                app.logger.info("Deleting entity %s of type %s" % (e["Id"],datatype))
-
+                    app.logger.error("Result: %s %s - %s: %s" % (batch_request["method"], batch_request["url"],
+                                                                 r["status"], r.get("body")))
+                    outcomes.append({"_id": entity_id, "status": "failed", "error": r.get("body")})
 
+    return outcomes
 
 
 if __name__ == '__main__':
@@ -1,69 +1,268 @@
 import logging
-from dao_helper import get_all_objects, make_request, GRAPH_URL, is_object_already_exists_exception, \
-    clear_sesam_attributes, stream_as_json
+from dao_helper import get_all_objects, make_batch_request, is_object_already_exists_error, \
+    clear_sesam_attributes, stream_as_json, GRAPH_URL, BATCH_SIZE
+from query_helper import with_selected, projection, project
+from sink_helper import run_sink, MISSING_RESPONSE_ERROR
+import change_store
+import id_index
+import segment_helper
 
 RESOURCE_PATH = '/groups/'
 
+# MS Graph accepts max 20 members in one members@odata.bind update
+MEMBERS_PER_REQUEST = 20
 
-def sync_group_array(group_data_array):
-    def __try_create(group_data):
+
+def sync_group_array(group_data_array, force_resync=False):
+    """
+    Function to synchronize group array from Sesam into Azure Active Directory
+    Groups with id or found in local id index are updated directly,
+    otherwise this function will try to create group first and update it if create operation failed
+    This function will also delete groups with _deleted property = true
+    Requests are sent in JSON batches of max BATCH_SIZE groups by SINK_WORKERS concurrent lanes
+    Only fields changed since last write are sent, groups without changes are skipped
+    :param group_data_array: iterable with group objects
+    :param force_resync: send full payload even if nothing changed since last write
+    :return: summary with per-entity results
+    """
+
+    def __get_group_id(group_data):
+        group_id = group_data['id'] if 'id' in group_data else id_index.lookup('groups', group_data)
+        if not group_id:
+            raise Exception("Couldn't find id for group")
+        return group_id
+
+    def __create_request(group_data):
         """
-        Internal function to create a group
+        Internal function to build create group request
         :param group_data: json object with group details
-        :return: void
+        :return: batch request
         """
         logging.info(f'trying to create group {group_data.get("displayName")}')
-        make_request(f'{GRAPH_URL}{RESOURCE_PATH}', 'POST', group_data)
-        logging.info(f'group {group_data.get("displayName")} created successfully')
+        return {'method': 'POST', 'url': RESOURCE_PATH, 'body': group_data}
 
-    def __try_update(group_data):
+    def __update_request(group_data):
         """
-        Internal function to update a group
+        Internal function to build update group request
         :param group_data: json object with group details, must contain group identifier
-        :return: void
+        :return: batch request with changed fields only or None if nothing changed since last write
         """
-        group_id = group_data['id'] if 'id' in group_data else None
-
-        if not group_id:
-            raise Exception("Couldn't find id for group")
+        group_id = __get_group_id(group_data)
+        changes = change_store.diff('groups', group_id, group_data, force_resync)
+        if changes is None:
+            logging.info(f'group {group_data.get("displayName")} not changed since last write, skipping')
+            return None
 
         logging.info(f'trying to update group {group_data.get("displayName")}')
-        make_request(f'{GRAPH_URL}{RESOURCE_PATH}{group_id}', 'PATCH', group_data)
-        logging.info(f'group {group_data.get("displayName")} updated successfully')
+        return {'method': 'PATCH', 'url': f'{RESOURCE_PATH}{group_id}', 'body': changes}
 
-    def __try_delete(group_data):
+    def __delete_request(group_data):
         """
-        Internal function to delete a group
+        Internal function to build delete group request
         :param group_data: json object with group details, must contain group identifier
-        :return: void
+        :return: batch request
         """
-        group_id = group_data['id'] if 'id' in group_data else None
-        if not group_id:
-            raise Exception("Couldn't find id for group")
-
+        group_id = __get_group_id(group_data)
         logging.info(f'trying to delete group {group_data.get("displayName")}')
-        make_request(f'{GRAPH_URL}{RESOURCE_PATH}{group_id}', 'DELETE')
-        logging.info(f'group {group_data.get("displayName")} disabled successfully')
-
-    for group in group_data_array:
-        if '_deleted' in group and group['_deleted']:
-            __try_delete(group)
-            continue
-
-        group = clear_sesam_attributes(group)
-        try:
-            __try_create(group)
-        except Exception as e:
-            if is_object_already_exists_exception(e):
-                __try_update(group)
+        return {'method': 'DELETE', 'url': f'{RESOURCE_PATH}{group_id}'}
+
+    def __sync_chunk(groups, summary):
+        operations = []
+        for group in groups:
+            try:
+                if '_deleted' in group and group['_deleted']:
+                    operations.append((group, 'deleted', __delete_request(group)))
+                else:
+                    group_data = clear_sesam_attributes(group)
+                    if 'id' in group_data or id_index.lookup('groups', group_data):
+                        operations.append((group, 'updated', __update_request(group_data)))
+                    else:
+                        operations.append((group, 'created', __create_request(group_data)))
+            except Exception as e:
+                summary.add(group, 'failed', str(e))
+
+        for group, _, _ in [op for op in operations if op[2] is None]:
+            summary.add(group, 'skipped')
+        operations = [op for op in operations if op[2] is not None]
+
+        conflicts = []
+        for (group, status, request), response in zip(operations, make_batch_request([op[2] for op in operations])):
+            if response is None:
+                summary.add(group, 'failed', MISSING_RESPONSE_ERROR)
+            elif response['status'] < 400:
+                logging.info(f'{request["method"]} {request["url"]} completed successfully')
+                if status == 'created':
+                    id_index.remember('groups', request['body'], response['body'].get('id'))
+                    change_store.remember('groups', response['body'].get('id'), request['body'])
+                elif status == 'updated':
+                    change_store.remember('groups', request['url'][len(RESOURCE_PATH):], request['body'])
+                else:
+                    id_index.forget('groups', request['url'][len(RESOURCE_PATH):])
+                    change_store.forget('groups', request['url'][len(RESOURCE_PATH):])
+                summary.add(group, status)
+            elif request['method'] == 'POST' and is_object_already_exists_error(response['body']):
+                conflicts.append((group, request['body']))
             else:
-                raise Exception from e
+                summary.add(group, 'failed', response['body'])
 
+        updates = []
+        for group, group_data in conflicts:
+            try:
+                request = __update_request(group_data)
+                if request is None:
+                    summary.add(group, 'skipped')
+                else:
+                    updates.append((group, request))
+            except Exception as e:
+                summary.add(group, 'failed', str(e))
 
-def get_all_groups(delta=None):
+        for (group, request), response in zip(updates, make_batch_request([update[1] for update in updates])):
+            if response is None:
+                summary.add(group, 'failed', MISSING_RESPONSE_ERROR)
+            elif response['status'] < 400:
+                logging.info(f'group {request["url"]} updated successfully')
+                change_store.remember('groups', request['url'][len(RESOURCE_PATH):], request['body'])
+                summary.add(group, 'updated')
+            else:
+                summary.add(group, 'failed', response['body'])
+
+    return run_sink(group_data_array, lambda g: g.get('id') or g.get('displayName'), __sync_chunk)
+
+
+def get_all_groups(delta=None, query=None, limit=None):
     """
     Fetch and stream back groups from Azure AD via MS Graph API
-    :param delta: delta token from last request
+    :param delta: delta token or cursor from last request
+    :param query: OData query options, attributes needed for id index are fetched even if not selected
+    and removed before output
+    :param limit: optional ResponseLimit, limited output is fetched page by page (never in segments)
     :return: generated JSON output with all fetched groups
     """
-    yield from stream_as_json(get_all_objects(f'{RESOURCE_PATH}delta', delta))
+    indexed = id_index.FETCHED_ATTRIBUTES['groups'] if id_index.ID_INDEX_ENABLED else ()
+    graph_query = with_selected(query or {}, indexed)
+    if delta is None and limit is None and segment_helper.SEGMENTED_FULL_SYNC:
+        objects = segment_helper.get_all_objects_segmented('groups', RESOURCE_PATH, graph_query)
+    else:
+        objects = get_all_objects(f'{RESOURCE_PATH}delta', delta, graph_query, limit)
+    groups = id_index.index_objects('groups', objects)
+    yield from stream_as_json(project(groups, projection(query)))
+
+
+def get_all_memberships(delta=None, limit=None):
+    """
+    Fetch and stream back group memberships from Azure AD via MS Graph API
+    Memberships are read from members@delta annotation of groups delta query, so incremental runs get only
+    added and removed members. Every membership is returned as separate entity, removed ones with _deleted = true
+    Memberships of deleted groups are not reported, groups dataset returns these groups as removed
+    :param delta: delta token or cursor from last request
+    :param limit: optional ResponseLimit, output ends at page boundary when reached
+    :return: generated JSON output with all fetched memberships
+    """
+
+    def __edges(groups):
+        # last edge is held back, delta token or cursor is given to the last group which may have no edges
+        last_edge = None
+        last_updated = None
+        for group in groups:
+            last_updated = group.get('_updated')
+            if '@removed' in group:
+                continue
+            for member in group.get('members@delta') or []:
+                if last_edge is not None:
+                    yield last_edge
+                member_type = member.get('@odata.type', '').split('.')[-1] or None
+                last_edge = {
+                    '_id': f'{group["id"]}_{member["id"]}',
+                    '_updated': group['_updated'],
+                    '_deleted': '@removed' in member,
+                    'groupId': group['id'],
+                    'memberId': member['id'],
+                    'memberType': member_type
+                }
+        if last_edge is not None:
+            last_edge['_updated'] = last_updated
+            yield last_edge
+
+    groups = get_all_objects(f'{RESOURCE_PATH}delta', delta, {'$select': 'members'}, limit)
+    yield from stream_as_json(__edges(groups))
+
+
+def _is_reference_exists_error(response_body: dict) -> bool:
+    """
+    Check if member can't be added because it is already member of the group
+    """
+    return 'already exist' in (response_body or {}).get('error', {}).get('message', '')
+
+
+def sync_membership_array(membership_array):
+    """
+    Function to synchronize group memberships from Sesam into Azure Active Directory
+    Every entity is one membership with groupId and memberId (object id of user, group, device etc.)
+    Added members of the same group are bound with one update of max MEMBERS_PER_REQUEST members@odata.bind
+    references, memberships with _deleted property = true are removed one by one,
+    all requests are sent in JSON batches.
+    If bulk add fails because some members are already in group, members of that update are added one by one
+    and existing ones are reported as skipped, removal of missing membership is reported as skipped as well
+    :param membership_array: iterable with membership objects
+    :return: summary with per-entity results
+    """
+
+    def __member_url(membership):
+        return f'{GRAPH_URL}/directoryObjects/{membership["memberId"]}'
+
+    def __sync_chunk(memberships, summary):
+        additions = {}
+        operations = []
+        for membership in memberships:
+            if not membership.get('groupId') or not membership.get('memberId'):
+                summary.add(membership, 'failed', 'groupId and memberId are required')
+            elif membership.get('_deleted'):
+                logging.info(f'trying to remove {membership["memberId"]} from group {membership["groupId"]}')
+                operations.append(([membership], 'removed', {
+                    'method': 'DELETE',
+                    'url': f'{RESOURCE_PATH}{membership["groupId"]}/members/{membership["memberId"]}/$ref'}))
+            else:
+                additions.setdefault(membership['groupId'], []).append(membership)
+
+        for group_id, members in additions.items():
+            for start in range(0, len(members), MEMBERS_PER_REQUEST):
+                chunk = members[start:start + MEMBERS_PER_REQUEST]
+                logging.info(f'trying to add {len(chunk)} members to group {group_id}')
+                operations.append((chunk, 'added', {
+                    'method': 'PATCH',
+                    'url': f'{RESOURCE_PATH}{group_id}',
+                    'body': {'members@odata.bind': [__member_url(m) for m in chunk]}}))
+
+        retries = []
+        for (chunk, status, request), response in zip(operations, make_batch_request([op[2] for op in operations])):
+            if response is None:
+                for membership in chunk:
+                    summary.add(membership, 'failed', MISSING_RESPONSE_ERROR)
+            elif response['status'] < 400:
+                logging.info(f'{request["method"]} {request["url"]} completed successfully')
+                for membership in chunk:
+                    summary.add(membership, status)
+            elif status == 'removed' and response['status'] == 404:
+                summary.add(chunk[0], 'skipped')
+            elif status == 'added' and _is_reference_exists_error(response['body']):
+                retries.extend(chunk)
+            else:
+                for membership in chunk:
+                    summary.add(membership, 'failed', response['body'])
+
+        single_adds = [{'method': 'POST', 'url': f'{RESOURCE_PATH}{m["groupId"]}/members/$ref',
+                        'body': {'@odata.id': __member_url(m)}} for m in retries]
+        for membership, response in zip(retries, make_batch_request(single_adds)):
+            if response is None:
+                summary.add(membership, 'failed', MISSING_RESPONSE_ERROR)
+            elif response['status'] < 400:
+                summary.add(membership, 'added')
+            elif _is_reference_exists_error(response['body']):
+                summary.add(membership, 'skipped')
+            else:
+                summary.add(membership, 'failed', response['body'])
+
+    # memberships of one group go to the same lane and chunk is as big as one JSON batch of full updates,
+    # so members of the same group are bound together
+    return run_sink(membership_array, lambda m: m.get('_id') or f'{m.get("groupId")}_{m.get("memberId")}',
+                    __sync_chunk, BATCH_SIZE * MEMBERS_PER_REQUEST, lambda m: m.get('groupId'))
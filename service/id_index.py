@@ -0,0 +1,139 @@
+import logging
+import os
+
+import local_store
+from str_utils import str_to_bool
+
+"""
+Set to false to disable local index and always try to create entity first
+"""
+ID_INDEX_ENABLED = str_to_bool(os.environ.get('ID_INDEX_ENABLED', 'true'))
+
+"""
+Attributes unique in Azure AD used to find Graph object id for entities without id.
+Only one attribute per kind, lookup never falls back to attributes which may be shared by several objects
+(mailNickname of users, displayName of groups), so new entity is never matched to an unrelated object
+"""
+INDEXED_ATTRIBUTES = {
+    'users': ['userPrincipalName'],
+    'groups': ['mailNickname']
+}
+
+"""
+Attributes which must be fetched from Graph to keep index up to date, mailNickname is unique only for
+mail-enabled groups
+"""
+FETCHED_ATTRIBUTES = {
+    'users': ['userPrincipalName'],
+    'groups': ['mailNickname', 'mailEnabled']
+}
+
+# number of index rows written at once when index is filled from delta feed
+FLUSH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS id_index (
+    kind TEXT NOT NULL,
+    attribute TEXT NOT NULL,
+    value TEXT NOT NULL,
+    object_id TEXT NOT NULL,
+    PRIMARY KEY (kind, attribute, value)
+);
+CREATE INDEX IF NOT EXISTS id_index_object ON id_index (kind, object_id);
+"""
+
+
+def _is_indexable(kind: str, entity: dict) -> bool:
+    return kind != 'groups' or entity.get('mailEnabled') is True
+
+
+def _rows(kind: str, entity: dict, object_id: str) -> list:
+    if not _is_indexable(kind, entity):
+        return []
+    return [(kind, attribute, str(entity[attribute]).lower(), object_id)
+            for attribute in INDEXED_ATTRIBUTES[kind] if entity.get(attribute)]
+
+
+def lookup(kind: str, entity: dict):
+    """
+    Find Graph object id for given entity by its unique attribute, groups are looked up only if mail-enabled
+    :param kind: users or groups
+    :param entity: entity from Sesam
+    :return: object id or None if entity is not known
+    """
+    if not ID_INDEX_ENABLED or not _is_indexable(kind, entity):
+        return None
+
+    local_store.ensure_schema('id_index', SCHEMA)
+    for attribute in INDEXED_ATTRIBUTES[kind]:
+        if entity.get(attribute):
+            rows = local_store.execute('SELECT object_id FROM id_index WHERE kind = ? AND attribute = ? AND value = ?',
+                                       (kind, attribute, str(entity[attribute]).lower()))
+            if rows:
+                return rows[0][0]
+    return None
+
+
+def remember(kind: str, entity: dict, object_id: str) -> None:
+    """
+    Store unique attributes of entity with its Graph object id
+    :param kind: users or groups
+    :param entity: entity with some of indexed attributes
+    :param object_id: Graph object id
+    """
+    if not ID_INDEX_ENABLED or not object_id:
+        return
+
+    local_store.ensure_schema('id_index', SCHEMA)
+    local_store.execute_many('INSERT OR REPLACE INTO id_index VALUES (?, ?, ?, ?)', _rows(kind, entity, object_id))
+
+
+def forget(kind: str, object_id: str) -> None:
+    """
+    Remove all index entries for given object
+    """
+    if not ID_INDEX_ENABLED:
+        return
+
+    local_store.ensure_schema('id_index', SCHEMA)
+    local_store.execute('DELETE FROM id_index WHERE kind = ? AND object_id = ?', (kind, object_id))
+
+
+def index_objects(kind: str, objects):
+    """
+    Pass objects through and keep index up to date with them. Used with delta feeds so
+    index is kept warm incrementally on every fetch
+    :param kind: users or groups
+    :param objects: objects from MS Graph
+    :return: generator with the same objects
+    """
+    if not ID_INDEX_ENABLED:
+        yield from objects
+        return
+
+    local_store.ensure_schema('id_index', SCHEMA)
+    rows = []
+    removed = []
+
+    def __flush():
+        try:
+            if removed:
+                local_store.execute_many('DELETE FROM id_index WHERE kind = ? AND object_id = ?', removed)
+            if rows:
+                local_store.execute_many('INSERT OR REPLACE INTO id_index VALUES (?, ?, ?, ?)', rows)
+        except Exception:
+            logging.exception('failed to update id index')
+        rows.clear()
+        removed.clear()
+
+    try:
+        for item in objects:
+            if '@removed' in item:
+                removed.append((kind, item['id']))
+            else:
+                rows.extend(_rows(kind, item, item['id']))
+            if len(rows) + len(removed) >= FLUSH_SIZE:
+                __flush()
+            yield item
+    finally:
+        __flush()
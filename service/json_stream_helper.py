@@ -0,0 +1,195 @@
+import codecs
+import json
+import os
+import time
+
+import trace_helper
+from metrics_helper import ENTITIES
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, stdlib encoder is used without it
+    orjson = None
+
+"""
+Number of bytes read from request body at once
+"""
+READ_CHUNK_SIZE = int(os.environ.get('READ_CHUNK_SIZE', str(64 * 1024)))
+
+"""
+Approximate number of bytes collected before chunk of streamed response is sent
+"""
+WRITE_CHUNK_SIZE = int(os.environ.get('WRITE_CHUNK_SIZE', str(64 * 1024)))
+
+# attribute with the same value for consecutive items (since value or cursor of their page), it's encoded once per value
+SPLICED_ATTRIBUTE = '_updated'
+
+__decoder = json.JSONDecoder()
+__encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+WHITESPACE = ' \t\n\r'
+# characters which may continue a number, e.g. "0" read so far may be "0.1" or "0e5"
+NUMBER_CHARS = '0123456789+-.eE'
+
+
+def iter_json_array(stream, chunk_size: int = READ_CHUNK_SIZE):
+    """
+    Parse JSON array from binary stream incrementally and yield its items as soon as they are read,
+    so only one item (plus one read chunk) is kept in memory at time.
+    Top level JSON object is yielded as single item
+    :param stream: file like object with read(size) method returning bytes
+    :param chunk_size: number of bytes to read at once
+    :return: generator with decoded items
+    """
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    eof = False
+    started = False
+
+    def __read_more():
+        nonlocal buffer, pos, eof
+        data = stream.read(chunk_size)
+        if not data:
+            eof = True
+            data = b''
+        buffer = buffer[pos:] + utf8_decoder.decode(data, final=eof)
+        pos = 0
+
+    def __skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            __read_more()
+
+    __skip_whitespace()
+    if pos >= len(buffer):
+        return
+
+    if buffer[pos] != '[':
+        # not an array, decode whole body as one value
+        while not eof:
+            __read_more()
+        yield json.loads(buffer[pos:])
+        return
+
+    pos += 1
+    while True:
+        __skip_whitespace()
+        if pos >= len(buffer):
+            raise ValueError('unexpected end of JSON array')
+
+        if buffer[pos] == ']':
+            pos += 1
+            __skip_whitespace()
+            if pos < len(buffer):
+                raise ValueError(f'unexpected data after JSON array: "{buffer[pos]}"')
+            return
+
+        if started:
+            if buffer[pos] != ',':
+                raise ValueError(f'expected "," or "]" in JSON array, got "{buffer[pos]}"')
+            pos += 1
+            __skip_whitespace()
+
+        while True:
+            try:
+                item, end = __decoder.raw_decode(buffer, pos)
+                # item ending at the end of buffer (number or literal) or number followed by a character which
+                # may continue it (e.g. "0" followed by ".") is complete only when next chunk is read
+                if eof or (end < len(buffer) and
+                           not (type(item) in (int, float) and buffer[end] in NUMBER_CHARS)):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            __read_more()
+
+        pos = end
+        started = True
+        yield item
+
+
+def dumps(value) -> bytes:
+    """
+    Encode value as compact UTF-8 JSON, orjson is used if installed
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass  # e.g. integers out of 64 bit range, stdlib encoder handles them
+    return __encoder.encode(value).encode('utf-8')
+
+
+def _encode_item(item, fragments: dict) -> bytes:
+    """
+    Encode one item, SPLICED_ATTRIBUTE is taken from fragments cache instead of being encoded again
+    """
+    if type(item) is not dict or type(item.get(SPLICED_ATTRIBUTE)) is not str:
+        return dumps(item)
+
+    value = item.pop(SPLICED_ATTRIBUTE)
+    try:
+        body = dumps(item)
+    finally:
+        item[SPLICED_ATTRIBUTE] = value
+
+    fragment = fragments.get(value)
+    if fragment is None:
+        # values of previous pages are never seen again
+        fragments.clear()
+        fragment = fragments[value] = dumps(SPLICED_ATTRIBUTE) + b':' + dumps(value)
+
+    if body == b'{}':
+        return b'{' + fragment + b'}'
+    return body[:-1] + b',' + fragment + b'}'
+
+
+def iter_json_chunks(items, chunk_size: int = WRITE_CHUNK_SIZE):
+    """
+    Encode items as JSON array and yield it in chunks of about chunk_size bytes,
+    so a large response is written with few big writes instead of several tiny writes per item
+    :param items: iterable with JSON serializable items
+    :param chunk_size: number of bytes collected before chunk is yielded
+    :return: generator with bytes
+    """
+    fragments = {}
+    buffer = bytearray(b'[')
+    first = True
+    count = 0
+    # time spent encoding items of current chunk, only measured for traced requests
+    tracing = trace_helper.active()
+    encoding = 0.0
+
+    for item in items:
+        if first:
+            first = False
+        else:
+            buffer += b','
+        if tracing:
+            started = time.perf_counter()
+            buffer += _encode_item(item, fragments)
+            encoding += time.perf_counter() - started
+        else:
+            buffer += _encode_item(item, fragments)
+        count += 1
+
+        if len(buffer) >= chunk_size:
+            ENTITIES.inc(value=count)
+            if tracing:
+                trace_helper.add_span('serialize', time.perf_counter() - encoding, encoding, entities=count,
+                                      bytes=len(buffer))
+                encoding = 0.0
+            count = 0
+            yield bytes(buffer)
+            buffer = bytearray()
+
+    ENTITIES.inc(value=count)
+    buffer += b']'
+    if tracing:
+        trace_helper.add_span('serialize', time.perf_counter() - encoding, encoding, entities=count, bytes=len(buffer))
+    yield bytes(buffer)
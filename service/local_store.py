@@ -0,0 +1,93 @@
+import logging
+import os
+import sqlite3
+import threading
+
+"""
+Path to SQLite database used to keep service state (id index, checkpoints etc.) between runs
+Mount a volume and point this variable to it to keep state between container restarts
+State may contain access tokens, so database is created readable by service user only
+"""
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', os.path.join(os.path.expanduser('~'), '.azure-ad', 'state.sqlite'))
+
+__connection = None
+__lock = threading.RLock()
+__initialized_schemas = set()
+
+
+def _create_private_file(path: str) -> None:
+    """
+    Create database file (and its directory) accessible by current user only, journal files created by SQLite
+    get the same permissions
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+    if os.stat(path).st_mode & 0o077:
+        try:
+            os.chmod(path, 0o600)
+        except OSError as e:
+            logging.warning(f'state database {path} is accessible by other users and can\'t be restricted: {e}')
+
+
+def _get_connection() -> sqlite3.Connection:
+    global __connection
+    if __connection is None:
+        _create_private_file(STATE_DB_PATH)
+        __connection = sqlite3.connect(STATE_DB_PATH, check_same_thread=False, timeout=30, isolation_level=None)
+        __connection.execute('PRAGMA journal_mode=WAL')
+        __connection.execute('PRAGMA synchronous=NORMAL')
+    return __connection
+
+
+def ensure_schema(name: str, ddl: str) -> None:
+    """
+    Create tables needed by some component, DDL is executed only once per process
+    :param name: component name
+    :param ddl: SQL script with CREATE TABLE IF NOT EXISTS statements
+    """
+    if name in __initialized_schemas:
+        return
+    with __lock:
+        _get_connection().executescript(ddl)
+        __initialized_schemas.add(name)
+
+
+def execute(sql: str, params=()) -> list:
+    """
+    Execute single SQL statement in shared connection
+    :param sql: SQL statement
+    :param params: statement parameters
+    :return: list of fetched rows
+    """
+    with __lock:
+        return _get_connection().execute(sql, params).fetchall()
+
+
+def execute_many(sql: str, params_list: list) -> None:
+    """
+    Execute SQL statement for every parameter set in one transaction
+    :param sql: SQL statement
+    :param params_list: list of statement parameters
+    """
+    with __lock:
+        connection = _get_connection()
+        connection.execute('BEGIN')
+        try:
+            connection.executemany(sql, params_list)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+
+def close() -> None:
+    """
+    Close shared connection, called on shutdown so WAL is checkpointed
+    """
+    global __connection
+    with __lock:
+        if __connection is not None:
+            __connection.close()
+            __connection = None
@@ -1,11 +1,17 @@
 import logging
+import time
 from functools import wraps
-from flask import request
+from flask import request, Response
+
+import trace_helper
+from metrics_helper import METRICS_ENABLED, ENDPOINT_LATENCY, RESPONSE_BYTES
 
 
 def log_request(request_func):
     """
     Simple request logging decorator
+    Also records endpoint latency (until response body is sent) and size of response in metrics
+    and traces the request if asked with trace=true query parameter or X-Trace header
     :param request_func: request to be processed
     :return: Response object
     """
@@ -13,6 +19,53 @@ def log_request(request_func):
     @wraps(request_func)
     def logging_decorator(*args, **kwargs):
         logging.info(f"{request.method} request to endpoint {request_func.__name__} for {request.path}")
-        return request_func(*args, **kwargs)
+        endpoint = request_func.__name__
+        method = request.method
+        path = request.path
+        trace = trace_helper.start(endpoint) if trace_helper.is_requested(request.args, request.headers) else None
+        if trace is None:
+            trace_helper.clear()
+        started = time.perf_counter()
+
+        def __finish(status: int) -> None:
+            duration = time.perf_counter() - started
+            if METRICS_ENABLED:
+                ENDPOINT_LATENCY.observe(duration, endpoint, method, status)
+            if trace is not None:
+                trace.add(f'{method} {path}', started, duration, {'endpoint': endpoint, 'status': status})
+                trace_helper.finish(trace)
+
+        try:
+            response = request_func(*args, **kwargs)
+        except Exception:
+            __finish(500)
+            raise
+
+        if not isinstance(response, Response):
+            __finish(200)
+            return response
+
+        if METRICS_ENABLED:
+            if response.is_streamed:
+                response.response = _count_bytes(response.response, endpoint)
+            else:
+                RESPONSE_BYTES.inc(endpoint, value=response.calculate_content_length() or 0)
+
+        if trace is not None:
+            response.headers['X-Trace-Id'] = trace.id
+
+        # called by WSGI server when whole body is sent or client disconnected
+        response.call_on_close(lambda: __finish(response.status_code))
+        return response
 
     return logging_decorator
+
+
+def _count_bytes(body, endpoint: str):
+    try:
+        for chunk in body:
+            RESPONSE_BYTES.inc(endpoint, value=len(chunk))
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
@@ -0,0 +1,164 @@
+import os
+import re
+import threading
+from bisect import bisect_left
+
+from str_utils import str_to_bool
+
+"""
+Set to false to disable collecting of metrics, /metrics endpoint returns empty response then
+"""
+METRICS_ENABLED = str_to_bool(os.environ.get('METRICS_ENABLED', 'true'))
+
+PREFIX = 'azure_ad_'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+_collectors = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonic counter with optional labels
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.label_names = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *label_values, value: float = 1) -> None:
+        if not METRICS_ENABLED:
+            return
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def render(self) -> list:
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_values, value in values:
+            lines.append(f'{self.name}{_labels(self.label_names, label_values)} {_format(value)}')
+        return lines
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets and optional labels
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.label_names = labels
+        self.buckets = tuple(sorted(buckets))
+        # per labels: [count in every bucket (not cumulative) + overflow, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *label_values) -> None:
+        if not METRICS_ENABLED:
+            return
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def render(self) -> list:
+        with self.lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="' + _format(bound) + '"'
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, label_values, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, label_values)} {_format(total)}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, label_values)} {cumulative}')
+        return lines
+
+
+def register_stats(name: str, documentation: str, label: str, get_stats) -> None:
+    """
+    Expose counters kept by other modules (e.g. rate_limiter.get_stats) as one labeled counter
+    :param name: metric name without prefix
+    :param documentation: metric description
+    :param label: name of label holding stats keys
+    :param get_stats: function returning dict with counter names and values
+    """
+    _collectors.append((PREFIX + name, documentation, label, get_stats))
+
+
+def render() -> str:
+    """
+    :return: all metrics in Prometheus text exposition format
+    """
+    if not METRICS_ENABLED:
+        return ''
+
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for name, documentation, label, get_stats in _collectors:
+        lines.extend([f'# HELP {name} {documentation}', f'# TYPE {name} counter'])
+        for key, value in sorted(get_stats().items()):
+            lines.append(f'{name}{{{label}="{_escape(key)}"}} {_format(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+_id_segment = re.compile(r'\$?[a-z][a-zA-Z.]*')
+
+
+def resource_template(path: str) -> str:
+    """
+    Replace object ids in Graph URL path with {id}, so metrics are not labeled with every object
+    e.g. /planner/plans/xqQg5FS2LkCp935s/details -> /planner/plans/{id}/details
+    :param path: URL path without query
+    :return: templated path
+    """
+    return '/'.join(segment if not segment or _id_segment.fullmatch(segment) else '{id}'
+                    for segment in path.split('/'))
+
+
+"""
+Metrics collected by service
+"""
+ENDPOINT_LATENCY = Histogram('http_request_duration_seconds', 'Time from request start until response is sent',
+                             ('endpoint', 'method', 'status'))
+RESPONSE_BYTES = Counter('http_response_bytes_total', 'Bytes sent in response bodies', ('endpoint',))
+RESPONSE_UNCOMPRESSED_BYTES = Counter('http_response_uncompressed_bytes_total',
+                                      'Bytes of compressed response bodies before compression',
+                                      ('endpoint', 'encoding'))
+GRAPH_LATENCY = Histogram('graph_request_duration_seconds', 'Latency of MS Graph requests (every attempt)',
+                          ('resource', 'method', 'status'))
+TOKEN_LATENCY = Histogram('token_request_duration_seconds', 'Time spent fetching Oauth2 tokens')
+GRAPH_RESPONSE_BYTES = Counter('graph_response_bytes_total', 'Bytes of MS Graph responses as received on the wire',
+                               ('resource', 'encoding'))
+PAGES = Counter('graph_pages_total', 'Pages fetched from MS Graph collections', ('resource',))
+ENTITIES = Counter('entities_streamed_total', 'Entities encoded and streamed to clients')
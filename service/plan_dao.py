@@ -1,20 +1,60 @@
+import os
+from itertools import chain
+
 import requests
 
-from dao_helper import get_all_objects, get_object
+import async_dao_helper
+from async_dao_helper import ASYNC_GRAPH_CLIENT, ASYNC_CONCURRENCY
+from dao_helper import get_all_objects, get_object, get_objects, get_current_credential, BATCH_SIZE
+from pool_helper import imap_ordered, chunked
+
+"""
+Number of concurrent workers used to fetch plans, tasks and their details
+1 means sequential fetching
+"""
+PLANNER_WORKERS = int(os.environ.get('PLANNER_WORKERS', '8'))
+
+"""
+Max number of groups/plans/tasks being fetched ahead of the consumer
+"""
+PLANNER_BUFFER_SIZE = int(os.environ.get('PLANNER_BUFFER_SIZE', str(4 * PLANNER_WORKERS)))
+
+# detail batches in flight with async client, so the number of detail requests in flight stays within ASYNC_CONCURRENCY
+ASYNC_BATCH_WINDOW = max(1, ASYNC_CONCURRENCY // BATCH_SIZE)
 
 
 def get_plans(group_generator_func):
-    for group in group_generator_func:
-        for plan in get_plans_for_group(group['id']):
-            plan['details'] = get_plan_details(plan['id'])
-            yield (plan)
+    if ASYNC_GRAPH_CLIENT:
+        yield from async_dao_helper.iterate_sync(
+            _get_plans_async(async_dao_helper.from_sync(group_generator_func), get_current_credential()))
+        return
+
+    def __with_details(plans):
+        for plan, details in zip(plans, get_objects([f'/planner/plans/{plan["id"]}/details' for plan in plans])):
+            plan['details'] = details
+        return plans
+
+    plan_lists = imap_ordered(lambda group: list(get_plans_for_group(group['id'])), group_generator_func,
+                              PLANNER_WORKERS, PLANNER_BUFFER_SIZE)
+    plan_chunks = chunked(chain.from_iterable(plan_lists), BATCH_SIZE)
+    yield from chain.from_iterable(imap_ordered(__with_details, plan_chunks, PLANNER_WORKERS, PLANNER_WORKERS))
 
 
 def get_tasks(plan_generator_func):
-    for plan in plan_generator_func:
-        for task in get_tasks_for_plan(plan['id']):
-            task['details'] = get_task_details(task['id'])
-            yield task
+    if ASYNC_GRAPH_CLIENT:
+        yield from async_dao_helper.iterate_sync(
+            _get_tasks_async(async_dao_helper.from_sync(plan_generator_func), get_current_credential()))
+        return
+
+    def __with_details(tasks):
+        for task, details in zip(tasks, get_objects([f'/planner/tasks/{task["id"]}/details' for task in tasks])):
+            task['details'] = details
+        return tasks
+
+    task_lists = imap_ordered(lambda plan: list(get_tasks_for_plan(plan['id'])), plan_generator_func,
+                              PLANNER_WORKERS, PLANNER_BUFFER_SIZE)
+    task_chunks = chunked(chain.from_iterable(task_lists), BATCH_SIZE)
+    yield from chain.from_iterable(imap_ordered(__with_details, task_chunks, PLANNER_WORKERS, PLANNER_WORKERS))
 
 
 def get_tasks_for_plan(plan_id):
@@ -35,3 +75,53 @@ def get_plan_details(plan_id):
 
 def get_task_details(task_id):
     return get_object(f'/planner/tasks/{task_id}/details')
+
+
+async def _get_plans_async(groups, credential):
+    """
+    Async version of get_plans, plan lists are fetched with up to ASYNC_CONCURRENCY requests in flight,
+    details are fetched in JSON batches through response cache
+    """
+
+    async def __plans_for_group(group):
+        try:
+            return [plan async for plan in
+                    async_dao_helper.get_all_objects(f'/groups/{group["id"]}/planner/plans', credential)]
+        except requests.exceptions.HTTPError:
+            # already logged in make_request function, no action needed
+            return []
+
+    async def __with_details(plans):
+        paths = [f'/planner/plans/{plan["id"]}/details' for plan in plans]
+        for plan, details in zip(plans, await async_dao_helper.get_objects(paths)):
+            plan['details'] = details
+        return plans
+
+    plans = async_dao_helper.flatten(async_dao_helper.ordered_map(__plans_for_group, groups))
+    plan_chunks = async_dao_helper.chunked(plans, BATCH_SIZE)
+    async for plan in async_dao_helper.flatten(async_dao_helper.ordered_map(__with_details, plan_chunks,
+                                                                            ASYNC_BATCH_WINDOW)):
+        yield plan
+
+
+async def _get_tasks_async(plans, credential):
+    """
+    Async version of get_tasks, task lists are fetched with up to ASYNC_CONCURRENCY requests in flight,
+    details are fetched in JSON batches through response cache
+    """
+
+    async def __tasks_for_plan(plan):
+        return [task async for task in
+                async_dao_helper.get_all_objects(f'/planner/plans/{plan["id"]}/tasks', credential)]
+
+    async def __with_details(tasks):
+        paths = [f'/planner/tasks/{task["id"]}/details' for task in tasks]
+        for task, details in zip(tasks, await async_dao_helper.get_objects(paths)):
+            task['details'] = details
+        return tasks
+
+    tasks = async_dao_helper.flatten(async_dao_helper.ordered_map(__tasks_for_plan, plans))
+    task_chunks = async_dao_helper.chunked(tasks, BATCH_SIZE)
+    async for task in async_dao_helper.flatten(async_dao_helper.ordered_map(__with_details, task_chunks,
+                                                                            ASYNC_BATCH_WINDOW)):
+        yield task
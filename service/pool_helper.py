@@ -0,0 +1,193 @@
+import contextvars
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def imap_ordered(func, iterable, workers: int, buffer_size: int = None):
+    """
+    Apply function to every item of iterable in a thread pool and yield results in the input order
+    Function is called in a copy of the caller context
+    At most buffer_size items are in flight (submitted but not yet consumed) so memory stays bounded
+    even for endless input and slow consumer
+    :param func: function to apply, called with one item
+    :param iterable: input items, consumed lazily
+    :param workers: number of worker threads, 1 or less means sequential processing in the caller thread
+    :param buffer_size: max number of in-flight items, defaults to 2 * workers
+    :return: generator with results in the same order as input
+    """
+    if workers <= 1:
+        yield from map(func, iterable)
+        return
+
+    buffer_size = max(buffer_size or 2 * workers, workers)
+    in_flight = deque()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for item in iterable:
+            in_flight.append(executor.submit(contextvars.copy_context().run, func, item))
+            if len(in_flight) >= buffer_size:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def chunked(iterable, size: int, key=None):
+    """
+    Split iterable into lists of max given size
+    If key function given then chunk is also closed before an item with key already present in it,
+    so items with the same key never end up in the same chunk and keep their relative order
+    :param iterable: input items, consumed lazily
+    :param size: max chunk size
+    :param key: optional function to get item key
+    :return: generator with lists of items
+    """
+    chunk = []
+    keys = set()
+
+    for item in iterable:
+        item_key = key(item) if key else None
+        if len(chunk) >= size or (key and item_key in keys):
+            yield chunk
+            chunk = []
+            keys = set()
+
+        chunk.append(item)
+        if key:
+            keys.add(item_key)
+
+    if chunk:
+        yield chunk
+
+
+def process_in_lanes(iterable, key, handler, workers: int, chunk_size: int, queue_size: int = None,
+                     lane_key=None) -> None:
+    """
+    Process items concurrently in lanes. Every lane is a worker thread with its own bounded queue,
+    items with the same key always go to the same lane so they are processed in input order.
+    Lane collects up to chunk_size already queued items (never two with the same key) and passes them to handler
+    :param iterable: input items, consumed lazily, producer is blocked when lane queue is full
+    :param key: function to get item key
+    :param handler: function called with list of items, exceptions raised by handler are re-raised in caller thread
+    :param workers: number of lanes, 1 or less means sequential processing in the caller thread
+    :param chunk_size: max number of items passed to handler at once
+    :param queue_size: max number of items waiting in every lane, defaults to 2 * chunk_size
+    :param lane_key: optional function choosing lane instead of key, it must give the same value for items
+    with the same key. Used to process related items (e.g. members of one group) together
+    :return: nothing, handler is responsible for collecting results
+    """
+    if workers <= 1:
+        for chunk in chunked(iterable, chunk_size, key):
+            handler(chunk)
+        return
+
+    stop = object()
+    queues = [queue.Queue(maxsize=queue_size or 2 * chunk_size) for _ in range(workers)]
+    errors = []
+
+    def __lane(lane_queue):
+        carry = None
+        while True:
+            item = carry if carry is not None else lane_queue.get()
+            carry = None
+            if item is stop:
+                return
+
+            chunk, keys = [item], {key(item)}
+            while len(chunk) < chunk_size:
+                try:
+                    item = lane_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is stop or key(item) in keys:
+                    carry = item
+                    break
+                chunk.append(item)
+                keys.add(key(item))
+
+            if not errors:
+                try:
+                    handler(chunk)
+                except Exception as e:
+                    errors.append(e)
+
+    # every lane runs in its own copy of caller context so context variables (e.g. credential) are visible there
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(__lane, q), daemon=True)
+               for q in queues]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for item in iterable:
+            if errors:
+                break
+            queues[hash((lane_key or key)(item)) % workers].put(item)
+    finally:
+        for lane_queue in queues:
+            lane_queue.put(stop)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def merge_concurrently(sources, workers: int, buffer_size: int):
+    """
+    Consume several iterables concurrently and yield their items in the order they arrive
+    Every source is consumed in a worker thread running in a copy of the caller context,
+    at most buffer_size items wait for the consumer, sources are blocked while buffer is full
+    :param sources: list of functions without arguments returning iterables
+    :param workers: max number of sources consumed at the same time
+    :param buffer_size: max number of items waiting to be yielded
+    :return: generator with items of all sources, exceptions raised by sources are re-raised in caller thread
+    """
+    done = object()
+    items = queue.Queue(maxsize=max(buffer_size, 1))
+    stopped = threading.Event()
+
+    def __put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __consume(source):
+        if stopped.is_set():
+            return
+        try:
+            for item in source():
+                if not __put((None, item)):
+                    return
+        except Exception as e:
+            __put((e, None))
+        finally:
+            __put((done, None))
+
+    executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+    try:
+        for source in sources:
+            executor.submit(contextvars.copy_context().run, __consume, source)
+
+        remaining = len(sources)
+        while remaining:
+            error, item = items.get()
+            if error is done:
+                remaining -= 1
+            elif error is not None:
+                raise error
+            else:
+                yield item
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True)
@@ -0,0 +1,102 @@
+import json
+import os
+from urllib.parse import urlencode, quote
+
+"""
+Default OData query options per dataset, JSON object with dataset name (user, group or resource path
+used in /datasets/<path>/entities) and query options for it, for example
+{"user": {"$select": "id,displayName,userPrincipalName"}, "group": {"$filter": "securityEnabled eq true"}}
+Query parameters select, filter, expand and top of the request override these values
+"""
+DATASET_QUERY_OPTIONS = json.loads(os.environ.get('DATASET_QUERY_OPTIONS', '{}'))
+
+OPTION_NAMES = ('$select', '$filter', '$expand', '$top')
+
+# attributes which are kept in projected objects regardless of $select
+ALWAYS_PROJECTED = ('id', '_id', '_updated', '@removed', '@odata.type')
+
+
+def get_query_options(dataset: str, args) -> dict:
+    """
+    Collect OData query options for dataset from configuration and request arguments
+    :param dataset: dataset name
+    :param args: request arguments
+    :return: dict with option names ($select etc.) and values, options without value are omitted
+    """
+    options = {name: value for name, value in DATASET_QUERY_OPTIONS.get(dataset, {}).items() if name in OPTION_NAMES}
+    for name in OPTION_NAMES:
+        value = args.get(name[1:])
+        if value:
+            options[name] = value
+    return options
+
+
+def with_selected(query: dict, attributes) -> dict:
+    """
+    Add attributes to $select of query, used when service needs attributes not requested by client
+    :return: new query dict, query without $select already returns all default attributes and is returned as is
+    """
+    if not query.get('$select'):
+        return query
+    selected = _split(query['$select'])
+    return {**query, '$select': ','.join(selected + [a for a in attributes if a not in selected])}
+
+
+def build_url(url: str, query: dict) -> str:
+    """
+    Append encoded query options to URL
+    """
+    if not query:
+        return url
+    return f'{url}{"&" if "?" in url else "?"}{urlencode(query, safe="$,()", quote_via=quote)}'
+
+
+def projection(query: dict):
+    """
+    Find attributes to keep in objects fetched with given query
+    :return: set of attribute names or None if query has no $select
+    """
+    if not query or not query.get('$select'):
+        return None
+    fields = set(_split(query['$select']))
+    # expanded navigation properties, e.g. manager($select=id) -> manager
+    fields.update(item.split('(')[0].strip() for item in _split(query.get('$expand', '')))
+    fields.update(ALWAYS_PROJECTED)
+    return fields
+
+
+def project(objects, fields):
+    """
+    Strip attributes not listed in fields from objects
+    :param objects: iterable with objects from MS Graph
+    :param fields: set of attributes to keep or None to pass objects through unchanged
+    :return: generator with projected objects
+    """
+    if fields is None:
+        yield from objects
+        return
+
+    for item in objects:
+        yield {key: value for key, value in item.items() if key in fields}
+
+
+def _split(value: str) -> list:
+    """
+    Split comma separated list, commas inside parentheses (nested options of $expand) are kept
+    """
+    items = []
+    depth = 0
+    current = ''
+    for char in value:
+        if char == ',' and depth == 0:
+            items.append(current.strip())
+            current = ''
+            continue
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        current += char
+    if current.strip():
+        items.append(current.strip())
+    return [item for item in items if item]
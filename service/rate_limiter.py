@@ -0,0 +1,143 @@
+import os
+import random
+import threading
+import time
+
+"""
+Client side rate limiter settings
+RATE_LIMIT_INITIAL - requests per second allowed for every tenant/resource pair at start
+RATE_LIMIT_MIN - lowest rate limiter may go down to after throttling
+RATE_LIMIT_MAX - highest rate limiter may go up to after successful requests
+RATE_LIMIT_BURST - max number of requests which may be sent at once after idle period
+RATE_LIMIT_INCREASE - how much rate grows after every successful request
+RATE_LIMIT_DECREASE - multiplier applied to rate after throttled request
+THROTTLE_WINDOW - seconds after rate cut in which other throttled requests don't cut the rate again
+THROTTLE_MAX_RETRIES - how many times throttled request will be retried before dropping it
+THROTTLE_BACKOFF_BASE - base for exponential backoff when Retry-After header is not present
+THROTTLE_BACKOFF_MAX - max number of seconds to wait between retries
+"""
+INITIAL_RATE = float(os.environ.get('RATE_LIMIT_INITIAL', '50'))
+MIN_RATE = float(os.environ.get('RATE_LIMIT_MIN', '1'))
+MAX_RATE = float(os.environ.get('RATE_LIMIT_MAX', '200'))
+BURST = float(os.environ.get('RATE_LIMIT_BURST', '20'))
+RATE_INCREASE = float(os.environ.get('RATE_LIMIT_INCREASE', '0.5'))
+RATE_DECREASE = float(os.environ.get('RATE_LIMIT_DECREASE', '0.5'))
+MAX_RETRIES = int(os.environ.get('THROTTLE_MAX_RETRIES', '6'))
+BACKOFF_BASE = float(os.environ.get('THROTTLE_BACKOFF_BASE', '1'))
+BACKOFF_MAX = float(os.environ.get('THROTTLE_BACKOFF_MAX', '120'))
+THROTTLE_WINDOW = float(os.environ.get('THROTTLE_WINDOW', '1'))
+
+THROTTLE_STATUSES = (429, 503)
+
+
+class RateLimiter:
+    """
+    Adaptive token bucket. Rate grows additively with every successful request and is cut multiplicatively
+    on throttling (at most once per THROTTLE_WINDOW), so it settles just under the Graph limit.
+    Throttling also pauses all requests until Retry-After is passed
+    """
+
+    def __init__(self, rate: float = INITIAL_RATE):
+        self.rate = rate
+        self.tokens = min(BURST, rate)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.cut_at = float('-inf')
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """
+        Take one token if available
+        :return: 0 if request may be sent now or number of seconds to wait before next try
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(BURST, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+    def acquire(self) -> None:
+        """
+        Block until request may be sent
+        """
+        wait = self.try_acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    def on_success(self) -> None:
+        with self.lock:
+            self.rate = min(MAX_RATE, self.rate + RATE_INCREASE)
+
+    def on_throttle(self, retry_after: float = None, share: float = 1.0) -> None:
+        """
+        :param retry_after: seconds all requests are paused for
+        :param share: part of the request which was throttled (e.g. throttled items of JSON batch envelope),
+        rate is cut proportionally
+        """
+        with self.lock:
+            now = time.monotonic()
+            # requests sent at the old rate are throttled together, only the first of them cuts the rate
+            if now - self.cut_at >= THROTTLE_WINDOW:
+                self.rate = max(MIN_RATE, self.rate * (1 - (1 - RATE_DECREASE) * share))
+                self.cut_at = now
+            self.tokens = min(self.tokens, 0)
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+
+__limiters = {}
+__limiters_lock = threading.Lock()
+
+__stats = {'requests': 0, 'throttled': 0, 'retried': 0, 'dropped': 0}
+__stats_lock = threading.Lock()
+
+
+def get_limiter(tenant_id: str, resource: str) -> RateLimiter:
+    """
+    Get shared rate limiter for given tenant and resource, limiter is created on first use
+    :param tenant_id: Azure tenant id
+    :param resource: top level Graph resource (users, groups, planner etc.)
+    :return: rate limiter object
+    """
+    key = (tenant_id, resource)
+    limiter = __limiters.get(key)
+    if limiter is None:
+        with __limiters_lock:
+            limiter = __limiters.setdefault(key, RateLimiter())
+    return limiter
+
+
+def count(counter: str, value: int = 1) -> None:
+    """
+    Increment one of requests/throttled/retried/dropped counters
+    """
+    with __stats_lock:
+        __stats[counter] += value
+
+
+def get_stats() -> dict:
+    """
+    :return: copy of rate limiter counters
+    """
+    with __stats_lock:
+        return dict(__stats)
+
+
+def backoff_delay(retry_after, attempt: int) -> float:
+    """
+    Calculate how long to wait before next attempt.
+    Value from Retry-After header is used if present, exponential backoff with full jitter otherwise
+    :param retry_after: value of Retry-After header or None
+    :param attempt: number of current attempt starting from 1
+    :return: number of seconds to wait
+    """
+    try:
+        return min(float(retry_after), BACKOFF_MAX)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
@@ -0,0 +1,148 @@
+import logging
+import os
+from urllib.parse import urlparse, parse_qs
+
+import checkpoint_store
+from dao_helper import GRAPH_URL, make_request, _get_tenant_id
+from metrics_helper import PAGES, resource_template
+from pool_helper import merge_concurrently
+from query_helper import build_url, with_selected
+from str_utils import str_to_bool
+from trace_helper import span
+
+"""
+Segmented full sync settings
+SEGMENTED_FULL_SYNC - fetch first (full) sync of users and groups as parallel segments of non-delta collection
+FULL_SYNC_WORKERS - number of segments fetched at the same time
+FULL_SYNC_BOUNDARIES - comma separated values splitting key space (userPrincipalName or displayName) into segments
+FULL_SYNC_PAGE_SIZE - page size ($top) of segment requests, max 999
+FULL_SYNC_BUFFER_PAGES - max number of fetched pages waiting to be streamed
+"""
+SEGMENTED_FULL_SYNC = str_to_bool(os.environ.get('SEGMENTED_FULL_SYNC', 'false'))
+FULL_SYNC_WORKERS = int(os.environ.get('FULL_SYNC_WORKERS', '8'))
+FULL_SYNC_BOUNDARIES = [b for b in os.environ.get('FULL_SYNC_BOUNDARIES', ','.join('bcdefghijklmnopqrstuvwxyz'))
+                        .split(',') if b]
+FULL_SYNC_PAGE_SIZE = min(int(os.environ.get('FULL_SYNC_PAGE_SIZE', '999')), 999)
+FULL_SYNC_BUFFER_PAGES = int(os.environ.get('FULL_SYNC_BUFFER_PAGES', str(2 * FULL_SYNC_WORKERS)))
+
+# attributes supporting ge/le filters which are used to split collections into segments
+SEGMENT_ATTRIBUTES = {
+    'users': 'userPrincipalName',
+    'groups': 'displayName'
+}
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _segment_filters(attribute: str, boundaries: list) -> list:
+    """
+    Build $filter for every segment. Graph supports only ge/le on these attributes so neighbour segments
+    overlap on exact boundary values, objects with such values are deduplicated while streaming
+    :return: list of filter expressions covering whole key space
+    """
+    bounds = [None] + sorted(set(boundaries)) + [None]
+    filters = []
+    for lower, upper in zip(bounds, bounds[1:]):
+        conditions = []
+        if lower is not None:
+            conditions.append(f'{attribute} ge {_quote(lower)}')
+        if upper is not None:
+            conditions.append(f'{attribute} le {_quote(upper)}')
+        filters.append(' and '.join(conditions))
+    return filters
+
+
+def get_latest_delta(resource_path: str, query: dict = None) -> str:
+    """
+    Get delta token for current state of resource without reading it, changes made while segments are fetched
+    are returned by next incremental run started with this token
+    Received delta link is saved as checkpoint, so next run reuses it with all query options
+    :param resource_path: path to collection, e.g. /users/
+    :param query: query options the delta token must keep ($select etc.)
+    :return: delta token
+    """
+    delta_path = f'{resource_path}delta'
+    url = build_url(GRAPH_URL + delta_path, {**(query or {}), '$deltatoken': 'latest'})
+    while True:
+        result = make_request(url, 'get')
+        if result.get('@odata.deltaLink'):
+            break
+        url = result['@odata.nextLink']
+
+    delta_link = result['@odata.deltaLink']
+    delta = parse_qs(urlparse(delta_link).query)['$deltatoken'][0]
+    checkpoint_store.save_delta(_get_tenant_id(), build_url(delta_path, query), delta, delta_link)
+    return delta
+
+
+def get_all_objects_segmented(kind: str, resource_path: str, query: dict = None):
+    """
+    Fetch all objects of collection in parallel segments and stream them back as one stream
+    Objects are yielded in the order pages arrive, delta token for next run is set as _updated of the last page only,
+    so interrupted stream is started from scratch the same way as interrupted delta query
+    :param kind: users or groups
+    :param resource_path: path to collection, e.g. /users/
+    :param query: OData query options, $filter is combined with segment filters
+    :return: generator with all objects
+    """
+    query = dict(query or {})
+    delta = get_latest_delta(resource_path, query)
+
+    attribute = SEGMENT_ATTRIBUTES[kind]
+    # segment attribute is needed to find duplicates on boundaries
+    query = with_selected(query, [attribute])
+    user_filter = query.pop('$filter', None)
+    query.setdefault('$top', FULL_SYNC_PAGE_SIZE)
+    boundaries = {b.lower() for b in FULL_SYNC_BOUNDARIES}
+    seen_on_boundary = set()
+
+    def __pages(segment_filter):
+        def __fetch():
+            segment_query = dict(query)
+            if segment_filter:
+                segment_query['$filter'] = f'({user_filter}) and {segment_filter}' if user_filter else segment_filter
+            url = build_url(GRAPH_URL + resource_path, segment_query)
+            while url is not None:
+                with span('page', resource=page_template, segment=segment_filter) as page_span:
+                    result = make_request(url, 'get')
+                    page_span['entities'] = len(result.get('value') or [])
+                PAGES.inc(page_template)
+                if type(result.get('value')) != list:
+                    raise ValueError(f'value object expected in response to url: {url} got {result}')
+                yield result['value']
+                url = result.get('@odata.nextLink')
+        return __fetch
+
+    def __is_duplicate(item) -> bool:
+        value = item.get(attribute)
+        if not isinstance(value, str) or value.lower() not in boundaries:
+            return False
+        if item['id'] in seen_on_boundary:
+            return True
+        seen_on_boundary.add(item['id'])
+        return False
+
+    page_template = resource_template(resource_path)
+    filters = _segment_filters(attribute, list(boundaries))
+    logging.info(f'fetching {resource_path} in {len(filters)} segments')
+
+    held = None
+    for page in merge_concurrently([__pages(f) for f in filters], FULL_SYNC_WORKERS, FULL_SYNC_BUFFER_PAGES):
+        page = [item for item in page if not __is_duplicate(item)]
+        if not page:
+            continue
+        if held:
+            yield from _stamp(held, None)
+        held = page
+
+    if held:
+        yield from _stamp(held, delta)
+
+
+def _stamp(items: list, delta):
+    for item in items:
+        item['_updated'] = delta
+        item['_id'] = item['id']
+        yield item
@@ -5,15 +5,27 @@ import datetime
 import os
 import json
 import uuid
+from functools import wraps
 from flask import Flask, Response, request as r, redirect, session
 
 from auth_helper import get_authorize_url, get_token_with_auth_code, add_token_to_cache
+from async_dao_helper import ASYNC_GRAPH_CLIENT, iterate_sync, get_all_objects as async_get_all_objects
 from plan_dao import get_plans, get_tasks
 from str_utils import str_to_bool
 from user_dao import sync_user_array, get_all_users
-from group_dao import sync_group_array, get_all_groups
-from dao_helper import init_dao, get_all_objects, init_dao_on_behalf_on, stream_as_json
+from group_dao import sync_group_array, get_all_groups, sync_membership_array, get_all_memberships
+from dao_helper import init_dao, get_all_objects, init_dao_on_behalf_on, stream_as_json, GRAPH_URL
+from json_stream_helper import iter_json_array
 from logger_helper import log_request
+from compression_helper import compress_response
+from cursor_helper import ResponseLimit, is_cursor, decode_cursor
+import async_dao_helper
+import cache_helper
+import local_store
+import metrics_helper
+import rate_limiter
+import trace_helper
+from query_helper import get_query_options, projection, project
 
 env = os.environ.get
 
@@ -24,54 +36,132 @@ CT = 'application/json'
 
 SUPPORTS_SINCE = str_to_bool(env('SUPPORTS_SINCE', 'false'))
 
+# respond with 500 to sink requests where some entities failed so Sesam retries the batch
+SINK_FAIL_ON_ERRORS = str_to_bool(env('SINK_FAIL_ON_ERRORS', 'true'))
+
+"""
+Server settings
+WSGI_SERVER - cherrypy (one process) or gunicorn (SERVER_WORKERS processes)
+SERVER_WORKERS - number of worker processes for gunicorn, defaults to number of CPU cores
+SERVER_THREADS - number of request handling threads in every process
+SERVER_GRACEFUL_TIMEOUT - seconds running requests may take to finish after stop signal
+SERVER_KEEP_ALIVE - seconds to wait for next request on keep-alive connection (gunicorn)
+AUTORELOAD - restart server when source files change, for development only
+"""
+WSGI_SERVER = env('WSGI_SERVER', 'cherrypy').lower()
+SERVER_WORKERS = int(env('SERVER_WORKERS', str(os.cpu_count() or 1)))
+SERVER_THREADS = int(env('SERVER_THREADS', '10'))
+SERVER_GRACEFUL_TIMEOUT = int(env('SERVER_GRACEFUL_TIMEOUT', '30'))
+SERVER_KEEP_ALIVE = int(env('SERVER_KEEP_ALIVE', '5'))
+AUTORELOAD = str_to_bool(env('AUTORELOAD', 'false'))
+
+metrics_helper.register_stats('graph_rate_limiter_events_total', 'Graph requests sent, throttled, retried and dropped',
+                              'event', rate_limiter.get_stats)
+metrics_helper.register_stats('response_cache_events_total', 'Response cache hits, misses, revalidations and evictions',
+                              'event', cache_helper.get_stats)
+
 # used to encrypt user sessions
 APP.secret_key = uuid.uuid4().bytes
 
 
+def check_since(request_func):
+    """
+    Decorator rejecting requests with invalid since cursor or limit before response is streamed
+    """
+
+    @wraps(request_func)
+    def check_decorator(*args, **kwargs):
+        try:
+            decode_cursor(r.args.get('since'), GRAPH_URL)
+            ResponseLimit.from_args(r.args)
+        except ValueError as e:
+            return Response(json.dumps({'error': str(e)}), status=400, content_type=CT)
+        return request_func(*args, **kwargs)
+
+    return check_decorator
+
+
 @APP.route('/datasets/user/entities', methods=['GET'])
 @log_request
+@check_since
+@compress_response
 def list_users():
     """
     Endpoint to fetch all users from Azure AD via MS graph API
-    :request_argument since - delta token returned from last request (if exist)
+    :request_argument since - delta token or cursor returned from last request (if exist)
+    :request_argument select, filter, expand, top - OData query options, see DATASET_QUERY_OPTIONS
+    :request_argument limit, limit_seconds - end response at page boundary after given number of entities or seconds
     :return: JSON array with fetched users
     """
     init_dao(env('client_id'), env('client_secret'), env('tenant_id'))
-    return Response(get_all_users(r.args.get('since')), content_type=CT)
+    return Response(get_all_users(r.args.get('since'), get_query_options('user', r.args),
+                                  ResponseLimit.from_args(r.args)), content_type=CT)
 
 
 @APP.route('/datasets/group/entities', methods=['GET'])
 @log_request
+@check_since
+@compress_response
 def list_groups():
     """
     Endpoint to fetch all groups from Azure AD via MS graph API
-    :request_argument since - delta token returned from last request (if exist)
+    :request_argument since - delta token or cursor returned from last request (if exist)
+    :request_argument select, filter, expand, top - OData query options, see DATASET_QUERY_OPTIONS
+    :request_argument limit, limit_seconds - end response at page boundary after given number of entities or seconds
     :return: JSON array with fetched groups
     """
     init_dao(env('client_id'), env('client_secret'), env('tenant_id'))
-    return Response(get_all_groups(r.args.get('since')), content_type=CT)
+    return Response(get_all_groups(r.args.get('since'), get_query_options('group', r.args),
+                                   ResponseLimit.from_args(r.args)), content_type=CT)
+
+
+@APP.route('/datasets/membership/entities', methods=['GET'])
+@log_request
+@check_since
+@compress_response
+def list_memberships():
+    """
+    Endpoint to fetch group memberships from Azure AD via MS graph API, one entity per group member
+    :request_argument since - delta token or cursor returned from last request (if exist)
+    :request_argument limit, limit_seconds - end response at page boundary after given number of entities or seconds
+    :return: JSON array with memberships, removed memberships have _deleted = true
+    """
+    init_dao(env('client_id'), env('client_secret'), env('tenant_id'))
+    return Response(get_all_memberships(r.args.get('since'), ResponseLimit.from_args(r.args)), content_type=CT)
 
 
 @APP.route('/datasets/<path:kind>/entities', methods=['GET'])
 @log_request
+@check_since
+@compress_response
 def list_objects(kind):
     """
     Endpoint to fetch all objects of given type from MS graph API
-    :request_argument since - delta token returned from last request (if exist)
+    :request_argument since - delta token or cursor returned from last request (if exist)
+    :request_argument select, filter, expand, top - OData query options, see DATASET_QUERY_OPTIONS
+    :request_argument limit, limit_seconds - end response at page boundary after given number of entities or seconds
     :return: JSON array with fetched groups
     """
     if r.args.get('auth') and r.args.get('auth') == 'user':
-        init_dao_on_behalf_on(env('client_id'), env('client_secret'), env('tenant_id'), env('username'),
-                              env('password'))
+        credential = init_dao_on_behalf_on(env('client_id'), env('client_secret'), env('tenant_id'),
+                                           env('username'), env('password'))
     else:
-        init_dao(env('client_id'), env('client_secret'), env('tenant_id'))
-    return Response(
-        stream_as_json(get_all_objects(f'/{kind}/{"delta" if SUPPORTS_SINCE else ""}', r.args.get('since'))),
-        content_type=CT)
+        credential = init_dao(env('client_id'), env('client_secret'), env('tenant_id'))
+
+    resource_path = f'/{kind}/{"delta" if SUPPORTS_SINCE else ""}'
+    query = get_query_options(kind, r.args)
+    limit = ResponseLimit.from_args(r.args)
+    # limited responses and cursors are served by sync client only
+    if ASYNC_GRAPH_CLIENT and limit is None and not is_cursor(r.args.get('since')):
+        objects = iterate_sync(async_get_all_objects(resource_path, credential, r.args.get('since'), query))
+    else:
+        objects = get_all_objects(resource_path, r.args.get('since'), query, limit)
+    return Response(stream_as_json(project(objects, projection(query))), content_type=CT)
 
 
 @APP.route('/planner/plans/entities', methods=['GET'])
 @log_request
+@compress_response
 def list_all_plans():
     """
     Endpoint to list all plans from Microsoft Planner service
@@ -87,6 +177,7 @@ def list_all_plans():
 
 @APP.route('/planner/tasks/entities', methods=['GET'])
 @log_request
+@compress_response
 def list_all_tasks():
     if r.args.get('auth') and r.args.get('auth') == 'user':
         init_dao_on_behalf_on(env('client_id'), env('client_secret'), env('tenant_id'), env('username'),
@@ -101,15 +192,17 @@ def list_all_tasks():
 def post_users():
     """
     Endpoint to synchronize users from Sesam into Azure AD
-    :return: 200 empty response if everything OK
+    :request_argument force_resync - send full payload even for users not changed since last write
+    :return: 200 response with per-entity summary if everything OK, 500 with the same summary if some entities failed
     """
     if r.args.get('auth') and r.args.get('auth') == 'user':
         init_dao_on_behalf_on(env('client_id'), env('client_secret'), env('tenant_id'), env('username'),
                               env('password'))
     else:
         init_dao(env('client_id'), env('client_secret'), env('tenant_id'))
-    sync_user_array(json.loads(r.data))
-    return Response('')
+    summary = sync_user_array(iter_json_array(r.stream), str_to_bool(r.args.get('force_resync', 'false')))
+    return Response(json.dumps(summary.as_dict()), status=500 if summary.failed() and SINK_FAIL_ON_ERRORS else 200,
+                    content_type=CT)
 
 
 @APP.route('/datasets/group', methods=['POST'])
@@ -117,15 +210,64 @@ def post_users():
 def post_groups():
     """
     Endpoint to synchronize groups from Sesam into Azure AD
-    :return: 200 empty response if everything OK
+    :request_argument force_resync - send full payload even for groups not changed since last write
+    :return: 200 response with per-entity summary if everything OK, 500 with the same summary if some entities failed
     """
     if r.args.get('auth') and r.args.get('auth') == 'user':
         init_dao_on_behalf_on(env('client_id'), env('client_secret'), env('tenant_id'), env('username'),
                               env('password'))
     else:
         init_dao(env('client_id'), env('client_secret'), env('tenant_id'))
-    sync_group_array(json.loads(r.data))
-    return Response('')
+    summary = sync_group_array(iter_json_array(r.stream), str_to_bool(r.args.get('force_resync', 'false')))
+    return Response(json.dumps(summary.as_dict()), status=500 if summary.failed() and SINK_FAIL_ON_ERRORS else 200,
+                    content_type=CT)
+
+
+@APP.route('/datasets/membership', methods=['POST'])
+@log_request
+def post_memberships():
+    """
+    Endpoint to synchronize group memberships from Sesam into Azure AD
+    :return: 200 response with per-entity summary if everything OK, 500 with the same summary if some entities failed
+    """
+    if r.args.get('auth') and r.args.get('auth') == 'user':
+        init_dao_on_behalf_on(env('client_id'), env('client_secret'), env('tenant_id'), env('username'),
+                              env('password'))
+    else:
+        init_dao(env('client_id'), env('client_secret'), env('tenant_id'))
+    summary = sync_membership_array(iter_json_array(r.stream))
+    return Response(json.dumps(summary.as_dict()), status=500 if summary.failed() and SINK_FAIL_ON_ERRORS else 200,
+                    content_type=CT)
+
+
+@APP.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Endpoint with service metrics in Prometheus text format
+    :return: metrics of this process
+    """
+    return Response(metrics_helper.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@APP.route('/debug/traces', methods=['GET'])
+def list_traces():
+    """
+    Endpoint listing traces of last traced requests
+    :return: JSON array with trace ids and names
+    """
+    return Response(json.dumps(trace_helper.list_traces()), content_type=CT)
+
+
+@APP.route('/debug/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    """
+    Endpoint returning one trace in Chrome trace format (load it in chrome://tracing or https://ui.perfetto.dev)
+    :return: JSON object with trace events
+    """
+    trace = trace_helper.get_trace(trace_id)
+    if trace is None:
+        return Response(json.dumps({'error': f'trace {trace_id} not found'}), status=404, content_type=CT)
+    return Response(json.dumps(trace.as_chrome_trace()), content_type=CT)
 
 
 @APP.route('/auth', methods=['GET'])
@@ -154,12 +296,67 @@ def auth_user():
 
         token = get_token_with_auth_code(tenant, client_id, client_secret, code, redir_url)
         if 'access_token' in token:
-            add_token_to_cache(client_id, tenant, token)
+            add_token_to_cache(client_id, tenant, token, client_secret)
             return Response(json.dumps({'status': 'ok', 'message': 'token acquired'}), content_type=CT)
         else:
             raise ValueError("token response malformed")
 
 
+def shutdown():
+    """
+    Release resources of this process, called when server stops
+    """
+    async_dao_helper.close()
+    local_store.close()
+
+
+def run_cherrypy():
+    import cherrypy
+
+    cherrypy.tree.graft(APP, '/')
+    cherrypy.config.update({
+        'environment': 'production',
+        'engine.autoreload_on': AUTORELOAD,
+        'log.screen': False,
+        'server.socket_port': PORT,
+        'server.socket_host': '0.0.0.0',
+        'server.thread_pool': SERVER_THREADS,
+        'server.shutdown_timeout': SERVER_GRACEFUL_TIMEOUT,
+        'server.max_request_body_size': 0
+    })
+
+    # stop gracefully on SIGTERM/SIGINT
+    cherrypy.engine.signals.subscribe()
+    cherrypy.engine.subscribe('stop', shutdown)
+    cherrypy.engine.start()
+    cherrypy.engine.block()
+
+
+def run_gunicorn():
+    """
+    Run SERVER_WORKERS processes with SERVER_THREADS threads each. Processes are forked from this one
+    after the application is loaded, state shared between them (tokens, checkpoints, id index) is kept in
+    local state database
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class __Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'0.0.0.0:{PORT}')
+            self.cfg.set('workers', SERVER_WORKERS)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', SERVER_THREADS)
+            self.cfg.set('graceful_timeout', SERVER_GRACEFUL_TIMEOUT)
+            self.cfg.set('keepalive', SERVER_KEEP_ALIVE)
+            self.cfg.set('reload', AUTORELOAD)
+            self.cfg.set('worker_exit', lambda server, worker: shutdown())
+
+        def load(self):
+            return APP
+
+    __Server().run()
+
+
 if __name__ == '__main__':
     """
     Application entry point
@@ -170,19 +367,7 @@ if __name__ == '__main__':
 
     if IS_DEBUG_ENABLED:
         APP.run(debug=IS_DEBUG_ENABLED, host='0.0.0.0', port=PORT)
+    elif WSGI_SERVER == 'gunicorn':
+        run_gunicorn()
     else:
-        import cherrypy
-
-        cherrypy.tree.graft(APP, '/')
-        cherrypy.config.update({
-            'environment': 'production',
-            'engine.autoreload_on': True,
-            'log.screen': False,
-            'server.socket_port': PORT,
-            'server.socket_host': '0.0.0.0',
-            'server.thread_pool': 10,
-            'server.max_request_body_size': 0
-        })
-
-        cherrypy.engine.start()
-        cherrypy.engine.block()
+        run_cherrypy()
@@ -0,0 +1,66 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from str_utils import str_to_bool
+
+"""
+Connection pool settings, all of them may be overridden with environment variables
+HTTP_POOL_CONNECTIONS - number of host pools to keep (one per Graph/login host is usually enough)
+HTTP_POOL_MAXSIZE - max number of kept alive connections per host, should be >= number of concurrent workers
+HTTP_MAX_RETRIES - how many times to retry on connection errors and 502/504 responses for idempotent methods
+(429 and 503 are handled by rate_limiter)
+HTTP_BACKOFF_FACTOR - backoff factor between retries (sleep = factor * 2 ^ (retry - 1))
+HTTP_KEEP_ALIVE - set to false to close connection after every request
+HTTP_TIMEOUT - connect and read timeout in seconds for every request
+GRAPH_ACCEPT_ENCODING - Accept-Encoding sent to MS Graph, responses are decoded transparently; identity disables
+compression
+"""
+POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '4'))
+POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '32'))
+MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '3'))
+BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', '0.5'))
+KEEP_ALIVE = str_to_bool(os.environ.get('HTTP_KEEP_ALIVE', 'true'))
+TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', '120'))
+ACCEPT_ENCODING = os.environ.get('GRAPH_ACCEPT_ENCODING', 'gzip, deflate')
+
+__session = None
+__session_lock = threading.Lock()
+
+
+def _create_session() -> requests.Session:
+    """
+    Function to build new session with pooled connection adapter mounted for http and https
+    :return: configured session object
+    """
+    retry = Retry(total=MAX_RETRIES, connect=MAX_RETRIES, read=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR,
+                  status_forcelist=(502, 504), raise_on_status=False, respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry,
+                          pool_block=False)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+
+    if not KEEP_ALIVE:
+        session.headers['Connection'] = 'close'
+
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Function to get shared HTTP session. Session is created lazily on first call and reused by all threads
+    so TCP and TLS connections are kept alive between Graph API calls
+    :return: shared session object
+    """
+    global __session
+    if __session is None:
+        with __session_lock:
+            if __session is None:
+                __session = _create_session()
+    return __session
@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+
+from dao_helper import BATCH_SIZE
+from pool_helper import process_in_lanes
+
+"""
+Number of concurrent lanes used to write entities received from Sesam, 1 means sequential writing
+"""
+SINK_WORKERS = int(os.environ.get('SINK_WORKERS', '4'))
+
+"""
+Max number of per-entity errors returned in sink response
+"""
+SINK_MAX_REPORTED_ERRORS = int(os.environ.get('SINK_MAX_REPORTED_ERRORS', '1000'))
+
+# error of entities whose request got no response in JSON batch
+MISSING_RESPONSE_ERROR = 'no response to the request in JSON batch'
+
+
+class SinkSummary:
+    """
+    Thread safe collector of per-entity sink results
+    Only counters and failed entities are kept so memory doesn't grow with batch size
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def add(self, entity: dict, status: str, error=None) -> None:
+        """
+        Register result for entity
+        :param entity: entity as received from Sesam
+        :param status: created/updated/disabled/deleted/failed or any other operation name
+        :param error: error message or response body for failed entities
+        """
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            if status == 'failed':
+                logging.error(f'failed to sync entity {entity.get("_id")}: {error}')
+                if len(self.errors) < SINK_MAX_REPORTED_ERRORS:
+                    self.errors.append({'_id': entity.get('_id'), 'error': error})
+
+    def failed(self) -> int:
+        return self.counts.get('failed', 0)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {'processed': sum(self.counts.values()), **self.counts, 'errors': list(self.errors)}
+
+
+class _ChunkSummary:
+    """
+    Summary view given to chunk handler, it remembers entities of the chunk which already have a result
+    """
+
+    def __init__(self, summary: SinkSummary):
+        self.summary = summary
+        self.recorded = set()
+
+    def add(self, entity: dict, status: str, error=None) -> None:
+        self.recorded.add(id(entity))
+        self.summary.add(entity, status, error)
+
+
+def run_sink(entities, key, chunk_handler, chunk_size: int = BATCH_SIZE, lane_key=None) -> SinkSummary:
+    """
+    Write entities to MS Graph concurrently. Entities with the same key are written in input order
+    :param entities: iterable with entities from Sesam
+    :param key: function to get entity key (id or other unique attribute)
+    :param chunk_handler: function called with list of max chunk_size entities and summary object,
+    it must register result of every entity in summary, entities without result are failed if handler raises
+    :param chunk_size: max number of entities passed to chunk_handler at once, defaults to one JSON batch
+    :param lane_key: optional function grouping entities which should be written by the same lane
+    :return: summary with per-entity results
+    """
+    summary = SinkSummary()
+
+    def __handle(chunk):
+        chunk_summary = _ChunkSummary(summary)
+        try:
+            chunk_handler(chunk, chunk_summary)
+        except Exception as e:
+            logging.exception('failed to sync chunk')
+            # entities written before the error keep their result, every entity is counted once
+            for entity in chunk:
+                if id(entity) not in chunk_summary.recorded:
+                    summary.add(entity, 'failed', str(e))
+
+    process_in_lanes(entities, key, __handle, SINK_WORKERS, chunk_size, lane_key=lane_key)
+    return summary
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# service modules are imported as top level modules, the same way service.py imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def state_db(tmp_path, monkeypatch):
+    """
+    Empty local state database used by the test only
+    """
+    import local_store
+    local_store.close()
+    monkeypatch.setattr(local_store, 'STATE_DB_PATH', str(tmp_path / 'state.sqlite'))
+    getattr(local_store, '__initialized_schemas').clear()
+    yield local_store.STATE_DB_PATH
+    local_store.close()
+    getattr(local_store, '__initialized_schemas').clear()
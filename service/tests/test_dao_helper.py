@@ -0,0 +1,158 @@
+import contextvars
+
+import pytest
+
+import cursor_helper
+import dao_helper
+import rate_limiter
+from auth_helper import Credential
+
+
+class FakeGraph:
+    """
+    Replacement of dao_helper.make_request answering $batch envelopes with given function
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.envelopes = []
+
+    def __call__(self, url, method, data=None, credential=None):
+        assert url == f'{dao_helper.GRAPH_URL}/$batch' and method == 'POST'
+        self.envelopes.append(data['requests'])
+        return {'responses': [{'id': request['id'], **self.respond(request)} for request in data['requests']]}
+
+
+class RecordingLimiter:
+    def __init__(self):
+        self.throttles = []
+
+    def on_throttle(self, retry_after=None, share=1.0):
+        self.throttles.append(share)
+
+
+@pytest.fixture
+def limiters(monkeypatch):
+    limiters = {}
+    monkeypatch.setattr(rate_limiter, 'get_limiter',
+                        lambda tenant_id, resource: limiters.setdefault(resource, RecordingLimiter()))
+    return limiters
+
+
+def install(monkeypatch, respond) -> FakeGraph:
+    graph = FakeGraph(respond)
+    monkeypatch.setattr(dao_helper, 'make_request', graph)
+    return graph
+
+
+def test_responses_are_returned_in_input_order_across_envelopes(monkeypatch, limiters):
+    graph = install(monkeypatch, lambda request: {'status': 200, 'body': {'url': request['url']}})
+    items = [{'method': 'GET', 'url': f'/users/{i}'} for i in range(dao_helper.BATCH_SIZE + 5)]
+
+    responses = dao_helper.make_batch_request(items)
+
+    assert [response['body']['url'] for response in responses] == [item['url'] for item in items]
+    assert [len(envelope) for envelope in graph.envelopes] == [dao_helper.BATCH_SIZE, 5]
+    assert not limiters
+
+
+def test_only_throttled_items_are_retried_and_envelope_is_throttled_once(monkeypatch, limiters):
+    attempts = {}
+
+    def respond(request):
+        attempts[request['url']] = attempts.get(request['url'], 0) + 1
+        if request['url'] in ('/users/1', '/users/2') and attempts[request['url']] == 1:
+            return {'status': 429, 'headers': {'Retry-After': '0'}, 'body': {}}
+        return {'status': 200, 'body': {'url': request['url']}}
+
+    graph = install(monkeypatch, respond)
+    items = [{'method': 'GET', 'url': f'/users/{i}'} for i in range(4)]
+
+    responses = dao_helper.make_batch_request(items)
+
+    assert [response['status'] for response in responses] == [200] * 4
+    assert [[request['url'] for request in envelope] for envelope in graph.envelopes][1] == ['/users/1', '/users/2']
+    assert limiters['$batch'].throttles == [0.5]
+    assert set(limiters) == {'$batch'}
+
+
+def test_throttled_items_are_given_up_after_max_retries(monkeypatch, limiters):
+    graph = install(monkeypatch, lambda request: {'status': 429, 'headers': {'Retry-After': '0'}, 'body': {}})
+
+    responses = dao_helper.make_batch_request([{'method': 'GET', 'url': '/users/1'}])
+
+    assert responses[0]['status'] == 429
+    assert len(graph.envelopes) == dao_helper.BATCH_MAX_RETRIES + 1
+
+
+def test_dependency_failed_in_previous_envelope_is_not_sent(monkeypatch, limiters):
+    graph = install(monkeypatch, lambda request: {'status': 400 if request['url'] == '/users/0' else 201,
+                                                  'body': {}})
+    items = [{'method': 'POST', 'url': f'/users/{i}', 'body': {}} for i in range(dao_helper.BATCH_SIZE)]
+    items.append({'method': 'POST', 'url': '/groups/0/members/$ref', 'body': {}, 'depends_on': [0]})
+
+    responses = dao_helper.make_batch_request(items)
+
+    assert responses[0]['status'] == 400
+    assert responses[-1]['status'] == 424
+    assert len(graph.envelopes) == 1
+
+
+def test_dependency_in_the_same_envelope_is_sent_as_depends_on(monkeypatch, limiters):
+    graph = install(monkeypatch, lambda request: {'status': 201, 'body': {}})
+    items = [{'method': 'POST', 'url': '/users', 'body': {'a': 1}},
+             {'method': 'POST', 'url': '/groups/0/members/$ref', 'body': {}, 'depends_on': [0]}]
+
+    dao_helper.make_batch_request(items)
+
+    first, second = graph.envelopes[0]
+    assert 'dependsOn' not in first and second['dependsOn'] == ['0']
+    assert first['headers']['Content-Type'] == 'application/json'
+
+
+def test_not_allowed_method_is_rejected(monkeypatch, limiters):
+    install(monkeypatch, lambda request: {'status': 200, 'body': {}})
+    with pytest.raises(Exception):
+        dao_helper.make_batch_request([{'method': 'HEAD', 'url': '/users/1'}])
+
+
+def test_cached_details_are_not_shared_between_credentials(monkeypatch, limiters):
+    graph = install(monkeypatch, lambda request: {'status': 200, 'body': {'seen_by': len(graph.envelopes)}})
+    credential = getattr(dao_helper, '__credential')
+    path = '/planner/tasks/t1/details'
+
+    def fetch(key):
+        credential.set(Credential('tenant', None, key))
+        return dao_helper.get_objects([path])[0]
+
+    app = contextvars.copy_context().run(fetch, ('tenant', 'client', 'app', None))
+    user = contextvars.copy_context().run(fetch, ('tenant', 'client', 'password', 'user@example.com'))
+    app_again = contextvars.copy_context().run(fetch, ('tenant', 'client', 'app', None))
+
+    assert app == app_again == {'seen_by': 1}
+    assert user == {'seen_by': 2}
+    assert len(graph.envelopes) == 2
+
+
+def test_interrupted_delta_run_continues_from_page_of_last_received_object(monkeypatch, state_db):
+    first = f'{dao_helper.GRAPH_URL}/users/delta'
+    second = f'{first}?$skiptoken=page2'
+    pages = {
+        first: {'value': [{'id': '1'}, {'id': '2'}], '@odata.nextLink': second},
+        second: {'value': [{'id': '3'}, {'id': '4'}], '@odata.deltaLink': f'{first}?$deltatoken=token'},
+    }
+    requested = []
+    monkeypatch.setattr(dao_helper, '_get_cached', lambda url: requested.append(url) or pages[url])
+    monkeypatch.setattr(dao_helper, '_get_tenant_id', lambda: 'tenant')
+    monkeypatch.setattr(dao_helper, 'PREFETCH_DEPTH', 0)
+
+    objects = [dict(item) for item in dao_helper.get_all_objects('/users/delta')]
+    assert [item['_updated'] for item in objects] == [cursor_helper.encode_cursor(first)] * 2 + [
+        cursor_helper.encode_cursor(second), 'token']
+
+    # client received objects 1-3 only, next run starts from page of object 3
+    requested.clear()
+    resumed = list(dao_helper.get_all_objects('/users/delta', objects[2]['_updated']))
+    assert requested == [second]
+    assert [item['id'] for item in resumed] == ['3', '4']
+    assert resumed[-1]['_updated'] == 'token'
@@ -0,0 +1,34 @@
+import json
+
+import group_dao
+
+
+def memberships(monkeypatch, groups) -> list:
+    monkeypatch.setattr(group_dao, 'get_all_objects', lambda resource_path, delta, query, limit: iter(groups))
+    return json.loads(b''.join(group_dao.get_all_memberships()))
+
+
+def test_last_membership_gets_token_of_last_group(monkeypatch):
+    groups = [
+        {'id': 'g1', '_updated': 'since', 'members@delta': [{'id': 'u1'}, {'id': 'u2', '@removed': {}}]},
+        {'id': 'g2', '_updated': 'since'},
+        {'id': 'g3', '_updated': 'delta-token', '@removed': {'reason': 'deleted'}},
+    ]
+
+    result = memberships(monkeypatch, groups)
+
+    assert [(m['_id'], m['_deleted'], m['_updated']) for m in result] == [
+        ('g1_u1', False, 'since'), ('g1_u2', True, 'delta-token')]
+
+
+def test_memberships_of_last_group_keep_its_token(monkeypatch):
+    groups = [
+        {'id': 'g1', '_updated': 'since', '@removed': {'reason': 'deleted'}},
+        {'id': 'g2', '_updated': 'cursor', 'members@delta': [
+            {'id': 'u1', '@odata.type': '#microsoft.graph.user'}, {'id': 'g3', '@odata.type': '#microsoft.graph.group'}]},
+    ]
+
+    result = memberships(monkeypatch, groups)
+
+    assert [(m['memberId'], m['memberType'], m['_updated']) for m in result] == [
+        ('u1', 'user', 'cursor'), ('g3', 'group', 'cursor')]
@@ -0,0 +1,60 @@
+import io
+import json
+
+import pytest
+
+from json_stream_helper import iter_json_array, iter_json_chunks
+
+
+def parse(text: str, chunk_size: int) -> list:
+    return list(iter_json_array(io.BytesIO(text.encode('utf-8')), chunk_size))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 4, 5, 7, 64])
+@pytest.mark.parametrize('text', [
+    '[0.1]',
+    '[1e5]',
+    '[1.5E-3, -0, 12345678901234567890]',
+    '[ {"a": [1, 2, {"b": null}]} , "x,]", true, false, null ]',
+    '["æøå ☃", {"emoji": "\U0001F600"}]',
+    '[]',
+    ' [1] \n',
+])
+def test_array_is_parsed_regardless_of_chunk_boundaries(text, chunk_size):
+    assert parse(text, chunk_size) == json.loads(text)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 64])
+def test_top_level_object_is_single_item(chunk_size):
+    assert parse('{"a": 1}', chunk_size) == [{'a': 1}]
+
+
+def test_empty_body_has_no_items():
+    assert parse('  ', 3) == []
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 64])
+@pytest.mark.parametrize('text', ['[{}]]', '[1] 2', '[1],'])
+def test_trailing_data_is_rejected(text, chunk_size):
+    with pytest.raises(ValueError):
+        parse(text, chunk_size)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 64])
+@pytest.mark.parametrize('text', ['[1', '[1,', '[{"a": 1}', '[1 2]', '[0.]'])
+def test_malformed_array_is_rejected(text, chunk_size):
+    with pytest.raises(ValueError):
+        parse(text, chunk_size)
+
+
+def test_items_are_yielded_before_whole_body_is_read():
+    stream = io.BytesIO(b'[{"id": 1}, {"id": 2}, ' + b' ' * 1000 + b'{"id": 3}]')
+    items = iter_json_array(stream, 16)
+    assert next(items) == {'id': 1}
+    assert stream.tell() < 100
+
+
+def test_chunks_are_valid_json_array():
+    items = [{'id': i, '_updated': 'token'} for i in range(100)] + [{'_updated': 'token'}, 1, None]
+    body = b''.join(iter_json_chunks(iter(items), 64))
+    assert json.loads(body) == items
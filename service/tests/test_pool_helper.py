@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from pool_helper import process_in_lanes
+
+
+class Recorder:
+    def __init__(self, fail_on=None):
+        self.chunks = []
+        self.lock = threading.Lock()
+        self.fail_on = fail_on
+
+    def __call__(self, chunk):
+        with self.lock:
+            self.chunks.append(list(chunk))
+        if self.fail_on is not None and self.fail_on in chunk:
+            raise RuntimeError(f'failed on {self.fail_on}')
+
+    def items(self):
+        return [item for chunk in self.chunks for item in chunk]
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_every_item_is_processed_once(workers):
+    handler = Recorder()
+    process_in_lanes(range(1000), lambda i: i, handler, workers, 20)
+    assert sorted(handler.items()) == list(range(1000))
+    assert max(len(chunk) for chunk in handler.chunks) <= 20
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_items_with_the_same_key_are_never_in_one_chunk_and_keep_order(workers):
+    items = [(i % 7, i) for i in range(500)]
+    handler = Recorder()
+
+    process_in_lanes(items, lambda item: item[0], handler, workers, 20)
+
+    for chunk in handler.chunks:
+        assert len({key for key, _ in chunk}) == len(chunk)
+    for key in range(7):
+        assert [i for k, i in handler.items() if k == key] == [i for k, i in items if k == key]
+
+
+def test_lane_key_keeps_related_items_in_one_lane():
+    items = [{'group': i % 3, 'member': i} for i in range(300)]
+    lanes = {}
+
+    def handler(chunk):
+        for item in chunk:
+            lanes.setdefault(item['group'], set()).add(threading.get_ident())
+
+    process_in_lanes(items, lambda item: (item['group'], item['member']), handler, 4, 20,
+                     lane_key=lambda item: item['group'])
+
+    assert all(len(threads) == 1 for threads in lanes.values())
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_handler_error_is_raised_in_caller(workers):
+    with pytest.raises(RuntimeError):
+        process_in_lanes(range(100), lambda i: i, Recorder(fail_on=50), workers, 10)
@@ -0,0 +1,20 @@
+import pytest
+
+import sink_helper
+from sink_helper import run_sink
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_entities_with_result_are_not_failed_when_handler_raises(monkeypatch, workers):
+    monkeypatch.setattr(sink_helper, 'SINK_WORKERS', workers)
+    entities = [{'_id': str(i)} for i in range(100)]
+
+    def handler(chunk, summary):
+        summary.add(chunk[0], 'created')
+        raise RuntimeError('write failed')
+
+    result = run_sink(entities, lambda e: e['_id'], handler, chunk_size=10).as_dict()
+
+    assert result['processed'] == len(entities)
+    assert result['created'] + result['failed'] == len(entities)
+    assert result['created'] >= 10
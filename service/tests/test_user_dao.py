@@ -0,0 +1,90 @@
+import itertools
+
+import pytest
+
+import sink_helper
+import user_dao
+
+
+class FakeUsers:
+    """
+    Replacement of make_batch_request keeping users in memory, users may be addressed by id or userPrincipalName
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.requests = []
+        self.ids = itertools.count(1)
+
+    def find(self, key: str):
+        return next((user for user in self.users.values() if key in (user['id'], user['userPrincipalName'])), None)
+
+    def __call__(self, batch_items):
+        responses = []
+        for item in batch_items:
+            self.requests.append(item)
+            if any(responses[d]['status'] >= 400 for d in item.get('depends_on', [])):
+                responses.append({'status': 424, 'headers': {}, 'body': {}})
+                continue
+            responses.append(self.handle(item['method'], item['url'].split('?')[0][len('/users/'):], item.get('body')))
+        return responses
+
+    def handle(self, method: str, key: str, body: dict) -> dict:
+        if method == 'POST':
+            if self.find(body['userPrincipalName']):
+                return {'status': 400, 'headers': {}, 'body': {'error': {
+                    'code': 'Request_BadRequest', 'details': [{'code': 'ObjectConflict'}]}}}
+            user = {**body, 'id': f'object-{next(self.ids)}'}
+            self.users[user['id']] = user
+            return {'status': 201, 'headers': {}, 'body': user}
+
+        user = self.find(key)
+        if user is None:
+            return {'status': 404, 'headers': {}, 'body': {}}
+        if method == 'PATCH':
+            user.update(body)
+            return {'status': 204, 'headers': {}, 'body': {}}
+        return {'status': 200, 'headers': {}, 'body': {'id': user['id']}}
+
+    def patches(self) -> list:
+        return [item['body'] for item in self.requests if item['method'] == 'PATCH']
+
+
+@pytest.fixture
+def graph(monkeypatch, state_db):
+    graph = FakeUsers()
+    monkeypatch.setattr(user_dao, 'make_batch_request', graph)
+    monkeypatch.setattr(sink_helper, 'SINK_WORKERS', 1)
+    return graph
+
+
+def sync(*users) -> dict:
+    result = user_dao.sync_user_array(list(users)).as_dict()
+    result.pop('errors')
+    return result
+
+
+USER = {'_id': 'u1', 'accountEnabled': True, 'displayName': 'User 1', 'mailNickname': 'user1',
+        'userPrincipalName': 'user1@example.com'}
+
+
+def test_disabled_user_is_enabled_again(graph):
+    assert sync(dict(USER)) == {'processed': 1, 'created': 1}
+    assert sync({**USER, '_deleted': True}) == {'processed': 1, 'disabled': 1}
+    assert graph.requests[-1]['url'] == '/users/object-1'
+
+    assert sync(dict(USER)) == {'processed': 1, 'updated': 1}
+    assert graph.patches()[-1] == {'accountEnabled': True}
+    assert graph.users['object-1']['accountEnabled'] is True
+
+    assert sync(dict(USER)) == {'processed': 1, 'skipped': 1}
+
+
+def test_existing_user_state_is_stored_under_object_id(graph):
+    graph.users['object-0'] = {**USER, 'id': 'object-0', 'displayName': 'Old name'}
+    graph.users['object-0'].pop('_id')
+
+    assert sync(dict(USER)) == {'processed': 1, 'updated': 1}
+    assert sync(dict(USER)) == {'processed': 1, 'skipped': 1}
+    assert sync({**USER, 'displayName': 'New name'}) == {'processed': 1, 'updated': 1}
+    assert graph.requests[-1] == {'method': 'PATCH', 'url': '/users/object-0', 'body': {'displayName': 'New name'}}
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+import time
+
+import local_store
+from str_utils import str_to_bool
+
+"""
+Set to true to store access tokens in local state database so all worker processes of the service use the same
+tokens instead of requesting their own (useful with gunicorn workers). Tokens are kept in process memory only by
+default. Refresh tokens are never stored, every process keeps its own
+"""
+SHARED_TOKEN_CACHE = str_to_bool(os.environ.get('SHARED_TOKEN_CACHE', 'false'))
+
+# long lived secrets which are not written to state database
+PRIVATE_FIELDS = ('refresh_token', 'id_token')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    cache_key TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+-- tokens stored by earlier versions kept refresh tokens
+DELETE FROM tokens WHERE token LIKE '%"refresh_token"%';
+"""
+
+
+def _hash_key(key: tuple) -> str:
+    # cache key contains client id and username, they are not stored as is
+    return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def load(key: tuple):
+    """
+    Load token stored by any worker process
+    :param key: credential cache key
+    :return: token object or None
+    """
+    if not SHARED_TOKEN_CACHE:
+        return None
+
+    local_store.ensure_schema('tokens', SCHEMA)
+    rows = local_store.execute('SELECT token FROM tokens WHERE cache_key = ?', (_hash_key(key),))
+    return json.loads(rows[0][0]) if rows else None
+
+
+def save(key: tuple, token: dict) -> None:
+    """
+    Store access token so other worker processes may use it, refresh token is not stored
+    :param key: credential cache key
+    :param token: token object
+    """
+    if not SHARED_TOKEN_CACHE or token is None:
+        return
+
+    shared = {k: v for k, v in token.items() if k not in PRIVATE_FIELDS}
+    local_store.ensure_schema('tokens', SCHEMA)
+    local_store.execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)',
+                        (_hash_key(key), json.dumps(shared), time.time()))
@@ -0,0 +1,156 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from str_utils import str_to_bool
+
+"""
+Request tracing settings
+TRACING_ENABLED - allow tracing of single requests with query parameter trace=true or header X-Trace: true
+TRACE_DIR - directory where traces are written as Chrome trace JSON files, traces are only kept in memory if not set
+TRACE_KEEP - number of last traces available through /debug/traces endpoint
+"""
+TRACING_ENABLED = str_to_bool(os.environ.get('TRACING_ENABLED', 'true'))
+TRACE_DIR = os.environ.get('TRACE_DIR')
+TRACE_KEEP = int(os.environ.get('TRACE_KEEP', '10'))
+
+# trace of the current request, worker threads started with pool_helper get copy of caller context
+__trace = contextvars.ContextVar('trace', default=None)
+__parent = contextvars.ContextVar('trace_parent', default=None)
+
+__traces = OrderedDict()
+__traces_lock = threading.Lock()
+
+
+class Trace:
+    """
+    Spans recorded for one request, stored as Chrome trace complete events
+    (https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU)
+    """
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.started = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, name: str, started: float, duration: float, args: dict) -> None:
+        event = {'name': name, 'cat': 'azure-ad', 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                 'ts': round((started - self.started) * 1e6, 1), 'dur': round(duration * 1e6, 1), 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    def as_chrome_trace(self) -> dict:
+        with self.lock:
+            events = list(self.events)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'id': self.id, 'name': self.name}}
+
+
+def is_requested(args, headers) -> bool:
+    """
+    Check if request asks for tracing
+    :param args: request arguments
+    :param headers: request headers
+    """
+    return TRACING_ENABLED and (str_to_bool(args.get('trace', 'false')) or
+                                str_to_bool(headers.get('X-Trace', 'false')))
+
+
+def start(name: str) -> Trace:
+    """
+    Start tracing in current context
+    :param name: trace name, e.g. endpoint
+    """
+    trace = Trace(name)
+    __trace.set(trace)
+    __parent.set(None)
+    return trace
+
+
+def clear() -> None:
+    """
+    Stop tracing in current context, called for every request so thread reused by WSGI server doesn't keep trace
+    """
+    __trace.set(None)
+    __parent.set(None)
+
+
+def active() -> bool:
+    return __trace.get() is not None
+
+
+@contextmanager
+def span(name: str, **args):
+    """
+    Record span in trace of current request, does nothing if request is not traced
+    :param name: span name
+    :param args: span attributes, yielded dict may be updated to add attributes known only at the end
+    """
+    trace = __trace.get()
+    if trace is None:
+        yield {}
+        return
+
+    span_id = uuid.uuid4().hex[:16]
+    args['span_id'] = span_id
+    args['parent_id'] = __parent.get()
+    token = __parent.set(span_id)
+    started = time.perf_counter()
+    try:
+        yield args
+    finally:
+        __parent.reset(token)
+        trace.add(name, started, time.perf_counter() - started, args)
+
+
+def add_span(name: str, started: float, duration: float, **args) -> None:
+    """
+    Record span measured by caller (e.g. sum of interleaved steps) in trace of current request
+    """
+    trace = __trace.get()
+    if trace is not None:
+        args['parent_id'] = __parent.get()
+        trace.add(name, started, duration, args)
+
+
+def finish(trace: Trace) -> None:
+    """
+    Store finished trace in memory and write it to TRACE_DIR
+    """
+    clear()
+    with __traces_lock:
+        __traces[trace.id] = trace
+        while len(__traces) > TRACE_KEEP:
+            __traces.popitem(last=False)
+
+    if TRACE_DIR:
+        path = os.path.join(TRACE_DIR, f'trace-{trace.id}.json')
+        try:
+            with open(path, 'w') as file:
+                json.dump(trace.as_chrome_trace(), file)
+            logging.info(f'trace of {trace.name} written to {path}')
+        except OSError:
+            logging.exception(f'failed to write trace to {path}')
+
+
+def get_trace(trace_id: str):
+    """
+    :return: stored Trace or None
+    """
+    with __traces_lock:
+        return __traces.get(trace_id)
+
+
+def list_traces() -> list:
+    """
+    :return: ids and names of stored traces, newest last
+    """
+    with __traces_lock:
+        return [{'id': trace.id, 'name': trace.name, 'spans': len(trace.events)} for trace in __traces.values()]
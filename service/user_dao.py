@@ -1,89 +1,174 @@
 import logging
 
-from dao_helper import get_all_objects, make_request, GRAPH_URL, is_object_already_exists_exception, \
+from dao_helper import get_all_objects, make_batch_request, is_object_already_exists_error, \
     clear_sesam_attributes, stream_as_json
+from query_helper import with_selected, projection, project
+from sink_helper import run_sink, SinkSummary, MISSING_RESPONSE_ERROR
+import change_store
+import id_index
+import segment_helper
 
 RESOURCE_PATH = '/users/'
 
 
-def sync_user_array(user_data_array: list) -> None:
+def sync_user_array(user_data_array, force_resync: bool = False) -> SinkSummary:
     """
     Function to synchronize user array from Sesam into Azure Active Directory
-    This function will try to create user first and update it if create operation failed
+    Users without id are looked up in local id index first and updated if found,
+    otherwise this function will try to create user first and update it if create operation failed
     This function will also disable users with _deleted property = true
-    :param user_data_array: array of user objects
-    :return: nothing if everything is OK
+    Requests are sent in JSON batches of max BATCH_SIZE users by SINK_WORKERS concurrent lanes
+    Only fields changed since last write are sent, users without changes are skipped
+    :param user_data_array: iterable with user objects
+    :param force_resync: send full payload even if nothing changed since last write
+    :return: summary with per-entity results
     """
 
-    def __try_create(user_data: dict) -> None:
+    def __get_user_id(user_data: dict) -> str:
+        user_id = user_data['id'] if user_data.get('id') else user_data.get('userPrincipalName')
+        if not user_id:
+            raise Exception("Couldn't find id for user, at least id or userPrincipalName needed")
+        return user_id
+
+    def __create_request(user_data: dict) -> dict:
         """
-        Internal function to create user
+        Internal function to build create user request
         :param user_data: json object with user details
-        :return: void
+        :return: batch request
         """
         logging.info(f'trying to create user {user_data.get("userPrincipalName")}')
-        make_request(f'{GRAPH_URL}{RESOURCE_PATH}', 'POST', user_data)
-        logging.info(f'user {user_data.get("userPrincipalName")} created successfully')
+        return {'method': 'POST', 'url': RESOURCE_PATH, 'body': user_data}
 
-    def __try_update(user_data: dict) -> None:
+    def __update_request(user_data: dict, user_id: str = None) -> dict:
         """
-        Internal function to update user
+        Internal function to build update user request
         Update user with passwordProfile is not possible without Directory.AccessAsUser.All
         which is not exist in "application" permission so we need to remove this part if exist
         :param user_data: json object with user details, must contain user identifier
         (id or userPrincipalName property)
-        :return: void
+        :param user_id: object id found in local index, used instead of user_data identifiers if given
+        :return: batch request with changed fields only or None if nothing changed since last write
         """
-        user_id = user_data['id'] if user_data.get('id') else user_data['userPrincipalName']
-
-        if not user_id:
-            raise Exception("Couldn't find id for user, at least id or userPrincipalName needed")
+        user_id = user_id or __get_user_id(user_data)
         # we can't and don't need to update user password when syncing user with Azure
         if user_data.get('passwordProfile'):
             del user_data['passwordProfile']
 
+        changes = change_store.diff('users', user_id, user_data, force_resync)
+        if changes is None:
+            logging.info(f'user {user_id} not changed since last write, skipping')
+            return None
+
         logging.info(f'trying to update user {user_id}')
-        make_request(f'{GRAPH_URL}{RESOURCE_PATH}{user_id}', 'PATCH', user_data)
-        logging.info(f'user {user_id} updated successfully')
+        return {'method': 'PATCH', 'url': f'{RESOURCE_PATH}{user_id}', 'body': changes}
 
-    def __try_delete(user_data: dict) -> None:
+    def __delete_request(user_data: dict, user_id: str = None) -> dict:
         """
         Internal function to 'delete' user (We will not actually perform delete operation but only
         disable user account by setting accountEnabled = false
         :param user_data: json object with user details, must contain user identifier
         (id or userPrincipalName property)
-        :return: void
+        :param user_id: object id found in local index, used instead of user_data identifiers if given
+        :return: batch request
         """
-        user_id = user_data['id'] if user_data.get('id') else user_data['userPrincipalName']
-        if not user_id:
-            raise Exception("Couldn't find id for user, at least id or userPrincipalName needed")
-
+        user_id = user_id or __get_user_id(user_data)
         logging.info(f'trying to disable user {user_id}')
-        make_request(f'{GRAPH_URL}{RESOURCE_PATH}{user_id}', 'PATCH', {'accountEnabled': False})
-        logging.info(f'user {user_id} disabled successfully')
-
-    for user in user_data_array:
-        if '_deleted' in user and user['_deleted']:
-            __try_delete(user)
-            continue
-
-        user = clear_sesam_attributes(user)
-        try:
-            if 'id' not in user:
-                __try_create(user)
+        return {'method': 'PATCH', 'url': f'{RESOURCE_PATH}{user_id}', 'body': {'accountEnabled': False}}
+
+    def __sync_chunk(users: list, summary: SinkSummary) -> None:
+        operations = []
+        # object ids of disabled users, state of users disabled by userPrincipalName only is not stored
+        disabled_ids = {}
+        for user in users:
+            try:
+                if '_deleted' in user and user['_deleted']:
+                    user_id = user.get('id') or id_index.lookup('users', user)
+                    disabled_ids[id(user)] = user_id
+                    operations.append((user, 'disabled', __delete_request(user, user_id)))
+                elif 'id' not in user:
+                    user_data = clear_sesam_attributes(user)
+                    user_id = id_index.lookup('users', user_data)
+                    if user_id:
+                        operations.append((user, 'updated', __update_request(user_data, user_id)))
+                    else:
+                        operations.append((user, 'created', __create_request(user_data)))
+                else:
+                    operations.append((user, 'updated', __update_request(clear_sesam_attributes(user))))
+            except Exception as e:
+                summary.add(user, 'failed', str(e))
+
+        for user, _, _ in [op for op in operations if op[2] is None]:
+            summary.add(user, 'skipped')
+        operations = [op for op in operations if op[2] is not None]
+
+        conflicts = []
+        for (user, status, request), response in zip(operations, make_batch_request([op[2] for op in operations])):
+            if response is None:
+                summary.add(user, 'failed', MISSING_RESPONSE_ERROR)
+            elif response['status'] < 400:
+                logging.info(f'{request["method"]} {request["url"]} completed successfully')
+                if status == 'created':
+                    id_index.remember('users', request['body'], response['body'].get('id'))
+                    change_store.remember('users', response['body'].get('id'), request['body'])
+                elif status == 'updated':
+                    change_store.remember('users', request['url'][len(RESOURCE_PATH):], request['body'])
+                else:
+                    # stored state must differ from re-enabled user, so accountEnabled is sent again
+                    change_store.remember('users', disabled_ids[id(user)], request['body'])
+                summary.add(user, status)
+            elif request['method'] == 'POST' and is_object_already_exists_error(response['body']):
+                conflicts.append((user, request['body']))
             else:
-                __try_update(user)
-        except Exception as e:
-            if is_object_already_exists_exception(e):
-                __try_update(user)
+                summary.add(user, 'failed', response['body'])
+
+        updates = []
+        for user, user_data in conflicts:
+            try:
+                request = __update_request(user_data)
+                if request is None:
+                    summary.add(user, 'skipped')
+                else:
+                    updates.append((user, request))
+            except Exception as e:
+                summary.add(user, 'failed', str(e))
+
+        # existing users are updated by userPrincipalName, their object id is read in the same batch
+        # so written state is stored and indexed under object id like state of all other users
+        update_requests = []
+        for _, request in updates:
+            update_requests.append(request)
+            update_requests.append({'method': 'GET', 'url': f'{request["url"]}?$select=id',
+                                    'depends_on': [len(update_requests) - 1]})
+        responses = make_batch_request(update_requests)
+        for (user, request), response, found in zip(updates, responses[0::2], responses[1::2]):
+            if response is None:
+                summary.add(user, 'failed', MISSING_RESPONSE_ERROR)
+            elif response['status'] < 400:
+                logging.info(f'user {request["url"]} updated successfully')
+                user_id = found['body'].get('id') if found is not None and found['status'] < 400 else None
+                id_index.remember('users', request['body'], user_id)
+                change_store.remember('users', user_id, request['body'])
+                summary.add(user, 'updated')
             else:
-                raise Exception from e
+                summary.add(user, 'failed', response['body'])
+
+    return run_sink(user_data_array, lambda u: u.get('id') or u.get('userPrincipalName'), __sync_chunk)
 
 
-def get_all_users(delta=None):
+def get_all_users(delta=None, query=None, limit=None):
     """
     Fetch and stream back users from Azure AD via MS Graph API
-    :param delta: delta token from last request
+    :param delta: delta token or cursor from last request
+    :param query: OData query options, attributes needed for id index are fetched even if not selected
+    and removed before output
+    :param limit: optional ResponseLimit, limited output is fetched page by page (never in segments)
     :return: generated JSON output with all fetched users
     """
-    yield from stream_as_json(get_all_objects(f'{RESOURCE_PATH}delta', delta))
+    indexed = id_index.FETCHED_ATTRIBUTES['users'] if id_index.ID_INDEX_ENABLED else ()
+    graph_query = with_selected(query or {}, indexed)
+    if delta is None and limit is None and segment_helper.SEGMENTED_FULL_SYNC:
+        objects = segment_helper.get_all_objects_segmented('users', RESOURCE_PATH, graph_query)
+    else:
+        objects = get_all_objects(f'{RESOURCE_PATH}delta', delta, graph_query, limit)
+    users = id_index.index_objects('users', objects)
+    yield from stream_as_json(project(users, projection(query)))